@@ -0,0 +1,771 @@
+"""Benchmarks and consistency checks for the server, its tests are in test_server.py.
+
+Usage: python bench.py <name> [args...]
+Run without arguments to list the available benchmarks.
+"""
+
+import os, random, selectors, signal, socket, sys, tempfile, time, tracemalloc
+from collections import defaultdict
+
+from server import Game, MoveCache, Connection, Server, frame
+from protocol import binary_frame, next_frame
+from gamelog import GameLog, encode, read_games
+from pgn import export
+from metrics import Metrics
+from logger import LOGGER, Logger, INFO, WARNING
+from profiler import PROFILER
+from support import FEN_CORPUS, PERFT_SUITE, new_game, play, random_lines, start_server, recv_frames, join_players
+
+BENCHES = {}
+
+
+def bench(fn):
+    BENCHES[fn.__name__] = fn
+    return fn
+
+
+@bench
+def movegen(games: str = "8", plies: str = "40") -> None:
+    """Timing of the list and bitboard move generators, test_server.py checks they agree."""
+    timings = {False: 0.0, True: 0.0}
+    positions = 0
+
+    for pos, line in random_lines(int(games), int(plies)):
+        ref = new_game(pos)
+        bb = new_game(pos, bitboard=True)
+
+        for move in [None] + line:
+            if move is not None:
+                play(ref, move)
+                play(bb, move)
+
+            for game in (ref, bb):
+                start = time.perf_counter()
+                game.get_all_moves()
+                game.get_all_legal_moves()
+                timings[game.bitboard] += time.perf_counter() - start
+            positions += 1
+
+    for mode, name in ((False, "list"), (True, "bitboard")):
+        print(f"{name:>8}: {timings[mode] / positions * 1000:.3f} ms/position over {positions} positions")
+
+
+@bench
+def ply(games: str = "4", plies: str = "40") -> None:
+    """Time get_all_legal_moves per ply for both board backends."""
+    for bitboard in (False, True):
+        elapsed = 0.0
+        count = 0
+        for pos, line in random_lines(int(games), int(plies), seed=1):
+            game = new_game(pos, bitboard=bitboard)
+            for move in line:
+                start = time.perf_counter()
+                game.get_all_legal_moves()
+                elapsed += time.perf_counter() - start
+                count += 1
+                play(game, move)
+
+        print(f"{'bitboard' if bitboard else 'list':>8}: {elapsed / count * 1000:.3f} ms/ply over {count} plies")
+
+
+@bench
+def hashing(games: str = "8", plies: str = "60") -> None:
+    """Time replaying games through the move cache, cold and warm."""
+    lines = list(random_lines(int(games), int(plies), seed=2))
+
+    cache = MoveCache()
+    for run in ("cold", "warm"):
+        start = time.perf_counter()
+        count = 0
+        for pos, line in lines:
+            game = new_game(pos, move_cache=cache)
+            for move in line:
+                play(game, move)
+                count += 1
+        print(f"{run}: {(time.perf_counter() - start) / count * 1000:.3f} ms/ply, cache {cache.stats()}")
+
+
+@bench
+def lazy(games: str = "8", plies: str = "40", queries: str = "2") -> None:
+    """Server CPU per ply answering a move, with the move table filled for every square vs. only as asked."""
+    lines = list(random_lines(int(games), int(plies), seed=4))
+    rng = random.Random(4)
+
+    for bitboard in (False, True):
+        for eager in (True, False):
+            elapsed = 0.0
+            count = 0
+            for pos, line in lines:
+                game = new_game(pos, bitboard=bitboard, move_cache=MoveCache())
+                game.white, game.black = object(), object()
+                for move in line:
+                    player = game.white if game.turn == Game.WHITE_TURN else game.black
+                    own = [sq for sq in game.occupied_squares() if game.board[sq[0] * 8 + sq[1]] >> 3 == game.turn]
+                    asked = [rng.choice(own) for _ in range(int(queries))]
+
+                    start = time.perf_counter()
+                    for r, f in asked:
+                        game.legal_moves(r, f)
+                    game.make_move(player, move)
+                    game.update_moves()
+                    if eager:
+                        game.all_legal_moves()
+                    game.save_board_pos(game.turn ^ 1)
+                    game.check_check()
+                    game.has_moves(player)
+                    elapsed += time.perf_counter() - start
+                    count += 1
+
+            print(f"{'bitboard' if bitboard else 'list':>8} {'eager' if eager else 'lazy':>5}: {elapsed / count * 1000:.3f} ms/ply over {count} plies")
+
+
+@bench
+def repetition(games: str = "8", plies: str = "100") -> None:
+    """Memory and time per saved position: hash history vs. the old nested-tuple keys."""
+    lines = list(random_lines(int(games), int(plies), seed=3))
+    positions = sum(len(line) for _, line in lines)
+
+    tracemalloc.start()
+    elapsed = 0.0
+    kept = []
+    for pos, line in lines:
+        game = new_game(pos)
+        for move in line:
+            play(game, move)
+            start = time.perf_counter()
+            game.save_board_pos(game.turn ^ 1)
+            elapsed += time.perf_counter() - start
+        kept.append(game.history)
+        del game
+    hashed = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"  hash: {hashed / positions:8.1f} B/position, {elapsed / positions * 1e6:.2f} us/save")
+
+    kept.clear()
+    tracemalloc.start()
+    elapsed = 0.0
+    for pos, line in lines:
+        game = new_game(pos)
+        boards = defaultdict(int)
+        for move in line:
+            play(game, move)
+            start = time.perf_counter()
+            key = (tuple(tuple(game.board[r * 8:r * 8 + 8]) for r in range(8)), tuple(game.castle_pos))
+            boards[key] += 1
+            elapsed += time.perf_counter() - start
+        kept.append(boards)
+        del game
+    tupled = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f" tuple: {tupled / positions:8.1f} B/position, {elapsed / positions * 1e6:.2f} us/save")
+
+
+@bench
+def footprint(games: str = "200", plies: str = "40") -> None:
+    """Memory per Game, fresh and after a random line, and legal moves generated per second."""
+    lines = list(random_lines(int(games), int(plies), seed=5))
+
+    for bitboard in (False, True):
+        name = "bitboard" if bitboard else "list"
+
+        tracemalloc.start()
+        kept = [new_game(pos, bitboard=bitboard, move_cache=MoveCache(0)) for pos, _ in lines]
+        fresh = tracemalloc.get_traced_memory()[0] / len(kept)
+        for game, (_, line) in zip(kept, lines):
+            for move in line:
+                play(game, move)
+                game.save_board_pos(game.turn ^ 1)
+        played = tracemalloc.get_traced_memory()[0] / len(kept)
+        tracemalloc.stop()
+        kept.clear()
+
+        moves = 0
+        elapsed = 0.0
+        for pos, line in lines:
+            game = new_game(pos, bitboard=bitboard, move_cache=MoveCache(0))
+            for move in line:
+                start = time.perf_counter()
+                moves += sum(len(targets) for targets in game.get_all_legal_moves().values())
+                elapsed += time.perf_counter() - start
+                play(game, move)
+
+        print(f"{name:>8}: {fresh:7.0f} B/game fresh, {played:7.0f} B/game after {plies} plies, {moves / elapsed:8.0f} moves/s")
+
+
+@bench
+def backlog(counts: str = "1000,10000,100000") -> None:
+    """Flush a lagging connection's queued frames through a small socket buffer."""
+    for count in [int(c) for c in counts.split(",")]:
+        ours, theirs = socket.socketpair()
+        ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        con = Connection(ours)
+
+        for _ in range(count):
+            con.queue_write(Game.START_POS)
+
+        writes = 0
+        start = time.perf_counter()
+        while not con.queue_empty:
+            try:
+                con.write()
+                writes += 1
+            except BlockingIOError:
+                pass
+            theirs.recv(65536)
+        elapsed = time.perf_counter() - start
+
+        ours.close()
+        theirs.close()
+        print(f"{count:>7} frames: {elapsed * 1000:9.2f} ms to flush in {writes} writes, {elapsed / count * 1e6:.2f} us/frame")
+
+
+@bench
+def broadcast(counts: str = "100,1000,10000", moves: str = "1000") -> None:
+    """Queue cost of one move broadcast per subscriber: framing per recipient vs. Game.broadcast."""
+    ours, theirs = socket.socketpair()  # Queueing never touches the socket, so every subscriber can share one
+
+    for count in [int(c) for c in counts.split(",")]:
+        game = new_game(Game.START_POS)
+        for _ in range(count):
+            game.write_to[Connection(ours)] = None
+        rounds = max(1, int(moves) * 100 // count)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for c in game.write_to:
+                c.queue_write("e2e4+")
+        per_recipient = time.perf_counter() - start
+        for c in game.write_to:
+            c.send_queue.clear()
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            game.broadcast("e2e4+")
+        shared = time.perf_counter() - start
+
+        stats = game.broadcast_stats()
+        print(f"{count:>6} subscribers: {per_recipient / rounds / count * 1e9:6.0f} -> {shared / rounds / count * 1e9:4.0f} ns/subscriber, "
+              f"{stats['frames'] // stats['broadcasts']} frames, {stats['bytes'] // stats['broadcasts']} B per move")
+
+    ours.close()
+    theirs.close()
+
+
+@bench
+def protocol(games: str = "8", plies: str = "60") -> None:
+    """Bytes on the wire and encode/decode time of the ASCII and binary protocols."""
+    moves = []
+    snapshots = []
+    for pos, line in random_lines(int(games), int(plies), seed=4):
+        game = new_game(pos)
+        for move in line:
+            snapshots.append(game.fen_encode())
+            play(game, move)
+            moves += [move, "ok", move]  # Sent by the mover, its answer and the broadcast to everyone else
+
+    for kind, msgs, per in (("per move", moves, 3), ("snapshot", snapshots, 1)):
+        for name, to_frame, binary in (("ascii", frame, False), ("binary", binary_frame, True)):
+            start = time.perf_counter()
+            frames = [to_frame(msg) for msg in msgs]
+            encoding = time.perf_counter() - start
+
+            start = time.perf_counter()
+            [next_frame(data, 0, len(data), binary)[0] for data in frames]
+            decoding = time.perf_counter() - start
+
+            size = sum(len(data) for data in frames)
+            print(f"{kind} {name:>6}: {size * per / len(msgs):6.1f} B, encode {encoding / len(msgs) * 1e6:5.2f} us, "
+                  f"decode {decoding / len(msgs) * 1e6:5.2f} us per message")
+
+
+@bench
+def fen(games: str = "8", plies: str = "60", repeat: str = "20") -> None:
+    """Time the FEN codec on FEN_CORPUS and positions of random games."""
+    corpus = list(FEN_CORPUS)
+    for pos, line in random_lines(int(games), int(plies), seed=5):
+        game = new_game(pos)
+        for move in line:
+            play(game, move)
+            corpus.append(game.fen_encode())
+
+    games = [Game() for _ in range(int(repeat)) for _ in corpus]
+    start = time.perf_counter()
+    for game, pos in zip(games, corpus * int(repeat)):
+        game.fen_decode(pos)
+    decode = (time.perf_counter() - start) / len(games)
+
+    start = time.perf_counter()
+    for game in games:
+        game.fen = None
+        game.fen_ranks = [None] * 8
+        game.fen_encode()
+    encode = (time.perf_counter() - start) / len(games)
+
+    start = time.perf_counter()
+    for game in games:
+        game.fen_encode()
+    cached = (time.perf_counter() - start) / len(games)
+
+    print(f"decode {decode * 1e6:.2f} us, encode {encode * 1e6:.2f} us, cached encode {cached * 1e6:.3f} us")
+
+
+@bench
+def perft(depth: str = "3", backend: str = "both") -> None:
+    """Report perft nodes/s on PERFT_SUITE, test_server.py checks the counts."""
+    backends = {"list": [False], "bitboard": [True], "both": [False, True]}[backend]
+
+    for bitboard in backends:
+        total_nodes = 0
+        total_time = 0.0
+        for pos, counts in PERFT_SUITE:
+            game = new_game(pos, bitboard=bitboard)
+            for d in range(1, min(int(depth), len(counts)) + 1):
+                start = time.perf_counter()
+                nodes = game.perft(d)
+                elapsed = time.perf_counter() - start
+                total_nodes += nodes
+                total_time += elapsed
+                print(f"{'bitboard' if bitboard else 'list':>8} depth {d} {nodes:>8} nodes {nodes / elapsed:8.0f} nodes/s  {pos}")
+
+        print(f"{'bitboard' if bitboard else 'list':>8} total: {total_nodes} nodes, {total_nodes / total_time:.0f} nodes/s")
+
+
+FOOLS_MATE = ["f2f3", "e7e5", "g2g4", "d8h4"]
+
+
+class LoadRoom:
+    """Two clients joining one room of a Server and playing a scripted game.
+
+    The script needn't end the game, the client to move after it is over
+    leaves, which ends the game as abandoned.
+    """
+
+    def __init__(self, room_id: str, script: list[str]) -> None:
+        self.room_id = room_id
+        self.script = script
+        self.ply = 0
+        self.joined = 0
+        self.sent_at = 0.0
+        self.clients = []
+
+
+class LoadClient:
+
+    def __init__(self, port: int, room: LoadRoom, color: str) -> None:
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.room = room
+        self.color = color
+        self.buf = bytearray()
+        self.state = "roles"
+        self.done = False
+        room.clients.append(self)
+
+        self.sock.sendall(frame(f"join {room.room_id}"))
+
+    def frames(self) -> list[str]:
+        data = self.sock.recv(65536)
+        if not data:
+            self.done = True
+            return []
+
+        self.buf.extend(data)
+        msgs = []
+        while len(self.buf) >= 3 and len(self.buf) >= 3 + int(self.buf[:3]):
+            length = int(self.buf[:3])
+            msgs.append(self.buf[3:3 + length].decode("ascii"))
+            del self.buf[:3 + length]
+        return msgs
+
+    def play_next(self) -> None:
+        room = self.room
+        room.sent_at = time.perf_counter()
+        self.sock.sendall(frame(room.script[room.ply]))
+        room.ply += 1
+
+    def handle(self, msg: str, latencies: list[float]) -> None:
+        room = self.room
+
+        if self.state == "roles":
+            self.sock.sendall(frame(self.color))
+            self.state = "fen"
+        elif self.state == "fen":
+            self.state = "initok"
+        elif self.state == "initok":
+            self.state = "playing"
+            room.joined += 1
+            if room.joined == 2:
+                room.clients[0 if room.clients[0].color == "w" else 1].play_next()
+        elif msg.startswith("ok"):
+            latencies.append(time.perf_counter() - room.sent_at)
+        elif msg.startswith("end"):
+            self.done = True
+        elif room.ply < len(room.script):
+            self.play_next()
+        else:
+            self.done = True
+
+
+def run_load(port: int, rooms: int, scripts: list[list[str]]) -> tuple[float, list[float]]:  # Room i plays scripts[i % len(scripts)]
+    sel = selectors.DefaultSelector()
+    latencies = []
+
+    start = time.perf_counter()
+    clients = []
+    for i in range(rooms):
+        room = LoadRoom(f"load-{i}", scripts[i % len(scripts)])
+        for color in ("w", "b"):
+            client = LoadClient(port, room, color)
+            sel.register(client.sock, selectors.EVENT_READ, client)
+            clients.append(client)
+
+    remaining = len(clients)
+    while remaining:
+        for key, _ in sel.select(5):
+            client = key.data
+            for msg in client.frames():
+                client.handle(msg, latencies)
+            if client.done:
+                sel.unregister(client.sock)
+                client.sock.close()
+                remaining -= 1
+
+    elapsed = time.perf_counter() - start
+    sel.close()
+    return elapsed, latencies
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+@bench
+def rooms(counts: str = "1,10,100,1000", transport: str = "selectors") -> None:
+    """Games/sec and move latency of a multi-room server (selectors or asyncio) as the number of rooms grows."""
+    for count in [int(c) for c in counts.split(",")]:
+        port, proc = start_server(transport)
+
+        elapsed, latencies = run_load(port, count, [FOOLS_MATE])
+
+        proc.terminate()
+        proc.join()
+
+        print(f"{count:>6} rooms: {count / elapsed:8.1f} games/s, move latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+
+class Spectator:
+
+    def __init__(self, port: int) -> None:
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.buf = bytearray()
+        self.received = 0
+
+    def join(self, room_id: str) -> None:
+        self.sock.sendall(frame(f"join {room_id}"))
+        self.sock.setblocking(False)
+
+    def receive(self) -> None:
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        self.buf.extend(data)
+        while len(self.buf) >= 3 and len(self.buf) >= 3 + int(self.buf[:3]):
+            del self.buf[:3 + int(self.buf[:3])]
+            self.received += 1
+
+
+def wait_received(sel: selectors.BaseSelector, spectators: list[Spectator], count: int) -> None:
+    behind = sum(1 for s in spectators if s.received < count)
+    while behind:
+        for key, _ in sel.select(5):
+            spectator = key.data
+            before = spectator.received < count
+            spectator.receive()
+            if before and spectator.received >= count:
+                behind -= 1
+
+
+SHUFFLE = ["g1f3", "g8f6", "f3g1", "f6g8", "b1c3", "b8c6"]
+
+
+@bench
+def spectators(counts: str = "100,1000,10000", transport: str = "selectors") -> None:
+    """Join throughput and per-move broadcast cost of one room as the number of spectators grows."""
+    for count in [int(c) for c in counts.split(",")]:
+        port, proc = start_server(transport)
+
+        players = join_players(port, "watch")
+
+        sel = selectors.DefaultSelector()
+        spectators = [Spectator(port) for _ in range(count)]
+
+        start = time.perf_counter()
+        for spectator in spectators:
+            spectator.join("watch")
+            sel.register(spectator.sock, selectors.EVENT_READ, spectator)
+        wait_received(sel, spectators, 3)
+        joining = time.perf_counter() - start
+
+        elapsed = 0.0
+        for ply, move in enumerate(SHUFFLE):
+            mover, other = players[ply % 2], players[1 - ply % 2]
+            start = time.perf_counter()
+            mover.sendall(frame(move))
+            recv_frames(mover, 1)
+            recv_frames(other, 1)
+            wait_received(sel, spectators, 4 + ply)
+            elapsed += time.perf_counter() - start
+
+        proc.terminate()
+        proc.join()
+        for spectator in spectators:
+            spectator.sock.close()
+        for sock in players:
+            sock.close()
+        sel.close()
+
+        per_move = elapsed / len(SHUFFLE)
+        print(f"{count:>6} spectators: {count / joining:8.0f} joins/s, {per_move * 1000:8.2f} ms/move, {per_move / count * 1e6:6.2f} us/spectator")
+
+
+
+@bench
+def queries(counts: str = "1,10,100,1000", rounds: str = "20", transport: str = "selectors") -> None:
+    """Round trip of a burst of pipelined "moves" queries from the player to move."""
+    port, proc = start_server(transport)
+    white, black = join_players(port, "queries")
+
+    for count in [int(c) for c in counts.split(",")]:
+        burst = b"".join(frame(f"moves {f}2") for f in "abcdefgh") * count
+        expected = 8 * count
+
+        start = time.perf_counter()
+        for _ in range(int(rounds)):
+            white.sendall(burst)
+            received = 0
+            buf = bytearray()
+            while received < expected:
+                buf.extend(white.recv(65536))
+                pos = 0
+                while len(buf) - pos >= 3 and len(buf) - pos >= 3 + int(buf[pos:pos + 3]):
+                    pos += 3 + int(buf[pos:pos + 3])
+                    received += 1
+                del buf[:pos]
+        elapsed = (time.perf_counter() - start) / int(rounds)
+
+        print(f"{expected:>6} queries: {elapsed * 1000:8.2f} ms/burst, {elapsed / expected * 1e6:6.2f} us/query")
+
+    proc.terminate()
+    proc.join()
+    white.close()
+    black.close()
+
+
+@bench
+def pool(rooms: str = "100", plies: str = "20", sizes: str = None, transport: str = "selectors") -> None:
+    """Games/sec and move latency with move analysis in a pool of 0 (in the event loop), 1 .. cpu_count workers."""
+    sizes = sizes or ",".join(str(n) for n in range(os.cpu_count() + 1))
+    # With a cache of their own, so the forked server doesn't start out knowing every position
+    scripts = [line for _, line in random_lines(32, int(plies), positions=[Game.START_POS], move_cache=MoveCache())]
+
+    for workers in [int(n) for n in sizes.split(",")]:
+        port, proc = start_server(transport, workers)
+
+        elapsed, latencies = run_load(port, int(rooms), scripts)
+
+        proc.terminate()
+        proc.join()
+
+        print(f"{workers:>3} workers: {int(rooms) / elapsed:8.1f} games/s, move latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+
+@bench
+def gamelog(games: str = "2000", plies: str = "40", seconds: str = "2") -> None:
+    """Event loop cost and syscalls of the game log with many concurrent games, vs. a write per record, then PGN export."""
+    games, plies = int(games), int(plies)
+    lines = list(random_lines(50, plies, seed=6))
+    pause = float(seconds) / plies  # Between rounds of one move in every game
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "games.log")
+
+        fd = os.open(os.path.join(tmp, "naive.log"), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        elapsed = 0.0
+        writes = 0
+        for ply in range(plies):
+            start = time.perf_counter()
+            for i in range(games):
+                line = lines[i % len(lines)][1]
+                if ply < len(line):
+                    os.write(fd, encode(("move", str(i), time.time(), line[ply])).encode("utf-8"))
+                    writes += 1
+            elapsed += time.perf_counter() - start
+        os.close(fd)
+        print(f" naive: {writes} moves, {writes} writes, {elapsed / writes * 1e6:.2f} us/move on the loop")
+
+        log = GameLog(path)
+        ids = [log.start(str(i), lines[i % len(lines)][0]) for i in range(games)]
+        elapsed = 0.0
+        wall = time.perf_counter()
+        for ply in range(plies):
+            start = time.perf_counter()
+            for i, game_id in enumerate(ids):
+                line = lines[i % len(lines)][1]
+                if ply < len(line):
+                    log.move(game_id, line[ply])
+            elapsed += time.perf_counter() - start
+            time.sleep(pause)
+        for game_id in ids:
+            log.end(game_id, "1/2-1/2")
+        log.close()
+        wall = time.perf_counter() - wall
+
+        print(f"   log: {writes} moves, {log.batches} writes+fsyncs ({log.batches / wall:.0f}/s) for {log.records} records, {elapsed / writes * 1e6:.2f} us/move on the loop")
+
+        start = time.perf_counter()
+        exported = sum(1 for record in read_games(path) if export(record))
+        elapsed = time.perf_counter() - start
+        if exported != games:
+            raise AssertionError(f"{exported} of {games} games read back")
+        print(f"   pgn: {exported} games read back and exported, {elapsed / exported * 1000:.2f} ms/game")
+
+
+@bench
+def timers(count: str = "100000") -> None:
+    """Cost of scheduling, re-arming (a move on a clock) and firing timers with many pending, and the heap size after cancellations."""
+    count = int(count)
+    fired = []
+    base = time.monotonic() - 1000  # All of them are due by the time they are run
+
+    with Server() as server:
+        start = time.perf_counter()
+        pending = [server.call_at(base + random.random(), lambda i=i: fired.append(i)) for i in range(count)]
+        elapsed = time.perf_counter() - start
+        print(f"schedule: {elapsed / count * 1e6:.2f} us/timer")
+
+        start = time.perf_counter()
+        for i, timer in enumerate(pending):
+            server.cancel(timer)
+            pending[i] = server.call_at(timer.deadline, timer.callback)
+        elapsed = time.perf_counter() - start
+        print(f"  re-arm: {elapsed / count * 1e6:.2f} us/timer, heap of {len(server.timers)} entries for {count} pending")
+
+        deadlines = [timer.deadline for timer in pending]
+        start = time.perf_counter()
+        server.run_timers()
+        elapsed = time.perf_counter() - start
+        if len(fired) != count or [deadlines[i] for i in fired] != sorted(deadlines):
+            raise AssertionError("timers fired out of order")
+        print(f"    fire: {elapsed / count * 1e6:.2f} us/timer, {len(server.timers)} left, {server.cancelled} cancelled")
+
+
+@bench
+def metrics(rooms: str = "200", plies: str = "40", transport: str = "selectors") -> None:
+    """Cost of recording metrics: per observation, per scrape, and games/sec and move latency of a loaded server with and without."""
+    registry = Metrics()
+    histogram = registry.phases["make_move"]
+    values = [random.random() * 1e-3 for _ in range(1000)]
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        for value in values:
+            histogram.observe(value)
+    print(f" observe: {(time.perf_counter() - start) / (1000 * len(values)) * 1e6:.3f} us")
+
+    start = time.perf_counter()
+    size = sum(len(registry.render()) for _ in range(100))
+    print(f"  render: {(time.perf_counter() - start) / 100 * 1000:.3f} ms, {size // 100} bytes")
+
+    scripts = [line for _, line in random_lines(32, int(plies), positions=[Game.START_POS], move_cache=MoveCache())]
+    for recording in (False, True, False, True):
+        port, proc = start_server(transport, metrics=recording)
+
+        elapsed, latencies = run_load(port, int(rooms), scripts)
+
+        proc.terminate()
+        proc.join()
+
+        print(f"{'on' if recording else 'off':>8}: {int(rooms) / elapsed:8.1f} games/s, move latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+
+class SlowStream:
+    """Stands in for a pipe to a log shipper that backs up, every write blocks for a while."""
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, data: str) -> None:
+        time.sleep(self.delay)
+        self.writes += 1
+
+    def flush(self) -> None:
+        pass
+
+
+@bench
+def logs(records: str = "200000", delay: str = "0.05") -> None:
+    """Caller's cost per record with the level disabled and enabled, and what is kept and dropped when the output backs up, vs. print."""
+    records, delay = int(records), float(delay)
+    stream = SlowStream(delay)
+    logger = Logger(INFO, stream)
+
+    start = time.perf_counter()
+    for i in range(records):
+        logger.debug("message", room="load-1", side="white", msg="e2e4")
+    print(f"disabled: {(time.perf_counter() - start) / records * 1e9:.0f} ns/record")
+
+    worst = 0.0
+    start = time.perf_counter()
+    for i in range(records):
+        t = time.perf_counter()
+        logger.info("message", room="load-1", side="white", msg="e2e4", ply=i)
+        worst = max(worst, time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    logger.close()
+    stats = logger.stats()
+    print(f" enabled: {elapsed / records * 1e9:.0f} ns/record, worst {worst * 1e6:.0f} us, {stats['written']} written in {stream.writes} writes, {stats['dropped']} dropped")
+
+    count = max(1, int(0.5 / delay))
+    start = time.perf_counter()
+    for i in range(count):
+        print(f"White: e2e4 {i}", file=stream)
+    print(f"   print: {(time.perf_counter() - start) / count * 1e6:.0f} us/record")
+
+
+@bench
+def profiling(rooms: str = "100", plies: str = "30", transport: str = "selectors") -> None:
+    """Games/sec and move latency of a loaded server without a profiling session, during a cprofile one (SIGUSR1) and during a trace one (SIGUSR2)."""
+    scripts = [line for _, line in random_lines(32, int(plies), positions=[Game.START_POS], move_cache=MoveCache())]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        PROFILER.directory = tmp  # The forked servers write there
+
+        for name, signum in (("off", None), ("cprofile", signal.SIGUSR1), ("trace", signal.SIGUSR2)):
+            port, proc = start_server(transport)
+            time.sleep(0.2)  # Until it handles the signals
+            if signum is not None:
+                os.kill(proc.pid, signum)
+
+            elapsed, latencies = run_load(port, int(rooms), scripts)
+
+            proc.terminate()
+            proc.join()
+
+            print(f"{name:>8}: {int(rooms) / elapsed:8.1f} games/s, move latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+        written = sorted(os.listdir(tmp))
+        if len(written) != 2:
+            raise AssertionError(f"Expected a file per session, got {written}")
+
+
+if __name__ == "__main__":
+    LOGGER.level = WARNING  # The servers' records would get in between the results
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHES:
+        for name, fn in BENCHES.items():
+            print(f"{name:>12}  {fn.__doc__}")
+        sys.exit(1)
+
+    BENCHES[sys.argv[1]](*sys.argv[2:])
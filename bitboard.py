@@ -0,0 +1,186 @@
+"""Bitboard move generation backend for Game.
+
+Squares are indexed as r * 8 + f, where r and f are the same rank/file
+coordinates Game uses for its board (r = 0 is the 8th rank). Piece codes are
+the values of server.Piece, so bit 8 of a code is its color.
+"""
+
+NONE = 0
+PAWN = 1
+ROOK = 2
+KNIGHT = 3
+BISHOP = 4
+QUEEN = 5
+KING = 6
+
+BLACK = 8
+
+FULL = (1 << 64) - 1
+
+SQUARES = [(sq >> 3, sq & 7) for sq in range(64)]
+
+# Directions as (dr, df). The first four increase the square index, so the
+# nearest blocker along them is the lowest set bit; the rest use the highest.
+POSITIVE = [(1, 0), (0, 1), (1, 1), (1, -1)]
+NEGATIVE = [(-1, 0), (0, -1), (-1, -1), (-1, 1)]
+
+ROOK_DIRS = [0, 1, 4, 5]
+BISHOP_DIRS = [2, 3, 6, 7]
+
+
+def _build_jumps(offsets: list[tuple[int, int]]) -> list[int]:
+    table = []
+    for r, f in SQUARES:
+        bb = 0
+        for dr, df in offsets:
+            nr, nf = r + dr, f + df
+            if 0 <= nr < 8 and 0 <= nf < 8:
+                bb |= 1 << (nr * 8 + nf)
+        table.append(bb)
+    return table
+
+
+def _build_rays() -> list[list[int]]:
+    rays = []
+    for dr, df in POSITIVE + NEGATIVE:
+        table = []
+        for r, f in SQUARES:
+            bb = 0
+            nr, nf = r + dr, f + df
+            while 0 <= nr < 8 and 0 <= nf < 8:
+                bb |= 1 << (nr * 8 + nf)
+                nr += dr
+                nf += df
+            table.append(bb)
+        rays.append(table)
+    return rays
+
+
+KNIGHT_ATTACKS = _build_jumps([(-2, -1), (-2, 1), (-1, 2), (1, 2), (2, -1), (2, 1), (-1, -2), (1, -2)])
+KING_ATTACKS = _build_jumps([(dr, df) for dr in (-1, 0, 1) for df in (-1, 0, 1) if (dr, df) != (0, 0)])
+PAWN_ATTACKS = [_build_jumps([(-1, -1), (-1, 1)]), _build_jumps([(1, -1), (1, 1)])]  # [white, black]
+RAYS = _build_rays()
+
+
+def ray_attacks(sq: int, occupied: int, dirs: list[int]) -> int:
+    attacks = 0
+    for d in dirs:
+        ray = RAYS[d][sq]
+        blockers = ray & occupied
+        if blockers:
+            if d < 4:
+                b = (blockers & -blockers).bit_length() - 1
+            else:
+                b = blockers.bit_length() - 1
+            ray ^= RAYS[d][b]
+        attacks |= ray
+    return attacks
+
+
+def squares(bb: int) -> list[tuple[int, int]]:
+    out = []
+    while bb:
+        low = bb & -bb
+        out.append(SQUARES[low.bit_length() - 1])
+        bb ^= low
+    return out
+
+
+class BitBoard:
+
+    def __init__(self) -> None:
+        self.pieces: list[int] = [0] * 15  # Indexed by piece code
+        self.colors: list[int] = [0, 0]
+        self.occupied = 0
+
+    @classmethod
+    def from_board(cls, board: bytearray) -> "BitBoard":  # From Game's board, one piece code per square
+        bb = cls()
+        for sq, code in enumerate(board):
+            if code != NONE:
+                bb.put(sq, code)
+        return bb
+
+    def put(self, sq: int, code: int) -> None:
+        bit = 1 << sq
+        self.pieces[code] |= bit
+        self.colors[code >> 3] |= bit
+        self.occupied |= bit
+
+    def remove(self, sq: int, code: int) -> None:
+        bit = ~(1 << sq)
+        self.pieces[code] &= bit
+        self.colors[code >> 3] &= bit
+        self.occupied &= bit
+
+    def pseudo_moves(self, sq: int, code: int, castle_pos: list[bool], en_passant_sq: int | None) -> int:
+        color = code >> 3
+        kind = code & 7
+        own = self.colors[color]
+
+        if kind == PAWN:
+            bit = 1 << sq
+            if color == 0:
+                push = (bit >> 8) & ~self.occupied
+                if push and sq >> 3 == 6:
+                    push |= (push >> 8) & ~self.occupied
+            else:
+                push = (bit << 8) & ~self.occupied
+                if push and sq >> 3 == 1:
+                    push |= (push << 8) & ~self.occupied
+            targets = self.colors[color ^ 1]
+            if en_passant_sq is not None and en_passant_sq >> 3 == (2 if color == 0 else 5):
+                targets |= 1 << en_passant_sq
+            return push | (PAWN_ATTACKS[color][sq] & targets)
+
+        if kind == KNIGHT:
+            return KNIGHT_ATTACKS[sq] & ~own
+
+        if kind == KING:
+            moves = KING_ATTACKS[sq] & ~own
+            f = sq & 7
+            rooks = self.pieces[ROOK | code & BLACK]
+            if castle_pos[color * 2 + 1] and f >= 4 and rooks >> (sq - 4) & 1 and not self.occupied & (0b111 << (sq - 3)):
+                moves |= 1 << (sq - 2)
+            if castle_pos[color * 2] and f <= 4 and rooks >> (sq + 3) & 1 and not self.occupied & (0b11 << (sq + 1)):
+                moves |= 1 << (sq + 2)
+            return moves
+
+        if kind == ROOK:
+            return ray_attacks(sq, self.occupied, ROOK_DIRS) & ~own
+        if kind == BISHOP:
+            return ray_attacks(sq, self.occupied, BISHOP_DIRS) & ~own
+        if kind == QUEEN:
+            return ray_attacks(sq, self.occupied, ROOK_DIRS + BISHOP_DIRS) & ~own
+
+        return 0
+
+    def attackers(self, sq: int, color: int) -> int:  # Pieces of color (0 = white, 1 = black) attacking sq
+        c = color << 3
+        pieces = self.pieces
+        queens = pieces[QUEEN | c]
+
+        return (PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWN | c]
+                | KNIGHT_ATTACKS[sq] & pieces[KNIGHT | c]
+                | KING_ATTACKS[sq] & pieces[KING | c]
+                | ray_attacks(sq, self.occupied, ROOK_DIRS) & (pieces[ROOK | c] | queens)
+                | ray_attacks(sq, self.occupied, BISHOP_DIRS) & (pieces[BISHOP | c] | queens))
+
+    def is_attacked(self, sq: int, color: int) -> bool:  # Whether any piece of color (0 = white, 1 = black) attacks sq
+        c = color << 3
+        pieces = self.pieces
+
+        if PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWN | c]:
+            return True
+        if KNIGHT_ATTACKS[sq] & pieces[KNIGHT | c]:
+            return True
+        if KING_ATTACKS[sq] & pieces[KING | c]:
+            return True
+
+        queens = pieces[QUEEN | c]
+        if ray_attacks(sq, self.occupied, ROOK_DIRS) & (pieces[ROOK | c] | queens):
+            return True
+        if ray_attacks(sq, self.occupied, BISHOP_DIRS) & (pieces[BISHOP | c] | queens):
+            return True
+
+        return False
@@ -0,0 +1,121 @@
+"""Append-only record of the games a server hosts.
+
+A game is a "start" record with its room and starting FEN, one "move" record
+per accepted move and an "end" record with the result. Each record is a JSON
+line carrying the game id and a Unix timestamp. Games cut short by a server
+shutdown have no end record.
+
+The event loop only queues records. A writer thread (see writer.py) turns
+everything queued within FLUSH_INTERVAL into a single write and fsync, so the
+syscall rate stays flat however many games are running. read_games reads a log back; see
+pgn.py to export the games.
+"""
+
+import json, os, time, uuid
+from typing import Iterator
+
+from writer import Writer
+
+FIELDS = {"start": ("room", "fen"), "move": ("move",), "end": ("result",)}  # Payload of each kind of record
+
+
+def encode(record: tuple) -> str:  # Log line of a queued (kind, game id, time, *payload) record
+    kind, game_id, t, *payload = record
+    entry = {"game": game_id, "event": kind, "t": round(t, 3)}
+    entry.update(zip(FIELDS[kind], payload))
+    return json.dumps(entry, separators=(",", ":")) + "\n"
+
+
+class GameLog(Writer):
+
+    NAME = "game log"
+    FLUSH_INTERVAL = 0.05
+
+    encode = staticmethod(encode)
+
+    def __init__(self, path: str, fsync: bool = True) -> None:
+        super().__init__()
+        self.file = open(path, "ab", buffering=0)
+        self.fsync = fsync
+
+        self.records = 0
+        self.batches = 0  # Writes (and fsyncs) so far
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self, room_id: str, fen: str) -> str:  # Returns the id of the new game, room ids get reused
+        game_id = uuid.uuid4().hex
+        self.append(("start", game_id, time.time(), room_id, fen))
+        return game_id
+
+    def move(self, game_id: str, move: str) -> None:
+        self.append(("move", game_id, time.time(), move))
+
+    def end(self, game_id: str, result: str) -> None:
+        self.append(("end", game_id, time.time(), result))
+
+    def write(self, lines: list[str]) -> None:
+        if not lines:
+            return
+
+        data = memoryview("".join(lines).encode("utf-8"))
+        while data:
+            data = data[self.file.write(data):]
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+        self.records += len(lines)
+        self.batches += 1
+
+    def close(self) -> None:
+        super().close()
+        self.file.close()
+
+    def stats(self) -> dict[str, int]:
+        return {"records": self.records, "batches": self.batches, "queued": len(self.queue)}
+
+
+class GameRecord:
+
+    def __init__(self, game_id: str, room_id: str, fen: str, started: float) -> None:
+        self.game_id = game_id
+        self.room_id = room_id
+        self.fen = fen
+        self.started = started
+
+        self.moves: list[tuple[str, float]] = []  # (move, time)
+        self.result = "*"  # Until the end record
+        self.ended: float = None
+
+
+def read_games(path: str) -> Iterator[GameRecord]:  # In the order they ended, the unfinished ones last
+    games: dict[str, GameRecord] = {}
+
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # The torn last line of a server that died mid-write
+                continue
+
+            kind = entry["event"]
+            if kind == "start":
+                games[entry["game"]] = GameRecord(entry["game"], entry["room"], entry["fen"], entry["t"])
+                continue
+
+            record = games.get(entry["game"])
+            if record is None:
+                continue
+
+            if kind == "move":
+                record.moves.append((entry["move"], entry["t"]))
+            elif kind == "end":
+                record.result = entry["result"]
+                record.ended = entry["t"]
+                yield games.pop(record.game_id)
+
+    yield from games.values()
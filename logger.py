@@ -0,0 +1,112 @@
+"""Structured logging for the server, one JSON object per line on stdout.
+
+Logging a record checks its level and queues the event name with its fields,
+nothing is formatted on the caller's side. A writer thread turns whatever is
+queued into JSON lines and writes them with one call, so a pipe that backs up
+stalls that thread and never the event loop. Under pressure the queue sheds
+load: past HIGH_WATER records only one in SAMPLE debug and info records is
+kept, at MAX_QUEUE every new record is dropped. Dropped records are counted,
+and the writer reports them in a "dropped" record of its own. The queue and
+the thread are writer.py's.
+"""
+
+import json, os, sys, time
+
+from writer import Writer
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+
+def encode(record: tuple) -> str:  # Log line of a queued (time, level, event, fields) record
+    t, level, event, fields = record
+    entry = {"t": round(t, 3), "level": LEVEL_NAMES[level], "event": event}
+    entry.update(fields)
+    return json.dumps(entry, separators=(",", ":"), default=str) + "\n"  # Exceptions and the like as their str
+
+
+class Logger(Writer):
+
+    NAME = "logger"
+    MAX_QUEUE = 10000  # Records queued at most, the writer being behind
+    HIGH_WATER = 5000  # Queued records from which debug and info records are sampled
+    SAMPLE = 10  # One in SAMPLE debug and info records is kept past HIGH_WATER
+    CLOSE_TIMEOUT = 2  # Seconds close waits for the writer to get rid of the backlog
+
+    encode = staticmethod(encode)
+
+    def __init__(self, level: int = INFO, stream=None) -> None:
+        super().__init__()
+        self.level = level  # Records below it are ignored
+        self.stream = stream  # sys.stdout as of each write by default, so redirecting it works
+
+        self.written = 0
+        self.dropped = 0  # Records shed under pressure or lost to a failing stream so far
+        self.reported = 0  # dropped as of the last "dropped" record
+        self.sampled = 0  # Debug and info records seen past HIGH_WATER
+
+        os.register_at_fork(after_in_child=self.forked)
+
+    def debug(self, event: str, **fields) -> None:
+        if DEBUG >= self.level:
+            self.log(DEBUG, event, fields)
+
+    def info(self, event: str, **fields) -> None:
+        if INFO >= self.level:
+            self.log(INFO, event, fields)
+
+    def warning(self, event: str, **fields) -> None:
+        if WARNING >= self.level:
+            self.log(WARNING, event, fields)
+
+    def error(self, event: str, **fields) -> None:
+        if ERROR >= self.level:
+            self.log(ERROR, event, fields)
+
+    def log(self, level: int, event: str, fields: dict) -> None:  # Fields must not change once logged, they are encoded later
+        queue = self.queue
+
+        if len(queue) >= self.HIGH_WATER:
+            if len(queue) >= self.MAX_QUEUE:
+                self.dropped += 1
+                return
+            if level < WARNING:
+                self.sampled += 1
+                if self.sampled % self.SAMPLE:
+                    self.dropped += 1
+                    return
+
+        self.append((time.time(), level, event, fields))
+
+    def write(self, lines: list[str]) -> None:
+        if self.dropped != self.reported:
+            lines.append(encode((time.time(), WARNING, "dropped", {"records": self.dropped - self.reported, "total": self.dropped})))
+            self.reported = self.dropped
+
+        if not lines:
+            return
+
+        stream = self.stream or sys.stdout
+        try:
+            stream.write("".join(lines))
+            stream.flush()
+        except (OSError, ValueError):  # A closed pipe or file, there is nowhere to report it
+            self.dropped += len(lines)
+            self.reported = self.dropped
+            return
+
+        self.written += len(lines)
+
+    def close(self) -> None:
+        super().close(self.CLOSE_TIMEOUT)
+
+    def stats(self) -> dict[str, int]:
+        return {"written": self.written, "dropped": self.dropped, "queued": len(self.queue)}
+
+
+LOGGER = Logger()
@@ -0,0 +1,196 @@
+"""Server metrics in the Prometheus text format.
+
+The event loop records into a Metrics: a histogram observation is a bisect
+and two additions, a counter an addition, so recording stays on under load.
+Gauges that would cost a pass over every connection (connections by role,
+queued output) are sampled by the server every SAMPLE_INTERVAL instead, and
+so is the count of log records dropped by logger.py.
+
+MetricsServer answers GET requests with render() from a thread of its own,
+on a local port or a Unix socket, so scrapes never wait on the event loop.
+Being local, it also takes the admin request that starts a profiling
+session, POST /profile?mode=cprofile|sample|trace&seconds=N (see profiler.py).
+The thread only copies what the loop writes, a scrape may see an observation
+in a bucket before it shows up in the sum.
+"""
+
+import http.server, os, socketserver, threading
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs
+
+from logger import LOGGER
+from profiler import PROFILER
+
+PHASES = ("make_move", "legal_moves", "save_board_pos", "broadcast")  # Steps of handling a move, see Game.on_move
+ROLES = ("white", "black", "spectator", "pending")
+RESULTS = ("1-0", "0-1", "1/2-1/2")
+
+PHASE_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1)
+LOOP_BUCKETS = (5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds  # Upper bounds of the buckets, the +Inf one is implied
+        self.counts = [0] * (len(bounds) + 1)  # Per bucket, not cumulative
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def lines(self, name: str, labels: str = "") -> list[str]:  # Exposition of the histogram, labels as 'key="value",'
+        counts = self.counts.copy()
+        total = 0
+        out = []
+        for le, count in zip([repr(bound) for bound in self.bounds] + ["+Inf"], counts):
+            total += count  # Buckets are cumulative in the exposition
+            out.append(f'{name}_bucket{{{labels}le="{le}"}} {total}')
+        labels = "{" + labels.rstrip(",") + "}" if labels else ""
+        out.append(f"{name}_sum{labels} {self.sum!r}")
+        out.append(f"{name}_count{labels} {total}")
+        return out
+
+
+class Metrics:
+
+    SAMPLE_INTERVAL = 1.0  # Seconds between samples of the gauges, see Server.sample
+
+    def __init__(self) -> None:
+        self.phases = {phase: Histogram(PHASE_BUCKETS) for phase in PHASES}
+        self.loop = Histogram(LOOP_BUCKETS)
+
+        self.games_started = 0
+        self.games_ended = dict.fromkeys(RESULTS, 0)
+
+        self.connections = dict.fromkeys(ROLES, 0)  # Gauges, replaced as a whole by each sample
+        self.queued_bytes = 0
+        self.log_dropped = 0
+
+    def started(self) -> None:
+        self.games_started += 1
+
+    def ended(self, result: str) -> None:
+        self.games_ended[result] = self.games_ended.get(result, 0) + 1
+
+    def sample(self, connections: dict[str, int], queued_bytes: int, log_dropped: int) -> None:
+        self.connections = connections
+        self.queued_bytes = queued_bytes
+        self.log_dropped = log_dropped
+
+    def render(self) -> str:
+        out = [
+            "# HELP chess_move_phase_seconds Time spent in each step of handling a move. legal_moves is missing for moves analyzed by workers",
+            "# TYPE chess_move_phase_seconds histogram",
+        ]
+        for phase, histogram in self.phases.items():
+            out += histogram.lines("chess_move_phase_seconds", f'phase="{phase}",')
+
+        out += [
+            "# HELP chess_loop_iteration_seconds Time the event loop spent on one iteration without waiting, on one client message with --asyncio",
+            "# TYPE chess_loop_iteration_seconds histogram",
+        ] + self.loop.lines("chess_loop_iteration_seconds")
+
+        out += [
+            "# HELP chess_connections Open connections by role, pending ones have not picked a role yet",
+            "# TYPE chess_connections gauge",
+        ] + [f'chess_connections{{role="{role}"}} {count}' for role, count in self.connections.items()]
+
+        out += [
+            "# HELP chess_send_queue_bytes Output queued for clients but not sent yet",
+            "# TYPE chess_send_queue_bytes gauge",
+            f"chess_send_queue_bytes {self.queued_bytes}",
+            "# HELP chess_games_started_total Games whose both players joined",
+            "# TYPE chess_games_started_total counter",
+            f"chess_games_started_total {self.games_started}",
+            "# HELP chess_log_dropped_total Log records dropped because the log writer fell behind",
+            "# TYPE chess_log_dropped_total counter",
+            f"chess_log_dropped_total {self.log_dropped}",
+            "# HELP chess_games_ended_total Games over by result",
+            "# TYPE chess_games_ended_total counter",
+        ] + [f'chess_games_ended_total{{result="{result}"}} {count}' for result, count in self.games_ended.copy().items()]
+
+        return "\n".join(out) + "\n"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    timeout = 5  # Seconds a scraper gets to send its request, one at a time is served
+
+    def do_GET(self) -> None:
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/profile":
+            self.reply(404, "Not found")
+            return
+
+        query = parse_qs(url.query)
+        try:
+            path = PROFILER.request(query.get("mode", ["cprofile"])[0], float(query.get("seconds", [PROFILER.SECONDS])[0]))
+        except ValueError as err:
+            self.reply(400, str(err))
+        except RuntimeError as err:
+            self.reply(409, str(err))
+        else:
+            self.reply(202, path)
+
+    def reply(self, status: int, text: str) -> None:
+        body = (text + "\n").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:  # Scrapes would drown the server's own output
+        pass
+
+
+class _TCPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+class MetricsServer:
+    """Serves a Metrics over HTTP on 127.0.0.1:<port>, or on a Unix socket when address isn't a port number."""
+
+    def __init__(self, metrics: Metrics, address: str) -> None:
+        if address.isdigit():
+            self.server = _TCPServer(("127.0.0.1", int(address)), _Handler)
+            where = f"port {self.server.server_address[1]}"
+        else:
+            if os.path.exists(address):  # Left behind by an earlier run
+                os.unlink(address)
+            self.server = socketserver.UnixStreamServer(address, _Handler)
+            where = address
+
+        self.server.metrics = metrics
+        self.address = address
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+        LOGGER.info("metrics_listening", address=where)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        if not self.address.isdigit():
+            os.unlink(self.address)
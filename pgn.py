@@ -0,0 +1,111 @@
+"""PGN export of the games in a game log (see gamelog.py).
+
+Usage: python pgn.py <log> [pgn]
+Writes to stdout without a second argument. Unfinished games get the result "*".
+"""
+
+import argparse, sys, time
+
+from server import Game, MoveCache, Piece, PAWN, KING, FEN_CHARS
+from gamelog import GameRecord, read_games
+
+
+def side_has_moves(game: Game) -> bool:  # Whether the side to move has a legal move
+    for r, f in game.occupied_squares():
+        if game.get_piece(r, f).value >> 3 == game.turn and game.legal_moves(r, f):
+            return True
+    return False
+
+
+def play_san(game: Game, move: str) -> str:  # Makes a logged move, returns it in standard algebraic notation
+    src = game.decode_alg(move[:2])
+    dst = game.decode_alg(move[2:4])
+    piece = game.get_piece(*src)
+    kind = piece.value & 7
+
+    if kind == KING and abs(dst[1] - src[1]) == 2:
+        san = "O-O" if dst[1] > src[1] else "O-O-O"
+
+    else:
+        capture = game.get_piece(*dst) is not Piece.NONE or (kind == PAWN and dst == game.en_passant_tgt)
+
+        if kind == PAWN:
+            san = (move[0] + "x" if capture else "") + move[2:]
+
+        else:
+            rivals = [sq for sq in game.occupied_squares()
+                      if sq != src and game.get_piece(*sq) is piece and dst in game.legal_moves(*sq)]  # Same kind, also reaching dst
+            if not rivals:
+                origin = ""
+            elif all(f != src[1] for _, f in rivals):
+                origin = move[0]
+            elif all(r != src[0] for r, _ in rivals):
+                origin = move[1]
+            else:
+                origin = move[:2]
+            san = FEN_CHARS[kind] + origin + ("x" if capture else "") + move[2:4]
+
+    game.make_move(None, move)
+    game.update_moves()
+
+    if game.is_in_check(game.turn):
+        san += "+" if side_has_moves(game) else "#"
+    return san
+
+
+def export(record: GameRecord) -> str:
+    game = Game(move_cache=MoveCache(64))
+    game.start(record.fen)
+
+    tags = [
+        ("Event", f"Room {record.room_id}"),
+        ("Site", "?"),
+        ("Date", time.strftime("%Y.%m.%d", time.gmtime(record.started))),
+        ("Round", "-"),
+        ("White", "?"),
+        ("Black", "?"),
+        ("Result", record.result),
+        ("UTCTime", time.strftime("%H:%M:%S", time.gmtime(record.started))),
+        ("GameId", record.game_id),
+    ]
+    if record.fen != Game.START_POS:
+        tags += [("SetUp", "1"), ("FEN", record.fen)]
+
+    tokens = []
+    for i, (move, _) in enumerate(record.moves):
+        if game.turn == Game.WHITE_TURN:
+            tokens.append(f"{game.move}.")
+        elif i == 0:
+            tokens.append(f"{game.move}...")
+
+        try:
+            tokens.append(play_san(game, move))
+        except Exception as err:
+            raise ValueError(f"Game {record.game_id}: cannot replay {move}", err)
+    tokens.append(record.result)
+
+    lines = [f'[{name} "{value}"]' for name, value in tags] + [""]
+    line = ""
+    for token in tokens:  # Movetext lines stay under 80 characters
+        if line and len(line) + 1 + len(token) >= 80:
+            lines.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    lines.append(line)
+
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a game log as PGN")
+    parser.add_argument("log")
+    parser.add_argument("pgn", nargs="?", help="output file, stdout by default")
+    args = parser.parse_args()
+
+    out = open(args.pgn, "w") if args.pgn else sys.stdout
+    with out:
+        for i, record in enumerate(read_games(args.log)):
+            if i:
+                out.write("\n")
+            out.write(export(record))
@@ -0,0 +1,137 @@
+"""Profiling sessions of a running server, started by a signal or an admin request.
+
+A session runs for a number of seconds and writes one file to the profiler's
+directory (--profile-dir):
+
+    cprofile  cProfile of the event loop thread, a pstats file (.prof)
+    sample    the loop thread's stack every SAMPLE_INTERVAL from a thread of
+              its own, as collapsed stacks for flame graphs (.folded)
+    trace     wall time of each step of handling a move, see Game.record,
+              as JSON lines (.jsonl)
+
+SIGUSR1 starts a cprofile session, or the one an admin request asked for,
+SIGUSR2 a trace session. The admin request is POST /profile?mode=&seconds=
+on the metrics endpoint (see metrics.py), which raises SIGUSR1 itself. The
+servers start and stop sessions on the event loop thread, cProfile only sees
+the thread that enabled it.
+"""
+
+import cProfile, json, os, signal, sys, threading, time
+
+from logger import LOGGER
+
+MODES = {"cprofile": ".prof", "sample": ".folded", "trace": ".jsonl"}  # File suffix of each mode
+SIGNALS = {signal.SIGUSR1: "cprofile", signal.SIGUSR2: "trace"}  # Mode each signal starts, SIGUSR1 that of an admin request first
+
+
+class Profiler:
+
+    SECONDS = 30  # Length of a session started by a plain signal
+    SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+
+    def __init__(self, directory: str = ".") -> None:
+        self.directory = directory
+        self.armed = False  # Whether a server handles the signals, until then requests are refused
+        self.requested: tuple[str, float, str] = None  # (mode, seconds, path) of the latest admin request
+
+        self.mode: str = None  # Of the running session
+        self.path: str = None
+        self.profile: cProfile.Profile = None
+
+        self.stacks: dict[str, int] = {}  # Samples by collapsed stack
+        self.sampler: threading.Thread = None
+        self.stopping = threading.Event()
+
+        self.tracing = False  # Checked by Game.record on every move
+        self.traces: list[tuple] = []  # (time, room, ply, phase, seconds)
+
+    def output(self, mode: str) -> str:
+        return os.path.join(self.directory, f"{mode}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}{MODES[mode]}")
+
+    def request(self, mode: str, seconds: float) -> str:  # Admin request from any thread, returns the file the session will write
+        if mode not in MODES or not 0 < seconds <= 3600:
+            raise ValueError(f"Expected a mode of {', '.join(MODES)} and up to an hour")
+        if not self.armed:
+            raise RuntimeError("No server is running")
+        if self.mode is not None:
+            raise RuntimeError(f"A {self.mode} session is running until it writes {self.path}")
+
+        path = self.output(mode)
+        self.requested = (mode, seconds, path)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        return path
+
+    def take(self, signum: int) -> tuple[str, float, str]:  # (mode, seconds, path) of the session a signal starts
+        requested = self.requested
+        self.requested = None
+        if requested is not None and signum == signal.SIGUSR1:
+            return requested
+        mode = SIGNALS[signum]
+        return mode, self.SECONDS, self.output(mode)
+
+    def start(self, mode: str, seconds: float, path: str) -> bool:  # On the event loop thread, False if a session is running already
+        if self.mode is not None:
+            LOGGER.warning("profile_busy", mode=self.mode, path=self.path)
+            return False
+
+        self.mode = mode
+        self.path = path
+
+        if mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif mode == "sample":
+            self.stacks = {}
+            self.stopping.clear()
+            self.sampler = threading.Thread(target=self.sample, args=(threading.get_ident(),), name="sampler", daemon=True)
+            self.sampler.start()
+        else:
+            self.traces = []
+            self.tracing = True
+
+        LOGGER.info("profile_started", mode=mode, seconds=seconds, path=path)
+        return True
+
+    def stop(self) -> None:  # On the event loop thread, writes the session's file
+        mode = self.mode
+        if mode is None:  # Stopped by a shutdown already
+            return
+
+        if mode == "cprofile":
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            self.profile = None
+        elif mode == "sample":
+            self.stopping.set()
+            self.sampler.join()
+            self.sampler = None
+            with open(self.path, "w") as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+        else:
+            self.tracing = False
+            with open(self.path, "w") as file:
+                for t, room, ply, phase, seconds in self.traces:
+                    file.write(json.dumps({"t": round(t, 6), "room": room, "ply": ply, "phase": phase, "us": round(seconds * 1e6, 1)}) + "\n")
+            self.traces = []
+
+        LOGGER.info("profile_written", mode=mode, path=self.path)
+        self.mode = None
+        self.path = None
+
+    def trace(self, room: str, ply: int, phase: str, seconds: float) -> None:
+        self.traces.append((time.time(), room, ply, phase, seconds))
+
+    def sample(self, ident: int) -> None:  # Runs on the sampler thread until stop
+        stacks = self.stacks
+        while not self.stopping.wait(self.SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(ident)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack = ";".join(reversed(names))  # Outermost first
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+
+PROFILER = Profiler()
@@ -0,0 +1,229 @@
+"""Wire encodings of the messages exchanged between Game and its clients.
+
+Messages are text everywhere inside the server. The ASCII protocol sends that
+text prefixed with its length as three digits. The binary protocol is opt-in:
+a client appends " binary" to its role response (or to "join <room id>" in
+lobby mode) and from the following frame on both directions use varint length
+prefixes and compact payloads. The first byte of a payload is its tag; moves
+take two bytes, squares one, and the FEN is replaced by a packed snapshot
+unless the position is so sparse that the FEN is shorter. Anything without a
+compact form is sent as TEXT, so every message round trips. Payloads are
+MAX_FRAME bytes at most, anything longer or that doesn't parse is a
+FrameError.
+
+Squares are indexed as r * 8 + f with r = 0 being the 8th rank, like Game's
+board and bitboard.py.
+"""
+
+import re
+
+TEXT = 0x00
+INITOK = 0x01
+INITFAIL = 0x02
+NO = 0x03
+OK = 0x04  # | status, no payload
+MOVE = 0x08  # | status, 2-byte move
+SNAPSHOT = 0x0C
+END = 0x0D
+QUERY = 0x0E  # "moves <square>"
+MOVES = 0x0F  # "moves <square> <targets>"
+
+STATUS = ["", "+", "#", "-"]
+PROMOTIONS = ["", "=Q", "=R", "=B", "=N"]
+SCORES = ["0-0", "1-0", "0-1", "1/2-1/2"]
+PIECES = " PRNBQK  prnbqk "  # Indexed by piece code, as in server.Piece
+
+SQUARE_NAMES = [f"{'abcdefgh'[sq & 7]}{8 - (sq >> 3)}" for sq in range(64)]
+SQUARE_INDEX = {name: sq for sq, name in enumerate(SQUARE_NAMES)}
+CASTLING = "KQkq"
+MAX_FRAME = 1024  # Longest binary payload accepted, a TEXT one as long as an ASCII frame allows takes 1000
+
+
+class FrameError(ValueError):
+    """A client sent bytes that aren't a frame of its protocol, the connection is beyond repair."""
+
+
+def frame(msg: str) -> bytes:  # Length-prefixed wire form of a message
+    return f"{len(msg):03}{msg}".encode("ascii")
+
+
+def varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def read_varint(buf, pos: int, end: int) -> tuple[int, int] | None:  # (value, position after it), None if cut off
+    n = 0
+    shift = 0
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+    return None
+
+
+def binary_frame(msg: str) -> bytes:
+    payload = encode(msg)
+    return varint(len(payload)) + payload
+
+
+def next_frame(buf, start: int, end: int, binary: bool) -> tuple[str, int] | None:  # (message, end of its frame), None if incomplete
+    if binary:
+        header = read_varint(buf, start, min(end, start + 2))  # Two bytes cover MAX_FRAME
+        if header is None:
+            if end - start >= 2:
+                raise FrameError("Binary frame too long")
+            return None
+        length, start = header
+        if length > MAX_FRAME:
+            raise FrameError(f"Binary frame of {length} bytes, at most {MAX_FRAME} are accepted")
+        if end - start < length:
+            return None
+        try:
+            return decode(bytes(buf[start:start + length])), start + length
+        except (ValueError, IndexError, TypeError) as err:  # Unknown tag, cut off payload
+            raise FrameError(f"Malformed binary frame: {err}") from err
+
+    if end - start < 3:
+        return None
+    prefix = buf[start:start + 3]
+    if not prefix.isdigit():
+        raise FrameError(f"Malformed frame length {bytes(prefix)!r}")
+    msg_end = start + 3 + int(prefix)
+    if msg_end > end:
+        return None
+    try:
+        return buf[start + 3:msg_end].decode("ascii"), msg_end
+    except UnicodeDecodeError as err:
+        raise FrameError("Frame is not ASCII") from err
+
+
+def encode_move(move: str) -> bytes | None:  # "e7e8=Q" as from | to << 6 | promotion << 12
+    src = SQUARE_INDEX.get(move[:2])
+    dst = SQUARE_INDEX.get(move[2:4])
+    prom = move[4:]
+    if src is None or dst is None or prom not in PROMOTIONS:
+        return None
+    return (src | dst << 6 | PROMOTIONS.index(prom) << 12).to_bytes(2, "little")
+
+
+def decode_move(data: bytes) -> str:
+    n = int.from_bytes(data, "little")
+    return SQUARE_NAMES[n & 63] + SQUARE_NAMES[n >> 6 & 63] + PROMOTIONS[n >> 12]
+
+
+EXPAND = {ord(str(n)): "." * n for n in range(1, 9)}  # FEN placement to one character per square
+CODES = bytes(PIECES.find(chr(c)) if chr(c) in PIECES.strip() else 0xFF for c in range(256))  # Piece code of each character
+CODES = CODES[:ord(".")] + b"\0" + CODES[ord(".") + 1:]
+PAIRS = ["".join("." if code == 0 else PIECES[code] for code in (byte >> 4, byte & 15)) for byte in range(256)]
+EMPTY_RUNS = re.compile(r"\.+")
+
+
+def pack_fen(fen: str) -> bytes | None:  # 64 piece codes as nibbles, then flags, en passant and the clocks
+    fields = fen.split(" ")
+    if len(fields) != 6 or fields[1] not in ("w", "b"):
+        return None
+    placement, turn, castling, en_passant, caclock, move = fields
+
+    ranks = placement.translate(EXPAND)
+    if len(ranks) != 71 or ranks[8::9] != "///////":
+        return None
+    board = ranks.replace("/", "").encode("ascii").translate(CODES)
+    if 0xFF in board:
+        return None
+
+    flags = turn == "b"
+    if castling != "-":
+        if castling != "".join(c for c in CASTLING if c in castling):  # Only the canonical order round trips
+            return None
+        for c in castling:
+            flags |= 2 << CASTLING.index(c)
+
+    ep = 0xFF if en_passant == "-" else SQUARE_INDEX.get(en_passant)
+    if ep is None or not caclock.isdigit() or not move.isdigit() or str(int(caclock)) != caclock or str(int(move)) != move:
+        return None
+
+    packed = bytes(a << 4 | b for a, b in zip(board[::2], board[1::2]))
+    return packed + bytes((flags, ep)) + varint(int(caclock)) + varint(int(move))
+
+
+def unpack_fen(data: bytes) -> str:
+    board = "".join(PAIRS[byte] for byte in data[:32])
+    placement = "/".join(board[i:i + 8] for i in range(0, 64, 8))
+    placement = EMPTY_RUNS.sub(lambda run: str(len(run.group())), placement)
+
+    flags, ep = data[32], data[33]
+    castling = "".join(c for i, c in enumerate(CASTLING) if flags & 2 << i) or "-"
+    caclock, pos = read_varint(data, 34, len(data))
+    move, _ = read_varint(data, pos, len(data))
+
+    return f"{placement} {'b' if flags & 1 else 'w'} {castling} {'-' if ep == 0xFF else SQUARE_NAMES[ep]} {caclock} {move}"
+
+
+def encode(msg: str) -> bytes:  # Payload of msg in the binary protocol
+    if msg == "initok":
+        return bytes((INITOK,))
+    if msg == "initfail":
+        return bytes((INITFAIL,))
+    if msg == "no":
+        return bytes((NO,))
+
+    status = STATUS.index(msg[-1]) if msg and msg[-1] in "+#-" else 0
+    body = msg[:-1] if status else msg
+
+    if body == "ok":
+        return bytes((OK | status,))
+
+    if 4 <= len(body) <= 6 and (move := encode_move(body)) is not None:
+        return bytes((MOVE | status,)) + move
+
+    if msg.startswith("end ") and msg[4:] in SCORES:
+        return bytes((END, SCORES.index(msg[4:])))
+
+    if msg.startswith("moves ") and (sq := SQUARE_INDEX.get(msg[6:8])) is not None:
+        if len(msg) == 8:
+            return bytes((QUERY, sq))
+        targets = msg[9:]
+        if msg[8] == " " and len(targets) % 2 == 0:
+            squares = [SQUARE_INDEX.get(targets[i:i + 2]) for i in range(0, len(targets), 2)]
+            if None not in squares:
+                return bytes((MOVES, sq, *squares))
+
+    if "/" in msg and (snapshot := pack_fen(msg)) is not None and len(snapshot) < len(msg):
+        return bytes((SNAPSHOT,)) + snapshot
+
+    return bytes((TEXT,)) + msg.encode("ascii")
+
+
+def decode(payload: bytes) -> str:
+    tag = payload[0]
+
+    if tag == TEXT:
+        return payload[1:].decode("ascii")
+    if tag == INITOK:
+        return "initok"
+    if tag == INITFAIL:
+        return "initfail"
+    if tag == NO:
+        return "no"
+    if tag & ~3 == OK:
+        return "ok" + STATUS[tag & 3]
+    if tag & ~3 == MOVE:
+        return decode_move(payload[1:3]) + STATUS[tag & 3]
+    if tag == SNAPSHOT:
+        return unpack_fen(payload[1:])
+    if tag == END:
+        return "end " + SCORES[payload[1]]
+    if tag == QUERY:
+        return "moves " + SQUARE_NAMES[payload[1]]
+    if tag == MOVES:
+        return "moves " + SQUARE_NAMES[payload[1]] + " " + "".join(SQUARE_NAMES[sq] for sq in payload[2:])
+
+    raise ValueError(f"Unknown message tag {tag}")
@@ -1,79 +1,136 @@
-import socket, sys, select
+import socket, selectors, heapq, argparse, asyncio, signal, threading
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+import multiprocessing
 from enum import Enum
-import copy
-from collections import defaultdict
+from typing import Callable, Iterable
+from collections import OrderedDict, deque
+from itertools import islice
+from array import array
+from functools import lru_cache
+import random
+import re
 import time
 
+from bitboard import BitBoard, SQUARES, squares
+from protocol import FrameError, frame, binary_frame, next_frame
+from gamelog import GameLog
+from metrics import Metrics, MetricsServer, ROLES
+from logger import LOGGER, LEVELS
+from profiler import PROFILER, SIGNALS
+
 class IncorrectMove(Exception):
     pass
 
 class Connection:
 
+    __slots__ = ("sock", "fd", "send_queue", "room", "binary", "reading", "events", "watch", "written", "mark")
+
+    SENDMSG_CHUNKS = 128  # Buffers handed to one sendmsg call, well under IOV_MAX
+
     def __init__(self, sock: socket.socket) -> None:
         self.sock = sock
         self.sock.setblocking(False)
+        self.fd = sock.fileno()
+
+        self.send_queue: deque[bytes | memoryview] = deque()  # Outgoing frames, the first one possibly a view of its unsent rest
 
-        self.send_queue: bytearray = bytearray()
+        self.room: Game = None
+        self.binary = False  # Whether it negotiated the binary protocol
+
+        self.reading = False  # Whether the server should read from it
+        self.events = 0  # Selector events it is registered for
+        self.watch = None  # Called when the send queue becomes empty or non-empty
+
+        self.written = 0  # Bytes sent so far
+        self.mark = -1  # written as of the last idle check that found output queued, see Server.evict
+
+    def encode(self, msg: str) -> bytes:
+        return binary_frame(msg) if self.binary else frame(msg)
 
     def queue_write(self, msg: str) -> None:
-        self.send_queue.extend(bytes(f"{str(len(msg)).rjust(3, '0')}{msg}", encoding="ascii"))
+        self.queue_frame(self.encode(msg))
+
+    def queue_frame(self, data: bytes) -> None:  # Queues an already framed message without copying it
+        empty = self.queue_empty
+        self.send_queue.append(data)
+
+        if empty and self.watch is not None:
+            self.watch(self)
 
     def write(self) -> None:
-        sent = self.sock.send(self.send_queue)
+        queue = self.send_queue
+
+        if len(queue) == 1 or not hasattr(self.sock, "sendmsg"):
+            sent = self.sock.send(queue[0])
+        else:
+            sent = self.sock.sendmsg(list(islice(queue, self.SENDMSG_CHUNKS)))
 
         if sent == 0:
             raise Exception("Socket closed unexpectedly")
 
-        self.send_queue = self.send_queue[sent:]
+        self.written += sent
+        while sent:
+            head = queue[0]
+            if sent < len(head):
+                queue[0] = memoryview(head)[sent:]
+                break
+            sent -= len(head)
+            queue.popleft()
 
-    def blocking_write(self, msg: str) -> None:
-        self.queue_write(msg)
-        while not self.queue_empty:
-            self.write()
+        if self.queue_empty and self.watch is not None:
+            self.watch(self)
 
     @property
     def queue_empty(self) -> bool:
-        return len(self.send_queue) == 0
+        return not self.send_queue
 
 
 class Player(Connection):
 
+    __slots__ = ("read_buf", "read_start", "read_end")
+
     def __init__(self, sock: socket.socket) -> None:
         super().__init__(sock)
 
-        self.read_buf = bytearray(1024)
-        self.read_prog = 0
-        self.msg_len = 0
+        self.read_buf = bytearray(4096)
+        self.read_start = 0  # Start of the first message not handled yet
+        self.read_end = 0  # End of the received data
 
-    def read(self) -> str | None:
-        prefix = False
+    def read(self) -> None:  # Receives whatever is available behind the buffered data
+        buf = self.read_buf
 
-        if self.read_prog == self.msg_len:
-            self.msg_len = 3
-            self.read_prog = 0
-            prefix = True
-        
-        view = memoryview(self.read_buf)
+        if self.read_end == len(buf):  # No room left behind the data, move the unhandled part to the front
+            rest = self.read_end - self.read_start
+            buf[:rest] = buf[self.read_start:self.read_end]
+            self.read_start = 0
+            self.read_end = rest
+            if rest == len(buf):
+                buf.extend(bytes(len(buf)))
 
-        bytes_read = self.sock.recv_into(view[self.read_prog:], min(self.msg_len - self.read_prog, 1024))
+        bytes_read = self.sock.recv_into(memoryview(buf)[self.read_end:])
 
         if bytes_read == 0:
             raise Exception("Socket closed unexpectedly")
 
-        self.read_prog += bytes_read
+        self.read_end += bytes_read
 
-        if self.read_prog == self.msg_len:
-            msg = self.read_buf.decode("ascii")[:self.msg_len]
-            if prefix:
-                self.msg_len = int(msg) + 3
-            else:
-                return msg[3:]
+    def next_message(self) -> str | None:  # Parsed lazily, so a protocol switch applies from the very next frame
+        found = next_frame(self.read_buf, self.read_start, self.read_end, self.binary)
+        if found is None:
+            return None
 
-        return None
+        msg, self.read_start = found
+        if self.read_start == self.read_end:
+            self.read_start = self.read_end = 0
+        return msg
+
+    @property
+    def buffered(self) -> bool:
+        return self.read_start != self.read_end
 
     def blocking_read(self) -> str:
-        while (msg := read) is None:
-            pass
+        while (msg := self.next_message()) is None:
+            self.read()
         return msg
 
 class Piece(Enum):
@@ -93,23 +150,149 @@ class Piece(Enum):
     QUEEN_B = 13
     KING_B = 14
 
+# Game's board holds Piece values as plain ints, Piece itself is only used at the API boundary (see Game.get_piece)
+EMPTY = Piece.NONE.value
+PAWN = Piece.PAWN_W.value
+ROOK = Piece.ROOK_W.value
+KNIGHT = Piece.KNIGHT_W.value
+BISHOP = Piece.BISHOP_W.value
+QUEEN = Piece.QUEEN_W.value
+KING = Piece.KING_W.value
+BLACK = 8  # Color bit of a value, piece >> 3 is WHITE_TURN/BLACK_TURN
+
+PIECES = {piece.value: piece for piece in Piece}
+PROMOTIONS = {"Q": QUEEN, "N": KNIGHT, "R": ROOK, "B": BISHOP}
+COLOR_NAMES = ("white", "black")  # Indexed by WHITE_TURN/BLACK_TURN, for the log
+
+def _build_steps(offsets: list[tuple[int, int]]) -> list[list[tuple[int, tuple[int, int]]]]:  # Per square, (index, (r, f)) of each square one offset away
+    table = []
+    for r, f in SQUARES:
+        table.append([((r + dr) * 8 + f + df, (r + dr, f + df)) for dr, df in offsets if 0 <= r + dr < 8 and 0 <= f + df < 8])
+    return table
+
+def _build_rays(dirs: list[tuple[int, int]]) -> list[list[list[tuple[int, tuple[int, int]]]]]:  # Per square and direction, (index, (r, f)) of the squares along it, nearest first
+    table = []
+    for r, f in SQUARES:
+        rays = []
+        for dr, df in dirs:
+            ray = []
+            nr, nf = r + dr, f + df
+            while 0 <= nr < 8 and 0 <= nf < 8:
+                ray.append((nr * 8 + nf, (nr, nf)))
+                nr += dr
+                nf += df
+            rays.append(ray)
+        table.append(rays)
+    return table
+
+# Move tables of the list backend, in the order get_possible_moves has always listed moves
+KNIGHT_STEPS = _build_steps([(-2, -1), (-2, 1), (-1, 2), (1, 2), (2, -1), (2, 1), (-1, -2), (1, -2)])
+KING_STEPS = _build_steps([(dr, df) for dr in (-1, 0, 1) for df in (-1, 0, 1) if (dr, df) != (0, 0)])
+PAWN_CAPTURES = [_build_steps([(-1, -1), (-1, 1)]), _build_steps([(1, -1), (1, 1)])]  # [white, black]
+ROOK_RAYS = _build_rays([(1, 0), (-1, 0), (0, 1), (0, -1)])
+BISHOP_RAYS = _build_rays([(-1, -1), (-1, 1), (1, -1), (1, 1)])
+
+FEN_CHARS = " PRNBQK  prnbqk"  # Indexed by Piece value
+FEN_SQUARES = FEN_CHARS.replace(" ", ".")  # The same, with a placeholder for empty squares
+FEN_EMPTY_RUNS = re.compile(r"\.+")
+FEN_CASTLING = "KQkq"  # In the order of Game.castle_pos
+
+@lru_cache(maxsize=4096)
+def fen_decode_rank(rank: str) -> bytes | None:  # Piece values of the 8 squares, None if it isn't exactly 8 squares
+    pieces = bytearray()
+    for c in rank:
+        if c in "12345678":
+            pieces.extend(bytes(int(c)))
+        elif c in FEN_CHARS and c != " ":
+            pieces.append(FEN_CHARS.index(c))
+        else:
+            return None
+
+    return bytes(pieces) if len(pieces) == 8 else None
+
+@lru_cache(maxsize=4096)
+def fen_encode_rank(rank: bytes) -> str:  # FEN of the piece values of a rank
+    squares = "".join([FEN_SQUARES[p] for p in rank])
+    return FEN_EMPTY_RUNS.sub(lambda run: str(len(run.group())), squares)
+
+ROOK_CORNERS = {(7, 7): 0, (7, 0): 1, (0, 7): 2, (0, 0): 3}  # Starting square of the rook of each castle_pos entry
+
+_zobrist = random.Random(0x63686573)
+
+ZOBRIST_PIECES = [[_zobrist.getrandbits(64) for _ in range(64)] for _ in range(15)]  # Indexed by Piece value, then r * 8 + f
+ZOBRIST_CASTLE = [_zobrist.getrandbits(64) for _ in range(4)]
+ZOBRIST_EN_PASSANT = [_zobrist.getrandbits(64) for _ in range(64)]
+ZOBRIST_BLACK_TURN = _zobrist.getrandbits(64)
+
+class MoveCache:
+    """Bounded LRU map from position hash to the legal move table of that position."""
+
+    def __init__(self, size: int = 4096) -> None:
+        self.size = size
+        self.entries: OrderedDict[int, dict[tuple[int, int], list[tuple[int, int]]]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: int) -> dict[tuple[int, int], list[tuple[int, int]]] | None:
+        moves = self.entries.get(key)
+
+        if moves is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return moves
+
+    def put(self, key: int, moves: dict[tuple[int, int], list[tuple[int, int]]]) -> None:
+        self.entries[key] = moves
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+MOVE_CACHE = MoveCache()
+
 class Game:
 
+    __slots__ = ("room_id", "bitboard", "bb", "hash", "move_cache", "white", "black", "write_to", "pending",
+                 "broadcasts", "frames_broadcast", "bytes_broadcast", "score", "move", "caclock", "en_passant_tgt",
+                 "castle_pos", "in_progress", "ended", "offload", "analyzing", "history", "kings", "stack",
+                 "fen", "fen_ranks", "snapshot_fen", "snapshots", "board", "turn", "moves", "log", "game_id",
+                 "occupancy", "material", "bishops_on", "clock", "clocks", "clock_start", "metrics")
+
     START_POS = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 
     WHITE_TURN = 0
     BLACK_TURN = 1
 
-    def __init__(self) -> None:
+    def __init__(self, bitboard: bool = False, move_cache: MoveCache = MOVE_CACHE, room_id: str = "0", log: GameLog = None,
+                 clock: tuple[float, float] = None, metrics: Metrics = None) -> None:
+
+        self.room_id = room_id
+        self.bitboard = bitboard
+        self.bb: BitBoard = None
+
+        self.hash = 0
+        self.move_cache = move_cache
 
         self.white: Player = None
         self.black: Player = None
 
-        self.write_to: list[Connection] = []
+        self.write_to: dict[Connection, None] = {}  # Used as an ordered set
+        self.pending: dict[Connection, None] = {}  # Greeted, waiting for the role response
 
-        self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.serversocket.setblocking(False)
+        self.broadcasts = 0
+        self.frames_broadcast = 0
+        self.bytes_broadcast = 0
+
+        self.score = "0-0"
 
         self.move = 1
         self.caclock = 0
@@ -120,461 +303,508 @@ class Game:
         self.in_progress = False
         self.ended = False
 
-        self.white_boards = defaultdict(int)
-        self.black_boards = defaultdict(int)
+        self.offload = False  # Leave update_moves and the end of game checks of each move to a worker, see analyze
+        self.analyzing: tuple[Player, str, str] = None  # (player, move, FEN before it) while a worker analyzes the position
 
-    def __enter__(self):
-        return self
+        self.history = array('Q')  # Position hashes saved by save_board_pos, see there
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.shutdown()
+        self.kings: list[tuple[int, int]] = [None, None]
+        self.occupancy = [0, 0]  # Square set (bit r * 8 + f) of each color's pieces, see occupied_squares
+        self.material = [0] * 15  # Number of pieces on the board by Piece value
+        self.bishops_on = [0, 0]  # Bishops of either color on light and on dark squares
+        self.stack: list[tuple] = []  # do_move history, consumed by undo_move
+
+        self.fen: str = None  # fen_encode of the current position, None once it changed
+        self.fen_ranks: list[str] = [None] * 8  # FEN of each rank, None once a piece on it changed
+
+        self.snapshot_fen: str = None  # The fen_encode string snapshots were built from
+        self.snapshots: list[bytes] = [None, None]  # By protocol, see snapshot
+
+        self.log = log
+        self.game_id: str = None  # Id of the game in log, once it started
+
+        self.clock = clock  # (seconds per player, increment per move), None for untimed games
+        self.clocks = [0.0, 0.0]  # Seconds each color had left when its clock last stopped
+        self.clock_start: float = None  # time.monotonic() the clock of the side to move started at, once the game started
+
+        self.metrics = metrics
 
     def fen_decode(self, FEN: str) -> None:
+        fields = FEN.split(" ")
+        if len(fields) != 6:
+            raise Exception("Incorrect FEN string", FEN)
 
-        self.board: list[list[Piece]] = []
-
-        rank: list[Piece] = []
-        for i, p in enumerate(FEN):
-            at = i
-            match p:
-                case 'P':
-                    rank.append(Piece.PAWN_W)
-                case 'R':
-                    rank.append(Piece.ROOK_W)
-                case 'N':
-                    rank.append(Piece.KNIGHT_W)
-                case 'B':
-                    rank.append(Piece.BISHOP_W)
-                case 'Q':
-                    rank.append(Piece.QUEEN_W)
-                case 'K':
-                    rank.append(Piece.KING_W)
-
-                case 'p':
-                    rank.append(Piece.PAWN_B)
-                case 'r':
-                    rank.append(Piece.ROOK_B)
-                case 'n':
-                    rank.append(Piece.KNIGHT_B)
-                case 'b':
-                    rank.append(Piece.BISHOP_B)
-                case 'q':
-                    rank.append(Piece.QUEEN_B)
-                case 'k':
-                    rank.append(Piece.KING_B)
-
-                case '/':
-                    if len(rank) != 8:
-                        raise Exception("Incorrect FEN string", FEN)
-
-                    self.board.append(rank.copy())
-                    rank.clear()
-
-                case ' ':
-                    if len(rank) != 8:
-                        raise Exception("Incorrect FEN string", FEN)
-
-                    self.board.append(rank.copy())
-                    break
+        placement, turn, castling, en_passant, caclock, move = fields
 
-                case _:
-                    rank.extend([Piece.NONE for _ in range(int(p))])
+        ranks = [fen_decode_rank(rank) for rank in placement.split("/")]
+        if len(ranks) != 8 or None in ranks:
+            raise Exception("Incorrect FEN string", FEN)
 
-        i += 1
+        if turn not in ("w", "b") or not caclock.isdigit() or not move.isdigit():
+            raise Exception("Incorrect FEN string", FEN)
 
-        if FEN[i] == 'w':
-            self.turn = self.WHITE_TURN
-        elif FEN[i] == 'b':
-            self.turn == self.BLACK_TURN
-        else:
+        if castling != "-" and (not castling or len(set(castling)) != len(castling) or not set(castling) <= set(FEN_CASTLING)):
             raise Exception("Incorrect FEN string", FEN)
-        
-        i += 9
 
-        next_space = FEN.find(" ", i)
-        self.caclock = int(FEN[i:next_space])
+        try:
+            self.en_passant_tgt = None if en_passant == "-" else self.decode_alg(en_passant)
+        except IncorrectMove:
+            raise Exception("Incorrect FEN string", FEN)
 
-        i = next_space + 1
+        self.board = bytearray(b"".join(ranks))  # Piece values, indexed by r * 8 + f
+        self.turn = self.WHITE_TURN if turn == "w" else self.BLACK_TURN
+        self.castle_pos = [c in castling for c in FEN_CASTLING]
+        self.caclock = int(caclock)
+        self.move = int(move)
 
-        self.move = int(FEN[i:])
-            
+        self.fen = None
+        self.fen_ranks = [None] * 8
 
-    def fen_encode(self) -> str:
+        self.stack.clear()
+        del self.history[:]
+        for color in (self.WHITE_TURN, self.BLACK_TURN):
+            sq = self.board.find(KING | color << 3)
+            self.kings[color] = None if sq < 0 else SQUARES[sq]
 
-        FEN = ""
+        if self.bitboard:
+            self.bb = BitBoard.from_board(self.board)
 
-        for rank in self.board:
-            no_len = 0
-            for piece in rank:
-                if piece == Piece.NONE:
-                    no_len += 1
-                    continue
-                
-                if no_len > 0:
-                    FEN += str(no_len)
-                    no_len = 0
-
-                match piece:
-                    case Piece.PAWN_W:
-                        FEN += 'P'
-                    case Piece.ROOK_W:
-                        FEN += 'R'
-                    case Piece.KNIGHT_W:
-                        FEN += 'N'
-                    case Piece.BISHOP_W:
-                        FEN += 'B'
-                    case Piece.QUEEN_W:
-                        FEN += 'Q'
-                    case Piece.KING_W:
-                        FEN += 'K'
-
-                    case Piece.PAWN_B:
-                        FEN += 'p'
-                    case Piece.ROOK_B:
-                        FEN += 'r'
-                    case Piece.KNIGHT_B:
-                        FEN += 'n'
-                    case Piece.BISHOP_B:
-                        FEN += 'b'
-                    case Piece.QUEEN_B:
-                        FEN += 'q'
-                    case Piece.KING_B:
-                        FEN += 'k'
-
-            if no_len > 0:
-                FEN += str(no_len)
-                no_len = 0
-            if rank != self.board[-1]:
-                FEN += '/'
-
-        FEN += ' '
-        FEN += 'w' if self.turn == self.WHITE_TURN else 'b'
-        FEN += ' '
-
-        if self.castle_pos[0]:
-            FEN += 'K' 
-        if self.castle_pos[1]:
-            FEN += 'Q'
-        if self.castle_pos[2]:
-            FEN += 'k'
-        if self.castle_pos[3]:
-            FEN += 'q'
-        if not self.castle_pos[0] and not self.castle_pos[1] and not self.castle_pos[2] and not self.castle_pos[3]:
-            FEN += '-'
-        FEN += ' '
-        FEN += '-' if self.en_passant_tgt == None else self.encode_alg(self.en_passant_tgt[0], self.en_passant_tgt[1])
-        FEN += ' '
-        FEN += str(self.caclock)
-        FEN += ' '
-        FEN += str(self.move)
-
-        return FEN
+        self.occupancy = [0, 0]
+        self.material = [0] * 15
+        self.bishops_on = [0, 0]
+        for sq, piece in enumerate(self.board):
+            if piece != EMPTY:
+                self.occupancy[piece >> 3] |= 1 << sq
+                self.material[piece] += 1
+                if piece & 7 == BISHOP:
+                    self.bishops_on[((sq >> 3) + (sq & 7)) & 1] += 1
+
+        self.hash = self.compute_hash()
+
+    def fen_encode(self) -> str:  # Cached until the position changes, per rank until a piece on it moves
+        if self.fen is not None:
+            return self.fen
+
+        for r, rank in enumerate(self.fen_ranks):
+            if rank is None:
+                self.fen_ranks[r] = fen_encode_rank(bytes(self.board[r * 8:r * 8 + 8]))
+
+        castling = "".join([c for c, allowed in zip(FEN_CASTLING, self.castle_pos) if allowed]) or "-"
+        en_passant = "-" if self.en_passant_tgt is None else self.encode_alg(*self.en_passant_tgt)
+
+        self.fen = f"{'/'.join(self.fen_ranks)} {'w' if self.turn == self.WHITE_TURN else 'b'} {castling} {en_passant} {self.caclock} {self.move}"
+        return self.fen
+
+    def compute_hash(self) -> int:
+        h = self.state_hash()
+
+        for sq, piece in enumerate(self.board):
+            if piece != EMPTY:
+                h ^= ZOBRIST_PIECES[piece][sq]
+
+        return h
+
+    def state_hash(self) -> int:  # Hash of everything but the pieces
+        h = ZOBRIST_BLACK_TURN if self.turn == self.BLACK_TURN else 0
+
+        for i in range(4):
+            if self.castle_pos[i]:
+                h ^= ZOBRIST_CASTLE[i]
+
+        if self.en_passant_tgt is not None:
+            h ^= ZOBRIST_EN_PASSANT[self.en_passant_tgt[0] * 8 + self.en_passant_tgt[1]]
+
+        return h
 
     def get_piece(self, r: int, f: int) -> Piece | None:
         if r < 0 or r >= 8 or f < 0 or f >= 8:
             return None
         
-        return self.board[r][f]
-
-    def move_piece(self, orig_r: int, orig_f: int, tgt_r: int, tgt_f: int, prom: Piece = Piece.NONE) -> bool:  # Returns True if capture occured
+        return PIECES[self.board[r * 8 + f]]
+
+    def set_piece(self, r: int, f: int, piece: int) -> None:
+        sq = r * 8 + f
+        old = self.board[sq]
+        if old != EMPTY:
+            self.hash ^= ZOBRIST_PIECES[old][sq]
+            if self.bb is not None:
+                self.bb.remove(sq, old)
+
+            self.occupancy[old >> 3] &= ~(1 << sq)
+            self.material[old] -= 1
+            if old & 7 == BISHOP:
+                self.bishops_on[(r + f) & 1] -= 1
+
+        if piece != EMPTY:
+            self.hash ^= ZOBRIST_PIECES[piece][sq]
+            if self.bb is not None:
+                self.bb.put(sq, piece)
+
+            self.occupancy[piece >> 3] |= 1 << sq
+            self.material[piece] += 1
+            if piece & 7 == BISHOP:
+                self.bishops_on[(r + f) & 1] += 1
+            elif piece & 7 == KING:
+                self.kings[piece >> 3] = (r, f)
+
+        self.board[sq] = piece
+        self.fen = None
+        self.fen_ranks[r] = None
+
+    def move_piece(self, orig_r: int, orig_f: int, tgt_r: int, tgt_f: int, prom: int = EMPTY) -> bool:  # Returns True if capture occured
         captured = False
-        piece = self.get_piece(orig_r, orig_f)
 
-        if piece == None:
+        if orig_r < 0 or orig_r >= 8 or orig_f < 0 or orig_f >= 8:
             raise ValueError("Tried moving NULL piece")
 
-        if piece in [Piece.PAWN_W, Piece.PAWN_B] and (tgt_r, tgt_f) == self.en_passant_tgt:
-            if tgt_r == 5:
-                if self.board[4][tgt_f] != Piece.NONE:
-                    captured = True
-                self.board[4][tgt_f] = Piece.NONE
-            else:
-                if self.board[3][tgt_f] != Piece.NONE:
-                    captured = True
-                self.board[3][tgt_f] = Piece.NONE
+        piece = self.board[orig_r * 8 + orig_f]
+        kind = piece & 7
+
+        if kind == PAWN and (tgt_r, tgt_f) == self.en_passant_tgt:
+            cap_r = 4 if tgt_r == 5 else 3
+            if self.board[cap_r * 8 + tgt_f] != EMPTY:
+                captured = True
+            self.set_piece(cap_r, tgt_f, EMPTY)
 
-        if piece in [Piece.PAWN_W, Piece.PAWN_B]:
-            if tgt_r in [0, 7]:
-                piece = prom
+        if kind == PAWN and tgt_r in (0, 7):
+            piece = prom
 
-        if piece in [Piece.KING_W, Piece.KING_B]:
+        if kind == KING:
             if tgt_f - orig_f == 2:
-                self.board[orig_r][orig_f + 1] = Piece(Piece.ROOK_W.value | (piece.value & 8))
-                self.board[orig_r][7] = Piece.NONE
+                self.set_piece(orig_r, orig_f + 1, ROOK | (piece & BLACK))
+                self.set_piece(orig_r, 7, EMPTY)
             elif tgt_f - orig_f == -2:
-                self.board[orig_r][orig_f - 1] = Piece(Piece.ROOK_W.value | (piece.value & 8))
-                self.board[orig_r][0] = Piece.NONE
+                self.set_piece(orig_r, orig_f - 1, ROOK | (piece & BLACK))
+                self.set_piece(orig_r, 0, EMPTY)
 
-        if self.board[tgt_r][tgt_f] != Piece.NONE:
+        if self.board[tgt_r * 8 + tgt_f] != EMPTY:
             captured = True
-        self.board[tgt_r][tgt_f] = piece
-        self.board[orig_r][orig_f] = Piece.NONE
+        self.set_piece(tgt_r, tgt_f, piece)
+        self.set_piece(orig_r, orig_f, EMPTY)
         return captured
 
-    def check_check(self, move_dict = None) -> int:  # -1 = no check, 0 = white is checked, 1 = black is checked, 2 = both checked
-        if move_dict is None:
-            move_dict = self.moves
-
-        white_checked = False
-        black_checked = False
-        for moves in move_dict.values():
-            for r, f in moves:
-                piece = self.get_piece(r, f)
-
-                if piece == Piece.KING_W:
-                    white_checked = True
-                if piece == Piece.KING_B:
-                    black_checked = True
-                
-        if white_checked and black_checked:
-            return 2
-        if black_checked:
-            return 1
-        if white_checked:
-            return 0
-        return -1
+    def do_move(self, src_r: int, src_f: int, dst_r: int, dst_f: int, prom: int = EMPTY) -> bool:  # Returns True if capture occured, prom is a Piece value
+        piece = self.board[src_r * 8 + src_f]
+        kind = piece & 7
 
-    def has_moves(self, not_player: Player) -> bool:
-        color = int(not_player == self.white) << 3
-        for r, f in self.moves.keys():
-            if len(self.moves[(r, f)]) == 0:
-                continue
-            piece = self.get_piece(r, f)
+        cap_r = dst_r
+        if kind == PAWN and (dst_r, dst_f) == self.en_passant_tgt:
+            cap_r = 4 if dst_r == 5 else 3
 
-            if (piece.value & 8) == color:
-                return True
+        rook = None
+        if kind == KING and abs(dst_f - src_f) == 2:
+            rook = self.board[src_r * 8 + (7 if dst_f > src_f else 0)]
 
-        return False
+        self.stack.append((src_r, src_f, dst_r, dst_f, piece, self.board[cap_r * 8 + dst_f], cap_r, rook,
+                           self.castle_pos.copy(), self.en_passant_tgt, self.caclock, self.move, self.hash,
+                           self.fen, self.fen_ranks[src_r], self.fen_ranks[dst_r]))  # The ranks a move changes, en passant and castling included
 
-    def will_check(self, src_r: int, src_f: int, dst_r: int, dst_f: int) -> int:  # -1 = no check, 0 = white will be checked, 1 = black will be checked, 2 = both will be checked
-        origboard = copy.deepcopy(self.board)
-         
-        self.move_piece(src_r, src_f, dst_r, dst_f)
+        self.hash ^= self.state_hash()
 
-        moves = self.get_all_moves()
-        check = self.check_check(moves)
+        next_en_passant = None
 
-        self.board = origboard   
-        return check
+        if kind == PAWN and abs(dst_r - src_r) == 2:
+            next_en_passant = ((dst_r + src_r) // 2, src_f)
 
-    def get_possible_moves(self, r: int, f: int) -> list[tuple[int, int]]:
-        piece = self.board[r][f]
+        elif kind == KING:
+            self.castle_pos[(piece >> 3) * 2] = False
+            self.castle_pos[(piece >> 3) * 2 + 1] = False
 
-        moves: list[tuple[int, int]] = []
+        for corner in ((src_r, src_f), (dst_r, dst_f)):  # A rook leaving its corner or being captured there
+            if corner in ROOK_CORNERS:
+                self.castle_pos[ROOK_CORNERS[corner]] = False
 
-        if piece == Piece.NONE:
-            return []
+        captured = self.move_piece(src_r, src_f, dst_r, dst_f, prom)
 
-        elif piece == Piece.PAWN_W:
-            if self.get_piece(r - 1, f) == Piece.NONE:
-                moves.append((r - 1, f))
-                if r == 6:
-                    if self.get_piece(r - 2, f) == Piece.NONE:
-                        moves.append((r - 2, f))
-
-            nr = r - 1
-            nf = f - 1
-            np = self.get_piece(nr, nf)
-            if (np not in [None, Piece.NONE] and (np.value & 8 != piece.value & 8)) or (nr, nf) == self.en_passant_tgt:
-                moves.append((nr, nf))
+        self.caclock += 1
+        if captured or kind == PAWN:
+            self.caclock = 0
 
-            nr = r - 1
-            nf = f + 1
-            np = self.get_piece(nr, nf)
-            if (np not in [None, Piece.NONE] and (np.value & 8 != piece.value & 8)) or (nr, nf) == self.en_passant_tgt:
-                moves.append((nr, nf))
+        self.en_passant_tgt = next_en_passant
 
-        elif piece == Piece.PAWN_B:
-            if self.get_piece(r + 1, f) == Piece.NONE:
-                moves.append((r + 1, f))
-                if r == 1:
-                    moves.append((r + 2, f))
+        if self.turn == self.BLACK_TURN:
+            self.move += 1
+        self.turn ^= 1
 
-            nr = r + 1
-            nf = f - 1
-            np = self.get_piece(nr, nf)
-            if (np not in [None, Piece.NONE] and (np.value & 8 != piece.value & 8)) or (nr, nf) == self.en_passant_tgt:
-                moves.append((nr, nf))
+        self.hash ^= self.state_hash()
 
-            nr = r + 1
-            nf = f + 1
-            np = self.get_piece(nr, nf)
-            if (np not in [None, Piece.NONE] and (np.value & 8 != piece.value & 8)) or (nr, nf) == self.en_passant_tgt:
-                moves.append((nr, nf))
+        return captured
 
-        elif piece in [Piece.KNIGHT_W, Piece.KNIGHT_B]:
-            for (nr, nf) in [(r - 2, f - 1), (r - 2, f + 1), (r - 1, f + 2), (r + 1, f + 2), (r + 2, f - 1), (r + 2, f + 1), (r - 1, f - 2), (r + 1, f - 2)]:
-                np = self.get_piece(nr, nf)
-                if np != Piece.NONE and (np == None or (piece.value & 8 == np.value & 8)):
-                    continue
+    def undo_move(self) -> None:
+        src_r, src_f, dst_r, dst_f, piece, captured, cap_r, rook, castle_pos, en_passant_tgt, caclock, move, h, fen, src_rank, dst_rank = self.stack.pop()
 
-                moves.append((nr, nf))
+        self.set_piece(dst_r, dst_f, EMPTY)
+        self.set_piece(cap_r, dst_f, captured)
+        self.set_piece(src_r, src_f, piece)
 
-        elif piece in [Piece.KING_W, Piece.KING_B]:
-            for nr in [r - 1, r, r + 1]:
-                for nf in [f - 1, f, f + 1]:
-                    if (nr, nf) == (r, f):
-                        continue
+        if rook is not None:
+            if dst_f > src_f:
+                self.set_piece(src_r, src_f + 1, EMPTY)
+                self.set_piece(src_r, 7, rook)
+            else:
+                self.set_piece(src_r, src_f - 1, EMPTY)
+                self.set_piece(src_r, 0, rook)
+
+        self.castle_pos = castle_pos
+        self.en_passant_tgt = en_passant_tgt
+        self.caclock = caclock
+        self.move = move
+        self.turn ^= 1
+        self.hash = h
+        self.fen = fen  # Back to the position encoded before, so legality probes keep the FEN and the snapshots built from it
+        self.fen_ranks[src_r] = src_rank
+        self.fen_ranks[dst_r] = dst_rank
+
+    def scan_attackers(self, r: int, f: int, color: int):  # Yields the squares of color's pieces attacking (r, f), nearest kinds first
+        board = self.board
+        sq = r * 8 + f
+        c = color << 3
+
+        pawn = PAWN | c
+        for nsq, square in PAWN_CAPTURES[color ^ 1][sq]:  # Where a pawn of color captures (r, f) from
+            if board[nsq] == pawn:
+                yield square
+
+        knight = KNIGHT | c
+        for nsq, square in KNIGHT_STEPS[sq]:
+            if board[nsq] == knight:
+                yield square
+
+        king = KING | c
+        for nsq, square in KING_STEPS[sq]:
+            if board[nsq] == king:
+                yield square
+
+        queen = QUEEN | c
+        for slider, rays in ((ROOK | c, ROOK_RAYS[sq]), (BISHOP | c, BISHOP_RAYS[sq])):
+            for ray in rays:
+                for nsq, square in ray:
+                    np = board[nsq]
+                    if np != EMPTY:
+                        if np == slider or np == queen:
+                            yield square
+                        break
 
-                    np = self.get_piece(nr, nf)
+    def is_attacked(self, r: int, f: int, color: int) -> bool:  # Whether any piece of color (WHITE_TURN/BLACK_TURN) attacks the square, stops at the first one
+        if self.bb is not None:
+            return self.bb.is_attacked(r * 8 + f, color)
 
-                    if np != Piece.NONE and (np == None or (piece.value & 8 == np.value & 8)):
-                        continue
+        return next(self.scan_attackers(r, f, color), None) is not None
 
-                    moves.append((nr, nf))
+    def attackers_of(self, r: int, f: int, color: int) -> list[tuple[int, int]]:  # Squares of every piece of color attacking the square
+        if self.bb is not None:
+            return squares(self.bb.attackers(r * 8 + f, color))
 
-            if self.castle_pos[((piece.value & 8) >> 3) * 2 + 1] and self.get_piece(r, f - 4) in [Piece.ROOK_W, Piece.ROOK_B] and self.get_piece(r, f - 3) == Piece.NONE and self.get_piece(r, f - 2) == Piece.NONE and self.get_piece(r, f - 1) == Piece.NONE:
-                moves.append((r, f - 2))
+        return list(self.scan_attackers(r, f, color))
 
-            if self.castle_pos[((piece.value & 8) >> 3) * 2] and self.get_piece(r, f + 3) in [Piece.ROOK_W, Piece.ROOK_B] and self.get_piece(r, f + 2) == Piece.NONE and self.get_piece(r, f + 1) == Piece.NONE:
-                moves.append((r, f + 2))
+    def is_in_check(self, color: int) -> bool:
+        if self.kings[color] is None:
+            return False
 
-        if piece in [Piece.ROOK_W, Piece.ROOK_B, Piece.QUEEN_W, Piece.QUEEN_B]:
-            for nr in range(r + 1, 8):
-                np = self.get_piece(nr, f)
+        r, f = self.kings[color]
+        if self.board[r * 8 + f] != KING | (color << 3):  # King was captured by a pseudo-legal move
+            return False
 
-                if np not in [None, Piece.NONE] and (piece.value & 8 == np.value & 8):  # Same color
-                    break
+        return self.is_attacked(r, f, color ^ 1)
 
-                moves.append((nr, f))
+    def check_check(self) -> int:  # -1 = no check, 0 = white is checked, 1 = black is checked, 2 = both checked
+        white_checked = self.is_in_check(self.WHITE_TURN)
+        black_checked = self.is_in_check(self.BLACK_TURN)
 
-                if np != Piece.NONE:
-                    break
-            
-            for nr in range(r - 1, -1, -1):
-                np = self.get_piece(nr, f)
+        if white_checked and black_checked:
+            return 2
+        if black_checked:
+            return 1
+        if white_checked:
+            return 0
+        return -1
 
-                if np not in [None, Piece.NONE] and (piece.value & 8 == np.value & 8):  # Same color
-                    break
+    def has_moves(self, not_player: Player) -> bool:  # Whether the opponent of not_player can move, stops at the first legal move found
+        for r, f in self.occupied_squares(int(not_player == self.white)):
+            if self.legal_moves(r, f):
+                return True
 
-                moves.append((nr, f))
-                if np != Piece.NONE:
-                    break
+        return False
 
-            for nf in range(f + 1, 8):
-                np = self.get_piece(r, nf)
+    def get_possible_moves(self, r: int, f: int) -> list[tuple[int, int]]:
+        board = self.board
+        sq = r * 8 + f
+        piece = board[sq]
 
-                if np not in [None, Piece.NONE] and (piece.value & 8 == np.value & 8):  # Same color
-                    break
+        if piece == EMPTY:
+            return []
 
-                moves.append((r, nf))
-                if np != Piece.NONE:
-                    break
-            
-            for nf in range(f - 1, -1, -1):
-                np = self.get_piece(r, nf)
+        if self.bb is not None:
+            ep = None if self.en_passant_tgt is None else self.en_passant_tgt[0] * 8 + self.en_passant_tgt[1]
+            return squares(self.bb.pseudo_moves(sq, piece, self.castle_pos, ep))
 
-                if np not in [None, Piece.NONE] and (piece.value & 8 == np.value & 8):  # Same color
-                    break
+        color = piece & BLACK
+        kind = piece & 7
+        moves: list[tuple[int, int]] = []
 
-                moves.append((r, nf))
-                if np != Piece.NONE:
-                    break
+        if kind == PAWN:
+            dr = 1 if color else -1
+            nr = r + dr
+            if 0 <= nr < 8 and board[nr * 8 + f] == EMPTY:
+                moves.append((nr, f))
+                if r == (1 if color else 6) and board[(nr + dr) * 8 + f] == EMPTY:
+                    moves.append((nr + dr, f))
 
-        if piece in [Piece.BISHOP_W, Piece.BISHOP_B, Piece.QUEEN_W, Piece.QUEEN_B]:
-            for (ar, af) in [(-1, -1), (-1, 1), (1, -1), (1, 1)]:
-                nr = r + ar
-                nf = f + af
-                while True:
-                    np = self.get_piece(nr, nf)
-                    if np == None:
-                        break
+            ep = self.en_passant_tgt
+            if ep is not None and ep[0] != (5 if color else 2):
+                ep = None
 
-                    if np != Piece.NONE and (piece.value & 8 == np.value & 8):  # Same color
-                        break
+            for nsq, square in PAWN_CAPTURES[color >> 3][sq]:
+                np = board[nsq]
+                if (np != EMPTY and np & BLACK != color) or square == ep:
+                    moves.append(square)
 
-                    moves.append((nr, nf))
+        elif kind == KNIGHT or kind == KING:
+            for nsq, square in (KNIGHT_STEPS if kind == KNIGHT else KING_STEPS)[sq]:
+                np = board[nsq]
+                if np == EMPTY or np & BLACK != color:
+                    moves.append(square)
 
-                    if np != Piece.NONE:
-                        break
+            if kind == KING:
+                rook = ROOK | color
+                if self.castle_pos[(color >> 3) * 2 + 1] and f >= 4 and board[sq - 4] == rook and board[sq - 3] == EMPTY and board[sq - 2] == EMPTY and board[sq - 1] == EMPTY:
+                    moves.append((r, f - 2))
+
+                if self.castle_pos[(color >> 3) * 2] and f <= 4 and board[sq + 3] == rook and board[sq + 2] == EMPTY and board[sq + 1] == EMPTY:
+                    moves.append((r, f + 2))
+
+        else:
+            if kind == ROOK:
+                rays = ROOK_RAYS[sq]
+            elif kind == BISHOP:
+                rays = BISHOP_RAYS[sq]
+            else:
+                rays = ROOK_RAYS[sq] + BISHOP_RAYS[sq]
+
+            for ray in rays:
+                for nsq, square in ray:
+                    np = board[nsq]
+                    if np == EMPTY:
+                        moves.append(square)
+                        continue
+
+                    if np & BLACK != color:
+                        moves.append(square)
+                    break
 
-                    nr += ar
-                    nf += af
-        
         return moves
 
     def get_legal_moves(self, r: int, f: int) -> list[tuple[int, int]]:
-        moves = self.get_possible_moves(r, f)
-        p = self.get_piece(r, f)
+        p = self.board[r * 8 + f]
+        color = p >> 3
+        king = p & 7 == KING
+        prom = QUEEN | (p & BLACK) if p & 7 == PAWN else EMPTY
+
+        moves = []
+        for nr, nf in self.get_possible_moves(r, f):
+            if king and abs(nf - f) == 2:  # Can't castle out of or through check
+                if self.is_in_check(color) or self.is_attacked(r, (f + nf) // 2, color ^ 1):
+                    continue
 
-        remove: list[tuple[int, int]] = []
+            self.do_move(r, f, nr, nf, prom)
+            checked = self.is_in_check(color)  # Only the mover's king matters
+            self.undo_move()
 
-        for nr, nf in moves:
-            check = self.will_check(r, f, nr, nf)
-            if (check == -1 or check == 1 - ((p.value & 8) >> 3)) and p in [Piece.KING_W, Piece.KING_B]:  # Can't castle through check
-                if nf - f == 2:
-                    check = self.will_check(r, f, nr, f + 1)
-                elif nf - f == -2:
-                    check = self.will_check(r, f, nr, f - 1)
+            if not checked:
+                moves.append((nr, nf))
 
-            if check == 2 or check == ((p.value & 8) >> 3):  # Checked yourself
-                remove.append((nr, nf))
+        return moves
 
-            if p in [Piece.KING_W, Piece.KING_B] and abs(nf - f) == 2:
-                move_dict = self.get_all_moves()
-                check = self.check_check(move_dict)
-                if check == 2 or check == ((p.value & 8) >> 3): 
-                    remove.append((nr, nf))
+    def occupied_squares(self, color: int = None) -> list[tuple[int, int]]:  # Squares of color's pieces (WHITE_TURN/BLACK_TURN), of every piece by default
+        if color is None:
+            return squares(self.occupancy[0] | self.occupancy[1])
 
+        return squares(self.occupancy[color])
 
-        for move in remove:
-            try:
-                moves.remove(move)
-            except:
-                continue
+    def insufficient_material(self) -> bool:  # Whether neither side can ever mate: lone kings, a single minor piece, or only bishops all on one square color
+        m = self.material
+        if m[PAWN] or m[PAWN | BLACK] or m[ROOK] or m[ROOK | BLACK] or m[QUEEN] or m[QUEEN | BLACK]:
+            return False
 
-        return moves
+        knights = m[KNIGHT] + m[KNIGHT | BLACK]
+        if knights + m[BISHOP] + m[BISHOP | BLACK] <= 1:
+            return True
+
+        return knights == 0 and (self.bishops_on[0] == 0 or self.bishops_on[1] == 0)
 
     def get_all_moves(self) -> dict[tuple[int, int], list[tuple[int, int]]]:
-        moves = {}
+        return {(r, f): self.get_possible_moves(r, f) for r, f in self.occupied_squares()}
+
+    def get_all_legal_moves(self) -> dict[tuple[int, int], list[tuple[int, int]]]:
+        return {(r, f): self.get_legal_moves(r, f) for r, f in self.occupied_squares()}
+
+    def perft(self, depth: int) -> int:  # Leaf nodes of the legal move tree depth plies below the current position
+        if depth == 0:
+            return 1
 
-        for r in range(8):
-            for f in range(8):
-                piece = self.get_piece(r, f)
+        promotions = [kind | self.turn << 3 for kind in (QUEEN, ROOK, BISHOP, KNIGHT)]
 
-                if piece == Piece.NONE:
+        nodes = 0
+        for r, f in self.occupied_squares(self.turn):
+            piece = self.board[r * 8 + f]
+
+            for nr, nf in self.get_legal_moves(r, f):
+                promoting = piece & 7 == PAWN and nr in (0, 7)
+
+                if depth == 1:  # Leaves only need counting
+                    nodes += 4 if promoting else 1
                     continue
 
-                nm = self.get_possible_moves(r, f)
+                for prom in (promotions if promoting else [EMPTY]):
+                    self.do_move(r, f, nr, nf, prom)
+                    nodes += self.perft(depth - 1)
+                    self.undo_move()
+
+        return nodes
+
+    def update_moves(self) -> None:  # Points self.moves at the move table of the position, which legal_moves fills in square by square
+        moves = self.move_cache.get(self.hash)
 
-                moves[(r, f)] =  nm
+        if moves is None:
+            moves = {}
+            self.move_cache.put(self.hash, moves)
+
+        self.moves = moves
+
+    def legal_moves(self, r: int, f: int) -> list[tuple[int, int]]:  # get_legal_moves, generated once per position
+        moves = self.moves.get((r, f))
+
+        if moves is None:
+            if self.board[r * 8 + f] == EMPTY:
+                return []
+            moves = self.moves[(r, f)] = self.get_legal_moves(r, f)
 
         return moves
 
-    def get_all_legal_moves(self) -> dict[tuple[int, int], list[tuple[int, int]]]:
-        moves = {}
+    def all_legal_moves(self) -> dict[tuple[int, int], list[tuple[int, int]]]:  # The move table with every occupied square filled in
+        for r, f in self.occupied_squares():
+            self.legal_moves(r, f)
 
-        for r in range(8):
-            for f in range(8):
-                piece = self.get_piece(r, f)
+        return self.moves
 
-                if piece == Piece.NONE:
-                    continue
+    def save_board_pos(self, turn: int) -> bool:  # Saves the current position as reached by turn's move, returns True on threefold repetition
+        h = self.hash if turn != self.turn else self.hash ^ ZOBRIST_BLACK_TURN
 
-                nm = self.get_legal_moves(r, f)
+        if self.en_passant_tgt is not None:
+            ep_r, ep_f = self.en_passant_tgt
+            pawn = PAWN | (self.turn << 3)
+            r = 4 if ep_r == 5 else 3
+            for f in (ep_f - 1, ep_f + 1):
+                if 0 <= f < 8 and self.board[r * 8 + f] == pawn and self.en_passant_tgt in self.legal_moves(r, f):
+                    return False  # A position with an en passant capture available never repeats
 
-                moves[(r, f)] =  nm
+            h ^= ZOBRIST_EN_PASSANT[ep_r * 8 + ep_f]
 
-        return moves
+        self.history.append(h)
 
-    def save_board_pos(self, turn: int) -> bool:
-        if self.en_passant_tgt != None:
-            for orig_r, orig_f in self.moves.keys():
-                piece = self.get_piece(orig_r, orig_f)
-                if (piece == Piece.PAWN_W and turn == self.WHITE_TURN) or (piece == Piece.PAWN_B and turn == self.BLACK_TURN):
-                    continue
-                moves = self.moves[(orig_r, orig_f)]
-                for move in moves:
-                    if move == self.en_passant_tgt:
-                        return
-        
-        board_tuple = []
-        for row in self.board:
-            board_tuple.append(tuple(row))
-        board_tuple = tuple(board_tuple)
-        boards = self.white_boards if turn == self.WHITE_TURN else self.black_boards
-        boards[(board_tuple, tuple(self.castle_pos))] += 1   
-        return boards[(board_tuple, tuple(self.castle_pos))] >= 3
+        # Nothing before the last capture or pawn move can repeat. One extra entry covers the initial position being saved for both sides
+        start = max(0, len(self.history) - self.caclock - 2)
+        return self.history[start:].count(h) >= 3
 
     def make_move(self, player: Player, move: str) -> None:
         length = len(move)
@@ -584,76 +814,46 @@ class Game:
         src_r, src_f = self.decode_alg(move[:2])
         dst_r, dst_f = self.decode_alg(move[2:4])
 
-        if self.board[src_r][src_f] == Piece.NONE:
+        piece = self.board[src_r * 8 + src_f]
+
+        if piece == EMPTY:
             raise IncorrectMove("Cannot move a NULL piece", move)
 
-        if (self.board[src_r][src_f].value & 8) != self.turn << 3:
+        if (piece & BLACK) != self.turn << 3:
             raise IncorrectMove()
         
         self.score = "0-0"
-        moves = self.moves[(src_r, src_f)]
+        moves = self.legal_moves(src_r, src_f)
 
         if (dst_r, dst_f) not in moves:
             raise IncorrectMove()
 
-        next_en_passant = None
-
-        piece = self.get_piece(src_r, src_f)
+        prom = EMPTY
 
-        prom = Piece.NONE
-
-        if piece in [Piece.PAWN_W, Piece.PAWN_B] and dst_r in [0, 7] and length != 6:
+        if piece & 7 == PAWN and dst_r in [0, 7] and length != 6:
             raise IncorrectMove()
 
         if length >= 6:
-            if piece not in [Piece.PAWN_W, Piece.PAWN_B]:
+            if piece & 7 != PAWN:
                 raise IncorrectMove()
             if move[4] != '=':
                 raise IncorrectMove()
-            
-            match move[5]:
-                case 'Q':
-                    prom = Piece.QUEEN_W
-                case 'N':
-                    prom = Piece.KNIGHT_W
-                case 'R':
-                    prom = Piece.ROOK_W
-                case 'B':
-                    prom = Piece.BISHOP_W
-                case _:
-                    raise IncorrectMove("Incorrect promotion target")
-            
-            prom = Piece(prom.value | (piece.value & 8))
-
-        if piece in [Piece.PAWN_W, Piece.PAWN_B] and abs(dst_r - src_r) == 2:
-            next_en_passant = (round((dst_r + src_r)/2), src_f)
-
-        elif piece in [Piece.ROOK_W, Piece.ROOK_B]:
-            if src_f == 0:
-                self.castle_pos[((piece.value & 8) >> 3) * 2 + 1] = False
-            elif src_f == 8:
-                self.castle_pos[((piece.value & 8) >> 3) * 2] = False
-
-        elif piece == Piece.KING_W:
-            self.castle_pos[0] = False
-            self.castle_pos[1] = False
-        
-        elif piece == Piece.KING_B:
-            self.castle_pos[2] = False
-            self.castle_pos[3] = False
 
-        captured = self.move_piece(src_r, src_f, dst_r, dst_f, prom)
+            if move[5] not in PROMOTIONS:
+                raise IncorrectMove("Incorrect promotion target")
 
-        if captured or piece in [Piece.PAWN_W, Piece.PAWN_B]:
-            self.caclock = 0
+            prom = PROMOTIONS[move[5]] | (piece & BLACK)
 
-        self.en_passant_tgt = next_en_passant
+        self.do_move(src_r, src_f, dst_r, dst_f, prom)
 
     @staticmethod
     def decode_alg(alg: str) -> tuple[int, int]:
         if len(alg) != 2:
             raise IncorrectMove("Incorrect length of algebraic position", alg)
 
+        if alg[1] not in "12345678":
+            raise IncorrectMove("Incorrect position", alg)
+
         file = ord(alg[0]) - ord('a')
         rank = 8 - int(alg[1])
 
@@ -673,341 +873,1305 @@ class Game:
         return f + r
 
 
-    def init_con(self, sock: socket.socket) -> Connection:
+    def start(self, pos: str = START_POS) -> None:
+        self.fen_decode(pos)
+
+        self.update_moves()
+        self.save_board_pos(self.turn)
+        self.save_board_pos(self.turn ^ 1)
+
+    def readers(self) -> list[Connection]:  # Connections the room is waiting on a message from
+        if self.ended:
+            return []
+
+        if self.analyzing is not None:  # The move table is out of date until the worker is done
+            return list(self.pending)
+
+        if self.in_progress:
+            return list(self.pending) + [self.white if self.turn == self.WHITE_TURN else self.black]
+
+        return list(self.pending) + [p for p in (self.white, self.black) if p is not None]
+
+    def greet(self, con: Connection) -> None:
+        if self.ended:
+            raise Exception("Game already ended")
+
+        if self.in_progress:
+            con.queue_frame(self.snapshot(con.binary))
+            self.write_to[con] = None
+            return
+
         msg = ""
-        
+
         if self.white is None:
             msg += "w"
-        
+
         if self.black is None:
             msg += "b"
 
         msg += "s"
 
-        self.blocking_write(sock, msg)
+        con.queue_write(msg)
+        self.pending[con] = None
 
-        resp = self.blocking_read(sock)
+    def visible_fen(self) -> str:  # FEN as the clients know it, a move being analyzed hasn't been broadcast yet
+        if self.analyzing is not None:
+            return self.analyzing[2]
+        return self.fen_encode()
+
+    def snapshot(self, binary: bool) -> bytes:  # Framed "s", FEN and "initok" for spectators joining mid-game, built once per position
+        fen = self.visible_fen()
+        if self.snapshot_fen is not fen:
+            self.snapshot_fen = fen
+            self.snapshots = [None, None]
+
+        data = self.snapshots[binary]
+        if data is None:
+            encode = binary_frame if binary else frame
+            data = self.snapshots[binary] = encode("s") + encode(fen) + encode("initok")
+        return data
+
+    def on_message(self, con: Connection, msg: str) -> None:
+        if con in self.pending:
+            self.on_handshake(con, msg)
+
+        elif self.in_progress and con == (self.white if self.turn == self.WHITE_TURN else self.black):
+            self.on_move(con, msg)
+
+        # Anything else, like a player talking before the game started, is ignored
+
+    def on_handshake(self, con: Connection, resp: str) -> None:
+        del self.pending[con]
+
+        if resp.endswith(" binary"):
+            resp = resp[:-7]
+            con.binary = True
 
         if len(resp) != 1:
             raise Exception("Incorrect response")
 
         if resp == "w":
-            if self.white is not None:
+            if self.white is not None or self.in_progress:
                 raise Exception("Incorrect response")
-            
-            con = Player(sock)
+
             self.white = con
-            self.write_to.append(con)
 
         elif resp == "b":
-            if self.black is not None:
+            if self.black is not None or self.in_progress:
                 raise Exception("Incorrect response")
-            
-            con = Player(sock)
+
             self.black = con
-            self.write_to.append(con)
 
-        elif resp == "s":
-            con = Connection(sock)
-            self.write_to.append(con)
+        elif resp != "s":
+            raise Exception("Incorrect response")
+
+        self.write_to[con] = None
 
-        self.blocking_write(sock, self.fen_encode())
+        con.queue_write(self.visible_fen())
+        con.queue_write("initok")
 
-        self.blocking_write(sock, "initok")
+        if self.white is not None and self.black is not None and not self.ended:
+            self.in_progress = True
+            if self.log is not None:
+                self.game_id = self.log.start(self.room_id, self.fen_encode())
+            if self.metrics is not None:
+                self.metrics.started()
+            if self.clock is not None:
+                self.clocks = [float(self.clock[0])] * 2
+                self.clock_start = time.monotonic()
 
-        return con
+    def on_move(self, player: Player, msg: str) -> None:
+        LOGGER.debug("message", room=self.room_id, side=COLOR_NAMES[self.turn], msg=msg)
 
-    def shutdown(self) -> None:
-        print("Shutting down...")
+        if self.clock_start is not None and time.monotonic() >= self.deadline():  # Beat the flag timer to it
+            self.flag()
+            return
 
-        for con in self.write_to:
+        if msg.startswith("moves "):
             try:
-                con.blocking_write("end " + self.score)
-                print(f"Closing connection to {con.sock.getpeername()}")
-            except:
-                print(f"Closing connection")
-            con.sock.close()
+                (r, f) = self.decode_alg(msg[6:8])
+                moves = self.legal_moves(r, f)
+                resp = "moves " + msg[6:8] + " "
+                for move in moves:
+                    resp += self.encode_alg(move[0], move[1])
+                player.queue_write(resp)
+                LOGGER.debug("reply", room=self.room_id, reply=resp)
+                return
+            except IncorrectMove:
+                player.queue_write("no")
+                LOGGER.debug("reply", room=self.room_id, reply="no")
+                return
+
+        before = self.fen_encode() if self.offload else None
+        start = time.perf_counter()
+        try:
+            self.make_move(player, msg)
+        except IncorrectMove:
+            player.queue_write("no")
+            LOGGER.debug("reply", room=self.room_id, reply="no")
+            return
+        self.record("make_move", start)
+
+        if self.clock_start is not None:
+            self.press_clock()
+
+        if self.offload:
+            self.analyzing = (player, msg, before)  # Finished by apply_analysis once a worker is done with the position
+            return
+
+        start = time.perf_counter()
+        self.update_moves()
+        check, has_moves = self.check_check(), self.has_moves(player)
+        self.record("legal_moves", start)
+
+        self.finish_move(player, msg, check, has_moves)
+
+    def apply_analysis(self, result: tuple[bytes, int, list[bool]]) -> None:  # Takes the result of analyze for the position on_move left behind
+        data, check, has_moves = result
+        player, msg, _ = self.analyzing
+
+        self.analyzing = None
+        self.moves = decode_moves(data)
+        self.finish_move(player, msg, check, has_moves[self.turn])
+
+    def finish_move(self, player: Player, msg: str, check: int, has_moves: bool) -> None:  # Answers an applied move given the new move table
+        if self.game_id is not None:
+            self.log.move(self.game_id, msg)
+
+        start = time.perf_counter()
+        rep = self.save_board_pos(self.turn ^ 1)
+        self.record("save_board_pos", start)
+
+        resp = "ok"
+        if check == self.turn:
+            if has_moves:
+                resp += "+"
+            else:
+                resp += "#"
+                self.in_progress = False
+                self.ended = True
+                self.score = "1-0" if player == self.white else "0-1"
+        elif not has_moves or self.caclock >= 100 or rep or self.insufficient_material():
+            resp += "-"
+            self.in_progress = False
+            self.ended = True
+            self.score = "1/2-1/2"
+        player.queue_write(resp)
+        LOGGER.debug("reply", room=self.room_id, reply=resp)
+
+        if check != -1:
+            if has_moves:
+                msg += "+"
+            else:
+                msg += "#"
+        elif not has_moves:
+            msg += "-"
+        start = time.perf_counter()
+        self.broadcast(msg, skip=player)
+        self.record("broadcast", start)
+
+        if self.ended:
+            self.end_game()
+
+    def record(self, phase: str, start: float) -> None:  # Adds the time since start (time.perf_counter()) to the histogram of a move phase (see metrics.py) and to a trace session
+        if self.metrics is None and not PROFILER.tracing:
+            return
+
+        elapsed = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics.phases[phase].observe(elapsed)
+        if PROFILER.tracing:
+            PROFILER.trace(self.room_id, len(self.history), phase, elapsed)
+
+    def on_close(self, con: Connection) -> None:
+        if con in self.pending:
+            del self.pending[con]
+            return
+
+        self.write_to.pop(con, None)
+
+        if self.ended:
+            return
+
+        if con != self.white and con != self.black:
+            LOGGER.info("spectator_left", room=self.room_id)
+            return
+
+        if not self.in_progress:
+            LOGGER.info("player_left", room=self.room_id, side="white" if con == self.white else "black")
+            if con == self.white:
+                self.white = None
+            else:
+                self.black = None
+            return
+
+        if con == self.white:
+            self.score = '0-1'
+        else:
+            self.score = '1-0'
+        LOGGER.info("abandoned", room=self.room_id, side="white" if con == self.white else "black")
+        self.end_game()
+
+    @property
+    def finished(self) -> bool:  # Ended and every connection closed
+        return self.ended and len(self.write_to) == 0 and len(self.pending) == 0
+
+    @property
+    def deserted(self) -> bool:  # Left by everyone before it started
+        return not self.in_progress and not self.ended and self.white is None and self.black is None and len(self.write_to) == 0 and len(self.pending) == 0
 
-        self.serversocket.close()
-        
     def serve(self, port: int, pos: str = START_POS) -> None:
+        self.start(pos)
+
+        with Server(self) as server:
+            server.serve(port)
+
+    def deadline(self) -> float | None:  # time.monotonic() the side to move runs out of time at, None unless its clock runs
+        if self.clock_start is None or not self.in_progress:
+            return None
+        return self.clock_start + self.clocks[self.turn]
+
+    def press_clock(self) -> None:  # Charges the player who just moved and starts the opponent's clock, after make_move
+        now = time.monotonic()
+        self.clocks[self.turn ^ 1] += self.clock[1] - (now - self.clock_start)
+        self.clock_start = now
+
+    def flag(self) -> None:  # The side to move ran out of time
+        loser = self.turn
+        LOGGER.info("flag", room=self.room_id, side=COLOR_NAMES[loser])
+
+        if self.occupancy[loser ^ 1].bit_count() == 1:  # A bare king can't mate, so it's a draw
+            self.score = "1/2-1/2"
+        else:
+            self.score = "0-1" if loser == self.WHITE_TURN else "1-0"
+        self.end_game()
+
+    def end_game(self) -> None:
+        LOGGER.info("game_over", room=self.room_id, result=self.score, game=self.game_id)
+        if self.game_id is not None:
+            self.log.end(self.game_id, self.score)
+        if self.metrics is not None:
+            self.metrics.ended(self.score)
+        self.ended = True
+        self.in_progress = False
+        self.broadcast("end " + self.score)
+
+    def broadcast(self, msg: str, skip: Connection = None) -> None:  # Frames msg once per protocol and queues it to every subscriber but skip
+        data = frame(msg)
+        binary = None
+
+        count = 0
+        size = 0
+        for c in self.write_to:
+            if c is skip:
+                continue
+            if c.binary:
+                if binary is None:
+                    binary = binary_frame(msg)
+                c.queue_frame(binary)
+                size += len(binary)
+            else:
+                c.queue_frame(data)
+                size += len(data)
+            count += 1
+
+        self.broadcasts += 1
+        self.frames_broadcast += count
+        self.bytes_broadcast += size
+
+    def broadcast_stats(self) -> dict[str, int]:
+        return {"broadcasts": self.broadcasts, "frames": self.frames_broadcast, "bytes": self.bytes_broadcast}
+
+
+_worker_games: dict[bool, Game] = {}  # One scratch Game per backend in each worker process
+
+
+def analyze(fen: str, bitboard: bool) -> tuple[bytes, int, list[bool]]:  # Runs in a pool worker: (encode_moves table, check_check, has_moves by color)
+    game = _worker_games.get(bitboard)
+    if game is None:
+        game = _worker_games[bitboard] = Game(bitboard)
+
+    game.fen_decode(fen)
+    game.update_moves()
+    moves = game.all_legal_moves()  # The room's own queries will be answered from it
 
+    has_moves = [False, False]
+    for (r, f), targets in moves.items():
+        if targets:
+            has_moves[game.board[r * 8 + f] >> 3] = True
+
+    return encode_moves(moves), game.check_check(), has_moves
+
+
+def analyze_batch(positions: list[tuple[str, bool]]) -> list[tuple[bytes, int, list[bool]]]:  # analyze of each (FEN, bitboard), one round trip to the pool
+    return [analyze(fen, bitboard) for fen, bitboard in positions]
+
+
+def analysis_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned rather than forked, a forked worker would hold on to every client socket open at the time
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"), initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+
+
+def encode_moves(moves: dict[tuple[int, int], list[tuple[int, int]]]) -> bytes:  # Square, target count, targets, for every occupied square
+    out = bytearray()
+    for (r, f), targets in moves.items():
+        out.append(r * 8 + f)
+        out.append(len(targets))
+        out.extend(tr * 8 + tf for tr, tf in targets)
+    return bytes(out)
+
+
+def decode_moves(data: bytes) -> dict[tuple[int, int], list[tuple[int, int]]]:
+    moves = {}
+    i = 0
+    while i < len(data):
+        sq, count = data[i], data[i + 1]
+        moves[(sq >> 3, sq & 7)] = [(t >> 3, t & 7) for t in data[i + 2:i + 2 + count]]
+        i += 2 + count
+    return moves
+
+
+def count_connections(rooms: Iterable[Game]) -> dict[str, int]:  # Connections of the rooms by role, see metrics.ROLES
+    counts = dict.fromkeys(ROLES, 0)
+    for room in rooms:
+        spectators = len(room.write_to)
+        for role, player in (("white", room.white), ("black", room.black)):
+            if player is not None and player in room.write_to:
+                counts[role] += 1
+                spectators -= 1
+        counts["spectator"] += spectators
+        counts["pending"] += len(room.pending)
+    return counts
+
+
+def parse_join(msg: str) -> tuple[str, bool]:  # Room id of a "join <room id>[ binary]" request and whether it asks for binary frames
+    if not msg.startswith("join ") or len(msg) == 5:
+        raise ValueError("Expected 'join <room id>'")
+
+    room_id = msg[5:]
+    if room_id.endswith(" binary"):
+        return room_id[:-7], True
+    return room_id, False
+
+
+class Timer:
+    """Entry of Server's timer heap, see Server.call_at."""
+
+    __slots__ = ("deadline", "callback", "pending")
+
+    def __init__(self, deadline: float, callback: Callable[[], None]) -> None:
+        self.deadline = deadline  # On the time.monotonic() clock
+        self.callback = callback
+        self.pending = True  # Until it fires or is cancelled
+
+    def when(self) -> float:  # As asyncio.TimerHandle.when, see BaseServer.arm
+        return self.deadline
+
+
+class BaseServer:
+    """What Server and AsyncServer have in common: the rooms and their creation
+    on join, the flag timers of their clocks, metrics sampling and profiling.
+
+    Subclasses bring the event loop: its timers (call_at, call_later and
+    cancel), settle, which brings the connections and the clock of a room up
+    to date after it handled an event, and the gauges sample reports.
+    """
+
+    HANDSHAKE_TIMEOUT = 10  # Seconds to join a room and answer the role prompt
+    SPECTATOR_TIMEOUT = 30  # Seconds a spectator may sit on queued output without taking any of it
+
+    def __init__(self, room: Game = None, pos: str = Game.START_POS, bitboard: bool = False, workers: int = 0, log: GameLog = None,
+                 clock: tuple[float, float] = None, metrics: Metrics = None) -> None:
+        self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.serversocket.setblocking(False)
+
+        self.room = room
+        self.pos = pos
+        self.bitboard = bitboard
+        self.log = log  # Given to the rooms it creates
+        self.clock = clock  # Time control of the rooms it creates
+        self.metrics = metrics  # Given to the rooms it creates too
+
+        self.rooms: dict[str, Game] = {}
+        if room is not None:
+            self.rooms[room.room_id] = room
+
+        self.flags: dict[Game, Timer | asyncio.TimerHandle] = {}  # Flag-fall timer of each room with a running clock
+
+        self.workers = workers
+        self.pool: ProcessPoolExecutor = None
+
+    def __enter__(self):
+        return self
+
+    def serve(self, port: int) -> None:
+        self.listen(port)
+        self.run()
+
+    def call_at(self, deadline: float, callback: Callable[[], None]) -> Timer | asyncio.TimerHandle:  # deadline is on the time.monotonic() clock
+        raise NotImplementedError
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Timer | asyncio.TimerHandle:
+        raise NotImplementedError
+
+    def cancel(self, timer: Timer | asyncio.TimerHandle) -> None:
+        raise NotImplementedError
+
+    def settle(self, room: Game, con) -> None:
+        raise NotImplementedError
+
+    def gauges(self) -> tuple[dict[str, int], int]:  # Connections by role (see metrics.ROLES) and bytes of queued output
+        raise NotImplementedError
+
+    def get_or_create_room(self, room_id: str) -> Game:
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = Game(self.bitboard, room_id=room_id, log=self.log, clock=self.clock, metrics=self.metrics)
+            room.offload = self.pool is not None
+            room.start(self.pos)
+            self.rooms[room_id] = room
+            LOGGER.info("room_created", room=room_id)
+        return room
+
+    def arm(self, room: Game) -> None:  # Keeps the flag timer of room at the deadline of its side to move
+        deadline = room.deadline()
+        timer = self.flags.get(room)
+
+        if timer is not None:
+            if timer.when() == deadline:
+                return
+            self.cancel(timer)
+            del self.flags[room]
+
+        if deadline is not None:
+            self.flags[room] = self.call_at(deadline, lambda: self.flag(room))
+
+    def flag(self, room: Game) -> None:  # Flag-fall timer of room
+        del self.flags[room]
+        room.flag()
+        self.settle(room, None)
+
+    def sample(self) -> None:  # Gauges of self.metrics, then samples again later
+        counts, queued = self.gauges()
+        self.metrics.sample(counts, queued, LOGGER.dropped)
+
+        self.call_later(self.metrics.SAMPLE_INTERVAL, self.sample)
+
+    def profile(self, signum: int) -> None:  # Starts the profiling session signum asks for
+        mode, seconds, path = PROFILER.take(signum)
+        if PROFILER.start(mode, seconds, path):
+            self.call_later(seconds, PROFILER.stop)
+
+
+class Server(BaseServer):
+    """Accepts connections on one listening socket and routes them to game rooms.
+
+    Given a room, every connection joins it directly and serve returns once that
+    game is over, which is what Game.serve does. Otherwise the first message of
+    a connection has to be "join <room id>", rooms are created on demand from
+    pos and serve runs until interrupted.
+
+    With workers, move generation and the end of game checks after each move
+    run in a process pool instead of the event loop, see analyze. The moves of
+    one loop iteration are shipped as one batch per worker, and the results
+    come back through the done callbacks of the futures, which wake the
+    selector up over a socket pair.
+    """
+
+    ACCEPT_BATCH = 4  # Connections accepted per readiness event, so a connect storm can't starve moves
+    ACCEPT_BACKOFF = 0.1  # Seconds the listener is left alone after accept failed for want of resources
+
+    def __init__(self, room: Game = None, pos: str = Game.START_POS, bitboard: bool = False, workers: int = 0, log: GameLog = None,
+                 clock: tuple[float, float] = None, metrics: Metrics = None) -> None:
+        super().__init__(room, pos, bitboard, workers, log, clock, metrics)
+
+        self.lobby: set[Player] = set()  # Connected, but not in a room yet
+        self.connections: dict[int, Connection] = {}  # By file descriptor
+        self.flushing: set[Connection] = set()  # Connections with queued output
+
+        self.ending: set[Game] = set()  # Ended rooms with connections left to flush
+        self.sweep: list[Game] = []  # Rooms that just ended
+        self.drained: list[Connection] = []  # Flushed connections of ended rooms
+        self.ready: deque[Connection] = deque()  # Connections with buffered messages that may be read again
+
+        self.selector = selectors.DefaultSelector()
+        self.timers: list[tuple[float, int, Timer]] = []  # Heap of (deadline, sequence number, timer)
+        self.timer_seq = 0
+        self.cancelled = 0  # Cancelled timers still in the heap
+
+        self.waker: socket.socket = None  # Read end of the socket pair done callbacks and signals write to
+        self.wake_w: socket.socket = None
+        self.signals: list[int] = []  # Profiling signals received, handled by the loop
+        self.analyses: list[Game] = []  # Rooms with a move to analyze, submitted at the end of the loop iteration
+        self.results: deque[tuple[list[Game], Future]] = deque()  # Appended to on the pool's thread
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def listen(self, port: int) -> None:
         self.serversocket.bind(('', port))
-        self.serversocket.listen(5)
+        self.serversocket.listen(5 if self.room is not None else socket.SOMAXCONN)
+        self.selector.register(self.serversocket, selectors.EVENT_READ)
 
-        print(f"Server started on port {port}")
+        LOGGER.info("listening", port=self.serversocket.getsockname()[1])
 
-        read_from = [self.serversocket]
+    def start_pool(self) -> None:
+        self.pool = analysis_pool(self.workers)
+        wait([self.pool.submit(analyze, self.pos, self.bitboard) for _ in range(self.workers)])  # Start them before the first move
 
-        self.fen_decode(pos)
+        for room in self.rooms.values():
+            room.offload = True
 
-        self.moves = self.get_all_moves()
-        self.save_board_pos(self.turn)
-        self.save_board_pos(self.turn ^ 1)
+    def call_at(self, deadline: float, callback: Callable[[], None]) -> Timer:  # Runs callback from the loop once time.monotonic() reaches deadline
+        timer = Timer(deadline, callback)
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (deadline, self.timer_seq, timer))
+        return timer
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Timer:
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def cancel(self, timer: Timer) -> None:  # Leaves the entry in the heap until it comes up, unless most of the heap is cancelled
+        if not timer.pending:
+            return
+
+        timer.pending = False
+        self.cancelled += 1
+
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.timers):
+            self.timers = [entry for entry in self.timers if entry[2].pending]
+            heapq.heapify(self.timers)
+            self.cancelled = 0
+
+    def run_timers(self) -> None:  # Fires the timers that are due
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.pending:
+                self.cancelled -= 1
+                continue
+
+            timer.pending = False
+            timer.callback()
+
+    def next_deadline(self) -> float | None:
+        while self.timers and not self.timers[0][2].pending:  # Don't wake up for a cancelled one
+            heapq.heappop(self.timers)
+            self.cancelled -= 1
+
+        return self.timers[0][0] if self.timers else None
+
+    def open_waker(self) -> None:
+        self.waker, self.wake_w = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+
+    def handle_signals(self) -> None:  # Profiling signals (see profiler.py) are queued for the loop, a handler may run in the middle of anything
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        signal.set_wakeup_fd(self.wake_w.fileno())  # Makes select return, so the loop gets to them
+        for signum in SIGNALS:
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        PROFILER.armed = True
+
+    def run(self) -> None:
+        if self.waker is None:
+            self.open_waker()
+
+        if self.workers > 0 and self.pool is None:
+            self.start_pool()
+
+        if not PROFILER.armed:
+            self.handle_signals()  # After forking the workers, they needn't wake us
+
+        self.call_later(self.SPECTATOR_TIMEOUT, self.evict)
+        if self.metrics is not None:
+            self.sample()
 
         while True:
-            ready_read, ready_write, _ = select.select(read_from, [c.sock for c in self.write_to if not c.queue_empty], [], 0.5)
+            timeout = None
+            deadline = self.next_deadline()
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
 
-            if self.serversocket in ready_read:
-                (client, address) = self.serversocket.accept()
+            events = self.selector.select(timeout)
+            busy = time.perf_counter()
 
-                print(f"Connection estabilished: {address}")
+            for key, mask in events:
+                if key.fileobj is self.waker:
+                    self.collect()
+                    continue
+
+                if key.data is None:
+                    self.accept()
+                    continue
 
-                if self.in_progress:
-                    con = Connection(client)
-                    con.queue_write("s")
-                    con.queue_write(self.fen_encode())
-                    con.queue_write("initok")
-                    self.write_to.append(con)
-                
-                else:
+                con = key.data
+                if self.connections.get(con.fd) is not con:  # Dropped while handling an earlier event
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
                     try:
-                        con = self.init_con(client)
-                        if con == self.white or con == self.black:
-                            read_from.append(con.sock)
-                    except Exception as err:
-                        print(f"Failed to initialize connection, because '{err}'. Shutting it down")
-                        try:
-                            self.blocking_write(client, "initfail")
-                        except:
-                            pass
-                        client.close()
-
-                ready_read.remove(self.serversocket)
-
-            for sock in ready_write:
-                for c in self.write_to:
-                    if c.sock == sock:
-                        con = c
-                
-                try:
-                    con.write()
-                except:
-                    if con != self.white and con != self.black:
-                        print(f"Spectator closed unexpectedly. Anyway...")
-                        con.sock.close()
-                        self.write_to.remove(con)
+                        con.write()
+                    except Exception:  # Not KeyboardInterrupt, Ctrl-C and SIGTERM shut the server down
+                        self.drop(con)
                         continue
-                    elif con == self.white:
-                        self.score = '0-1'
-                        print("White abandoned game")
-                    else:
-                        self.score = '1-0'
-                        print("Black abandoned game")
-                    self.end_game(self.score)
-                    con.sock.close()
-                    self.write_to.remove(con)
-                        
-
-            if not self.in_progress and self.white is not None and self.black is not None and not self.ended:
-                self.in_progress = True
-                read_from = [self.serversocket]
-
-                if self.turn == self.WHITE_TURN:
-                    read_from.append(self.white.sock)
-                else:
-                    read_from.append(self.black.sock)
-
-            if not self.in_progress and not self.ended:
-                for sock in ready_read:
-                    if self.white is not None and self.white.sock == sock:
-                        con = self.white
-                    else:
-                        con = self.black
-                    
+
+                if mask & selectors.EVENT_READ and con.reading:
                     try:
-                        msg = con.read()
-                    except:
-                        print(f"Connection at {con.sock.getpeername()} closed")
-                        con.sock.close()
-                        if con == self.white:
-                            self.white = None
-                        elif con == self.black:
-                            self.black = None
-                        read_from.remove(sock)
-                        self.write_to.remove(con)
-
-            if self.ended:
-                if len(self.write_to) == 0:
-                    return
-                
-                remove = []
-                for con in self.write_to:
-                    if con.queue_empty:
-                        print(f"Closing connection to {con.sock.getpeername()}")
-                        con.sock.close()
-                        remove.append(con)
-                for con in remove:
-                    self.write_to.remove(con)
-
-            if len(ready_read) == 0 or not self.in_progress:
-                continue
+                        con.read()
+                    except Exception:
+                        self.drop(con)
+                        continue
 
-            # Read move
+                    self.deliver(con)
 
-            sock = ready_read[0]
+            while self.ready:
+                self.deliver(self.ready.popleft())
 
-            if self.white.sock == sock:
-                player = self.white
-            else:
-                player = self.black
+            while self.signals:
+                self.profile(self.signals.pop(0))
+
+            if self.analyses:
+                self.submit()
 
-            if (self.turn == self.WHITE_TURN and player == self.black) or (self.turn == self.BLACK_TURN and player == self.white):
-                raise Exception("Wrong player made a move. That shouldn't be possible")
+            self.run_timers()
 
+            self.reap()
+
+            if self.metrics is not None:
+                self.metrics.loop.observe(time.perf_counter() - busy)
+
+            if self.room is not None and self.room.finished:
+                return
+
+    def interest(self, con: Connection) -> None:  # Brings the selector registration of con up to date
+        events = (selectors.EVENT_READ if con.reading else 0) | (selectors.EVENT_WRITE if not con.queue_empty else 0)
+
+        if events == con.events:
+            return
+
+        if events & selectors.EVENT_WRITE:
+            self.flushing.add(con)
+        elif con in self.flushing:
+            self.flushing.discard(con)
+            if con.room is not None and con.room.ended:
+                self.drained.append(con)
+
+        if con.events == 0:
+            self.selector.register(con.sock, events, con)
+        elif events == 0:
+            self.selector.unregister(con.sock)
+        else:
+            self.selector.modify(con.sock, events, con)
+
+        con.events = events
+
+    def refresh(self, room: Game, con: Connection) -> None:  # Updates read interest and the flag timer after room handled an event from con
+        readers = room.readers()
+
+        for c in list(room.pending) + [room.white, room.black, con]:
+            if c is not None and self.connections.get(c.fd) is c:
+                reading = c in readers
+                if reading and not c.reading and c.buffered:
+                    self.ready.append(c)
+                c.reading = reading
+                self.interest(c)
+
+        self.arm(room)
+
+    def settle(self, room: Game, con: Connection | None) -> None:  # refresh, and the end of room if that was the event
+        self.refresh(room, con)
+        self.check_end(room)
+
+    def expire(self, con: Player) -> None:  # Handshake timer of con
+        if self.connections.get(con.fd) is con and (con.room is None or con in con.room.pending):
+            self.fail(con, "Handshake timed out")
+
+    def evict(self) -> None:  # Drops spectators that took none of their queued output since the last run, then runs again later
+        for con in list(self.flushing):
+            if con.written != con.mark:
+                con.mark = con.written
+            elif con.room is not None and con is not con.room.white and con is not con.room.black and con not in con.room.pending:
+                LOGGER.warning("evicted", room=con.room.room_id, fd=con.fd, reason="spectator stopped reading")
+                self.close(con)
+
+        self.call_later(self.SPECTATOR_TIMEOUT, self.evict)
+
+    def gauges(self) -> tuple[dict[str, int], int]:
+        counts = count_connections(self.rooms.values())
+        counts["pending"] += len(self.lobby)
+        return counts, sum(len(data) for con in self.flushing for data in con.send_queue)
+
+    def deliver(self, con: Player) -> None:  # Dispatches buffered messages of con for as long as it is read from
+        while con.reading and self.connections.get(con.fd) is con:
+            try:
+                msg = con.next_message()
+            except FrameError as err:
+                self.fail(con, err)
+                return
+
+            if msg is None:
+                return
+            self.dispatch(con, msg)
+
+    def accept(self) -> None:
+        for _ in range(self.ACCEPT_BATCH):
             try:
-                msg = player.read()
-            except:
-                if player == self.white:
-                    print("White abandoned game")
-                    self.score = '0-1'
-                else:
-                    print("Black abandoned game")
-                    self.score = '1-0'
-                self.end_game()
-                self.write_to.remove(player)
-                msg = None
-
-            if msg == None:
+                (client, address) = self.serversocket.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:  # Reset while in the backlog, the next one may be fine
                 continue
+            except OSError as err:  # Out of file descriptors or memory, the backlog waits until some are freed
+                LOGGER.warning("accept_failed", error=err, retry=self.ACCEPT_BACKOFF)
+                self.selector.unregister(self.serversocket)
+                self.call_later(self.ACCEPT_BACKOFF, lambda: self.selector.register(self.serversocket, selectors.EVENT_READ))
+                return
 
-            print(("White: " if player == self.white else "Black: ") + msg)
+            self.add(client, address)
 
-            if msg.startswith("moves "):
-                try:
-                    (r, f) = self.decode_alg(msg[6:8])
-                    moves = self.moves.get((r, f), [])
-                    resp = "moves " + msg[6:8] + " "
-                    for move in moves:
-                        resp += self.encode_alg(move[0], move[1])
-                    player.queue_write(resp)
-                    print(resp)
-                    continue
-                except IncorrectMove:
-                    player.queue_write("no")
-                    print("no")
-                    continue
+    def add(self, client: socket.socket, address) -> None:
+        LOGGER.info("connected", peer=address, fd=client.fileno())
+
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Moves are tiny, don't let Nagle hold them back
+
+        con = Player(client)
+        con.watch = self.interest
+        self.connections[con.fd] = con
+        self.call_later(self.HANDSHAKE_TIMEOUT, lambda: self.expire(con))
+
+        if self.room is None:
+            self.lobby.add(con)
+            con.reading = True
+            self.interest(con)
+            return
+
+        self.join(con, self.room)
+
+    def join(self, con: Player, room: Game) -> None:
+        con.room = room
+        try:
+            room.greet(con)
+        except Exception as err:
+            self.fail(con, err)
+            return
+
+        self.refresh(room, con)
+
+    def dispatch(self, con: Player, msg: str) -> None:
+        if con.room is None:
+            self.lobby.discard(con)
 
-            check = -1
-            has_moves = True
             try:
-                self.caclock += 1
-                self.make_move(player, msg)
-                self.moves = self.get_all_legal_moves()
-                rep = self.save_board_pos(self.turn)
-                resp = "ok"
-                check = self.check_check()
-                has_moves = self.has_moves(player)
-                if check == (1 - self.turn):
-                    if has_moves:
-                        resp += "+"
-                    else:
-                        resp += "#"
-                        self.in_progress = False
-                        self.ended = True
-                        self.score = "1-0" if player == self.white else "0-1"
-                elif not has_moves or self.caclock >= 100 or rep:
-                    resp += "-"
-                    self.in_progress = False
-                    self.ended = True
-                    self.score = "1/2-1/2"
-                player.queue_write(resp)
-                print(resp)
-                if self.turn == self.BLACK_TURN:
-                    self.move += 1
-                self.turn ^= 1
-            except IncorrectMove:
-                player.queue_write("no")
-                print("no")
-                continue
+                room_id, con.binary = parse_join(msg)
+            except ValueError as err:
+                self.fail(con, err)
+                return
+
+            self.join(con, self.get_or_create_room(room_id))
+            return
 
-            if check != -1:
-                if has_moves:
-                    msg += "+"
-                else:
-                    msg += "#"
-            elif not has_moves:
-                msg += "-"
-            for c in self.write_to:
-                if c == player:
+        try:
+            con.room.on_message(con, msg)
+        except Exception as err:
+            self.fail(con, err)
+            return
+
+        if con.room.analyzing is not None:
+            self.analyses.append(con.room)
+
+        self.settle(con.room, con)
+
+    def submit(self) -> None:  # Hands the positions on_move left behind to the pool, a batch per worker
+        rooms = self.analyses
+        self.analyses = []
+
+        for i in range(min(self.workers, len(rooms))):
+            batch = rooms[i::self.workers]
+            future = self.pool.submit(analyze_batch, [(room.fen_encode(), room.bitboard) for room in batch])
+            future.add_done_callback(lambda future, batch=batch: self.analyzed(batch, future))
+
+    def analyzed(self, batch: list[Game], future: Future) -> None:  # Called on the pool's thread
+        self.results.append((batch, future))
+        try:
+            self.wake_w.send(b"\0")
+        except OSError:  # Already woken up with a full buffer, or shut down
+            pass
+
+    def collect(self) -> None:  # Finishes the moves whose analysis is done
+        try:
+            while self.waker.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.results:
+            batch, future = self.results.popleft()
+
+            try:
+                results = future.result()
+            except Exception as err:  # A broken pool shouldn't take the games with it
+                LOGGER.warning("analysis_failed", error=err)
+                results = [analyze(room.fen_encode(), room.bitboard) for room in batch]
+
+            for room, result in zip(batch, results):
+                if room.ended or room.analyzing is None:  # Abandoned while the worker was busy
                     continue
-                c.queue_write(msg)
 
-            if self.ended:
-                self.end_game()
-                read_from = []
-                continue
+                room.apply_analysis(result)
+                self.settle(room, None)
 
-            read_from = [self.serversocket]
+    def fail(self, con: Connection, err) -> None:
+        LOGGER.warning("initfail", fd=con.fd, error=err)
+        try:
+            con.sock.send(con.encode("initfail"))
+        except Exception:  # Let KeyboardInterrupt through, like the run loop
+            pass
+        self.drop(con)
+
+    def drop(self, con: Connection) -> None:
+        if con.events != 0:
+            self.selector.unregister(con.sock)
+            con.events = 0
+        con.watch = None
+
+        con.sock.close()
+        self.connections.pop(con.fd, None)
+        self.flushing.discard(con)
+
+        if con.room is None:
+            self.lobby.discard(con)
+            return
+
+        room = con.room
+        room.on_close(con)
+
+        if not room.ended:
+            self.refresh(room, con)
+            if room.deserted and self.room is None and self.rooms.get(room.room_id) is room:
+                del self.rooms[room.room_id]
+                LOGGER.info("room_closed", room=room.room_id)
+            return
+
+        self.check_end(room)
+
+        if (room.finished or room.deserted and self.room is None) and self.rooms.get(room.room_id) is room:
+            self.ending.discard(room)
+            del self.rooms[room.room_id]
+            if self.room is None:
+                LOGGER.info("room_closed", room=room.room_id)
+
+    def check_end(self, room: Game) -> None:
+        if room.ended and room not in self.ending:
+            self.ending.add(room)
+            self.sweep.append(room)
+            self.arm(room)  # Stops its clock
+
+    def close(self, con: Connection) -> None:
+        if self.connections.get(con.fd) is not con:
+            return
+
+        LOGGER.info("closing", fd=con.fd)
+        self.drop(con)
+
+    def reap(self) -> None:  # Closes the connections of ended rooms once their output is flushed
+        while self.sweep:
+            room = self.sweep.pop()
+            for con in [c for c in room.write_to if c.queue_empty] + list(room.pending):
+                self.close(con)
+
+        while self.drained:
+            self.close(self.drained.pop())
 
-            if self.turn == self.WHITE_TURN:
-                read_from.append(self.white.sock)
-            else:
-                read_from.append(self.black.sock)
+    def shutdown(self) -> None:
+        LOGGER.info("shutdown")
 
-    def end_game(self) -> None:
-        print(self.score)
-        self.ended = True
-        self.in_progress = False
-        for c in self.write_to:
-            c.queue_write("end " + self.score)
+        for con in self.connections.values():
+            con.watch = None
+        self.selector.close()
 
-    @staticmethod
-    def blocking_read(sock: socket.socket) -> str:
-        sock.settimeout(0.5)
+        for room in self.rooms.values():
+            for con in list(room.write_to) + list(room.pending):
+                con.queue_write("end " + room.score)
+                try:
+                    while not con.queue_empty:  # As much as the socket takes without blocking
+                        con.write()
+                except Exception:  # A full buffer or a peer that is gone, it's closed either way
+                    pass
+                LOGGER.info("closing", fd=con.fd)
+                con.sock.close()
+
+        for con in self.lobby:
+            con.sock.close()
 
-        read_buf = bytearray(1024)
-        view = memoryview(read_buf)
+        if PROFILER.mode is not None:
+            PROFILER.stop()
 
-        read_prog = 0
-        msg_len = 3
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
 
-        while read_prog < msg_len:
-            recvd = sock.recv_into(view[read_prog:], msg_len - read_prog)
+        if self.waker is not None:
+            if PROFILER.armed:
+                signal.set_wakeup_fd(-1)
+                PROFILER.armed = False
+            self.waker.close()
+            self.wake_w.close()
 
-            if recvd == 0:
-                raise Exception("Socket closed unexpectedly")
+        self.serversocket.close()
 
-            read_prog += recvd
 
-        msg_len = int(read_buf[:msg_len].decode("ascii"))
-        read_prog = 0
+class AsyncConnection(asyncio.Protocol):
+    """Client of an AsyncServer, speaking the same framing as Connection and Player."""
 
-        while read_prog < msg_len:
-            recvd = sock.recv_into(view[read_prog:], msg_len - read_prog)
+    __slots__ = ("server", "transport", "sock", "room", "read_buf", "binary", "reading", "closed", "wakeup", "stall")
 
-            if recvd == 0:
-                raise Exception("Socket closed unexpectedly")
+    def __init__(self, server: "AsyncServer") -> None:
+        self.server = server
+        self.transport: asyncio.Transport = None
+        self.sock = None
 
-            read_prog += recvd
+        self.room: Game = None
 
-        sock.setblocking(False)
+        self.read_buf = bytearray()
+        self.binary = False
+        self.reading = True  # Whether the room wants messages from it, see AsyncServer.settle
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.stall: asyncio.TimerHandle = None  # Eviction timer while the transport has more output buffered than it likes
 
-        return read_buf[:msg_len].decode("ascii")
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.sock = transport.get_extra_info("socket")
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.spawn(self)
 
-    @staticmethod
-    def blocking_write(sock: socket.socket, msg: str) -> None:
-        sock.settimeout(0.5)
+    def data_received(self, data: bytes) -> None:
+        self.read_buf.extend(data)
+        self.wakeup.set()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.closed = True
+        self.wakeup.set()
+        self.resume_writing()
+
+    def pause_writing(self) -> None:  # Output piles up. The players' clocks deal with them, spectators get SPECTATOR_TIMEOUT to catch up
+        room = self.room
+        if room is not None and self is not room.white and self is not room.black:
+            self.stall = asyncio.get_running_loop().call_later(self.server.SPECTATOR_TIMEOUT, self.evict)
+
+    def resume_writing(self) -> None:
+        if self.stall is not None:
+            self.stall.cancel()
+            self.stall = None
+
+    def evict(self) -> None:
+        LOGGER.warning("evicted", room=self.room.room_id, peer=self.transport.get_extra_info("peername"), reason="spectator stopped reading")
+        self.transport.abort()
+
+    async def read(self) -> str | None:  # Next message once the room wants one, None after the client is gone
+        while True:
+            if self.reading:
+                found = next_frame(self.read_buf, 0, len(self.read_buf), self.binary)
+                if found is not None:
+                    msg, end = found
+                    del self.read_buf[:end]
+                    return msg
+
+            if self.closed:
+                return None
+
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+    def set_reading(self, reading: bool) -> None:
+        self.reading = reading
+
+        if self.closed:
+            return
+
+        if reading:
+            self.transport.resume_reading()
+            self.wakeup.set()
+        else:
+            self.transport.pause_reading()
+
+    def encode(self, msg: str) -> bytes:
+        return binary_frame(msg) if self.binary else frame(msg)
+
+    def queue_write(self, msg: str) -> None:
+        self.transport.write(self.encode(msg))
+
+    def queue_frame(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    @property
+    def queue_empty(self) -> bool:
+        return self.transport.get_write_buffer_size() == 0
+
+
+class AsyncServer(BaseServer):
+    """asyncio counterpart of Server with the same room semantics.
 
-        msg = bytearray(f"{str(len(msg)).rjust(3, '0')}{msg}", encoding="ascii")
-        view = memoryview(msg)
-        write_prog = 0
-        msg_len = len(msg)
+    Every client is an AsyncConnection served by its own task, so the role
+    handshake is a coroutine and a slow client only ever delays itself.
+    """
 
-        while write_prog < msg_len:
-            sent = sock.send(view[write_prog:])
+    def __init__(self, room: Game = None, pos: str = Game.START_POS, bitboard: bool = False, workers: int = 0, log: GameLog = None,
+                 clock: tuple[float, float] = None, metrics: Metrics = None) -> None:
+        super().__init__(room, pos, bitboard, workers, log, clock, metrics)
 
-            if sent == 0:
+        self.tasks: set[asyncio.Task] = set()
+        self.done: asyncio.Future = None
+
+        self.ending: set[Game] = set()  # Ended rooms with connections left to close
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.serversocket.close()
+
+    def listen(self, port: int) -> None:
+        self.serversocket.bind(('', port))
+        self.serversocket.listen(5 if self.room is not None else socket.SOMAXCONN)
+
+        LOGGER.info("listening", port=self.serversocket.getsockname()[1])
+
+    def run(self) -> None:
+        asyncio.run(self.main())
+
+    async def main(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.done = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, lambda: self.done.done() or self.done.set_result(None))
+        for signum in SIGNALS:
+            loop.add_signal_handler(signum, self.profile, signum)
+        PROFILER.armed = True
+
+        if self.workers > 0:
+            self.pool = analysis_pool(self.workers)
+            await asyncio.gather(*[loop.run_in_executor(self.pool, analyze, self.pos, self.bitboard) for _ in range(self.workers)])
+            for room in self.rooms.values():
+                room.offload = True
+
+        if self.metrics is not None:
+            self.sample()
+
+        backlog = 5 if self.room is not None else socket.SOMAXCONN
+        server = await loop.create_server(lambda: AsyncConnection(self), sock=self.serversocket, backlog=backlog)
+        async with server:
+            try:
+                await self.done
+            finally:
+                self.shutdown()
+
+    def call_at(self, deadline: float, callback: Callable[[], None]) -> asyncio.TimerHandle:  # The loop's clock is time.monotonic() too
+        return asyncio.get_running_loop().call_at(deadline, callback)
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> asyncio.TimerHandle:
+        return asyncio.get_running_loop().call_later(delay, callback)
+
+    def cancel(self, timer: asyncio.TimerHandle) -> None:
+        timer.cancel()
+
+    def gauges(self) -> tuple[dict[str, int], int]:
+        queued = 0
+        for room in self.rooms.values():
+            for con in list(room.write_to) + list(room.pending):
+                if not con.closed:
+                    queued += con.transport.get_write_buffer_size()
+
+        counts = count_connections(self.rooms.values())
+        counts["pending"] += max(0, len(self.tasks) - sum(counts.values()))  # A task per client, those not in a room yet are in the lobby
+        return counts, queued
+
+    def spawn(self, con: AsyncConnection) -> None:
+        task = asyncio.create_task(self.client(con))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def client(self, con: AsyncConnection) -> None:
+        LOGGER.info("connected", peer=con.transport.get_extra_info("peername"))
+
+        try:
+            await asyncio.wait_for(self.handshake(con), self.HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.fail(con, "Handshake timed out")
+            return
+        except Exception as err:
+            self.fail(con, err)
+            return
+
+        while True:
+            try:
+                msg = await con.read()
+            except FrameError as err:
+                self.fail(con, err)
+                return
+
+            if msg is None:
+                break
+
+            busy = time.perf_counter()
+            try:
+                con.room.on_message(con, msg)
+            except Exception as err:
+                self.fail(con, err)
+                return
+
+            self.settle(con.room, con)
+
+            if self.metrics is not None:  # The loop's iterations aren't ours to time, a message is what it spends them on
+                self.metrics.loop.observe(time.perf_counter() - busy)
+
+            if con.room.analyzing is not None:
+                await self.analyze(con.room)
+
+        self.drop(con)
+
+    async def analyze(self, room: Game) -> None:  # Finishes the move on_move left behind with the pool's help
+        fen = room.fen_encode()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.pool, analyze, fen, room.bitboard)
+        except Exception as err:  # A broken pool shouldn't take the game with it
+            LOGGER.warning("analysis_failed", error=err)
+            result = analyze(fen, room.bitboard)
+
+        if room.ended or room.analyzing is None:  # Abandoned while the worker was busy
+            return
+
+        room.apply_analysis(result)
+        self.settle(room, None)
+
+    async def handshake(self, con: AsyncConnection) -> None:
+        room = self.room
+
+        if room is None:
+            msg = await con.read()
+            if msg is None:
                 raise Exception("Socket closed unexpectedly")
 
-            write_prog += sent
+            room_id, con.binary = parse_join(msg)
+            room = self.get_or_create_room(room_id)
+
+        con.room = room
+        room.greet(con)
+
+        if con in room.pending:
+            resp = await con.read()
+            if resp is None:
+                raise Exception("Socket closed unexpectedly")
+
+            room.on_message(con, resp)
+
+        self.settle(room, con)
+
+    def settle(self, room: Game, con: AsyncConnection) -> None:  # Updates read interest and the flag timer after room handled an event from con
+        readers = room.readers()
+
+        for c in list(room.pending) + [room.white, room.black, con]:
+            if c is not None and not c.closed:
+                c.set_reading(c in readers)
 
-        sock.setblocking(False)
+        self.arm(room)
+
+        if room.ended and room not in self.ending:
+            self.ending.add(room)
+            for c in list(room.write_to) + list(room.pending):
+                if not c.transport.is_closing():
+                    LOGGER.info("closing", peer=c.transport.get_extra_info("peername"))
+                    c.transport.close()  # Sends whatever is still buffered first
+
+        if (room.finished or room.deserted and self.room is None) and self.rooms.get(room.room_id) is room:
+            self.ending.discard(room)
+            del self.rooms[room.room_id]
+            if self.room is None:
+                LOGGER.info("room_closed", room=room.room_id)
+            elif not self.done.done():
+                self.done.set_result(None)
+
+    def fail(self, con: AsyncConnection, err) -> None:
+        LOGGER.warning("initfail", peer=con.transport.get_extra_info("peername"), error=err)
+        if not con.closed:
+            con.queue_write("initfail")
+            con.transport.close()
+        self.drop(con)
+
+    def drop(self, con: AsyncConnection) -> None:
+        if not con.transport.is_closing():
+            con.transport.close()
+
+        if con.room is None:
+            return
+
+        con.room.on_close(con)
+        self.settle(con.room, con)
+
+    def shutdown(self) -> None:
+        LOGGER.info("shutdown")
+
+        for room in self.rooms.values():
+            for con in list(room.write_to) + list(room.pending):
+                if not con.transport.is_closing():
+                    con.queue_write("end " + room.score)
+                    con.transport.close()
+
+        if PROFILER.mode is not None:
+            PROFILER.stop()
+        PROFILER.armed = False
+
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+def time_control(text: str) -> tuple[float, float]:  # "300+2" as seconds per player and increment per move
+    base, _, increment = text.partition("+")
+    return float(base), float(increment or 0)
 
 
 if __name__ == "__main__":
-    with Game() as game:
+    parser = argparse.ArgumentParser(description="Chess game server")
+    parser.add_argument("port", nargs="?", type=int, default=40000)
+    parser.add_argument("pos", nargs="?", default=Game.START_POS, help="FEN of the starting position")
+    parser.add_argument("--rooms", action="store_true", help="host many games, joined with 'join <room id>'")
+    parser.add_argument("--bitboard", action="store_true", help="use the bitboard move generator")
+    parser.add_argument("--asyncio", action="store_true", help="serve clients with asyncio protocols")
+    parser.add_argument("--workers", type=int, default=0, metavar="N", help="analyze positions in a pool of N processes")
+    parser.add_argument("--log", metavar="PATH", help="append the games to a game log, see gamelog.py and pgn.py")
+    parser.add_argument("--clock", type=time_control, metavar="SECONDS+INCREMENT", help="play with clocks, e.g. 300+2, a flag fall loses")
+    parser.add_argument("--metrics", metavar="PORT|PATH", help="serve Prometheus metrics on a local port or a Unix socket, see metrics.py")
+    parser.add_argument("--log-level", choices=LEVELS, default="info", help="least severe JSON log records written to stdout, debug logs every message")
+    parser.add_argument("--profile-dir", default=".", metavar="DIR", help="where profiling sessions (SIGUSR1, SIGUSR2, see profiler.py) write their files")
+    args = parser.parse_args()
+
+    LOGGER.level = LEVELS[args.log_level]
+    PROFILER.directory = args.profile_dir
+
+    log = GameLog(args.log) if args.log else None
+    metrics = Metrics() if args.metrics else None
+    exporter = MetricsServer(metrics, args.metrics) if args.metrics else None
+
+    server_type = AsyncServer if args.asyncio else Server
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # Unwind like Ctrl-C, so the worker pool is shut down too
+
+    if args.rooms:
+        server = server_type(pos=args.pos, bitboard=args.bitboard, workers=args.workers, log=log, clock=args.clock, metrics=metrics)
+    else:
+        game = Game(args.bitboard, log=log, clock=args.clock, metrics=metrics)
+        game.start(args.pos)
+        server = server_type(game, workers=args.workers, metrics=metrics)
+
+    with server:
         try:
-            game.serve(40000 if len(sys.argv) == 1 else int(sys.argv[1]), game.START_POS if len(sys.argv) < 3 else sys.argv[2])
+            server.serve(args.port)
+        except KeyboardInterrupt:
+            pass
         except Exception as err:
-            print(err)
+            LOGGER.error("error", error=err)
+
+    if log is not None:
+        log.close()
+    if exporter is not None:
+        exporter.close()
+    LOGGER.close()
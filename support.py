@@ -0,0 +1,164 @@
+"""Positions and helpers shared by the tests and bench.py."""
+
+import os, random, signal, socket, sys
+import multiprocessing
+
+from server import Game, Piece, Server, AsyncServer, frame
+from protocol import next_frame
+from metrics import Metrics
+
+POSITIONS = [
+    Game.START_POS,
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w KQkq - 0 1",
+    "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQkq - 1 8",
+]
+
+
+FEN_CORPUS = [
+    Game.START_POS,
+    "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1",
+    "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+    "r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1",
+    "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+    "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+    "r3k2r/8/8/8/8/8/8/R3K2R b Kq - 3 20",
+    "4k3/8/8/8/8/8/8/4K3 w - - 99 150",
+    "8/8/8/8/8/8/8/K6k b - - 0 1",
+    "rrrrkrrr/8/8/8/8/8/8/RRRRKRRR w - - 0 1",
+    "7k/P7/8/8/8/8/p7/7K w - - 0 60",
+]
+
+
+PERFT_SUITE = [  # Positions with their known perft counts from depth 1 on
+    (Game.START_POS, [20, 400, 8902, 197281]),
+    ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862, 4085603]),
+    ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238, 674624]),
+    ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467, 422333]),
+    ("r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1", [6, 264, 9467, 422333]),
+    ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379, 2103487]),
+    ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", [46, 2079, 89890, 3894594]),
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", [26, 568, 13744, 314346]),
+    ("8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1", [15, 126, 1928, 13931]),
+]
+
+
+def new_game(pos: str = Game.START_POS, **kwargs) -> Game:
+    game = Game(**kwargs)
+    game.fen_decode(pos)
+    game.update_moves()
+    return game
+
+
+def legal_move_strings(game: Game) -> list[str]:
+    out = []
+    for (r, f), targets in game.all_legal_moves().items():
+        piece = game.get_piece(r, f)
+        if (piece.value & 8) != game.turn << 3:
+            continue
+        for nr, nf in targets:
+            move = game.encode_alg(r, f) + game.encode_alg(nr, nf)
+            if piece in [Piece.PAWN_W, Piece.PAWN_B] and nr in [0, 7]:
+                move += "=Q"
+            out.append(move)
+    return out
+
+
+def play(game: Game, move: str) -> None:
+    """Apply a move the same way Game.serve does after accepting it."""
+    game.make_move(None, move)
+    game.update_moves()
+
+
+def random_lines(games: int, plies: int, seed: int = 0, positions: list[str] = POSITIONS, **kwargs):
+    """Yield (start FEN, move list) pairs of random legal games, kwargs go to Game."""
+    rng = random.Random(seed)
+    for i in range(games):
+        pos = positions[i % len(positions)]
+        game = new_game(pos, **kwargs)
+        line = []
+        for _ in range(plies):
+            moves = legal_move_strings(game)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            line.append(move)
+            play(game, move)
+        yield pos, line
+
+
+class Peer:
+    """Stand-in for a client connection of a Game, keeping the messages queued to it."""
+
+    def __init__(self, binary: bool = False) -> None:
+        self.binary = binary
+        self.received: list[str] = []
+
+    def queue_write(self, msg: str) -> None:
+        self.received.append(msg)
+
+    def queue_frame(self, data: bytes) -> None:
+        start = 0
+        while (found := next_frame(data, start, len(data), self.binary)) is not None:
+            msg, start = found
+            self.received.append(msg)
+
+
+def start_game(pos: str = Game.START_POS, **kwargs) -> tuple[Game, Peer, Peer]:  # A game in progress between two Peers, kwargs go to Game
+    game = Game(**kwargs)
+    game.start(pos)
+    white, black = Peer(), Peer()
+    for peer, role in ((white, "w"), (black, "b")):
+        game.greet(peer)
+        game.on_message(peer, role)
+        peer.received.clear()
+    return game, white, black
+
+
+def quiet_serve(server: Server | AsyncServer) -> None:
+    sys.stdout = open(os.devnull, "w")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # So terminate() shuts the worker pool down too
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def start_server(transport: str, workers: int = 0, metrics: bool = False, **kwargs) -> tuple[int, multiprocessing.Process]:  # kwargs go to the server
+    server_type = AsyncServer if transport == "asyncio" else Server
+    server = server_type(workers=workers, metrics=Metrics() if metrics else None, **kwargs)
+    server.listen(0)
+    port = server.serversocket.getsockname()[1]
+
+    proc = multiprocessing.Process(target=quiet_serve, args=(server,), daemon=workers == 0)  # Daemons can't start a pool
+    proc.start()
+    server.serversocket.close()
+    return port, proc
+
+
+def recv_frames(sock: socket.socket, count: int) -> list[str]:
+    buf = bytearray()
+    msgs = []
+    while len(msgs) < count:
+        while len(buf) < 3 or len(buf) < 3 + int(buf[:3]):
+            buf.extend(sock.recv(1))
+        msgs.append(buf[3:].decode("ascii"))
+        buf.clear()
+    return msgs
+
+
+def join_players(port: int, room_id: str) -> list[socket.socket]:  # White and black of a started game
+    players = []
+    for color in ("w", "b"):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(frame(f"join {room_id}"))
+        players.append(sock)
+    for sock, color in zip(players, ("w", "b")):
+        recv_frames(sock, 1)
+        sock.sendall(frame(color))
+        recv_frames(sock, 2)
+    return players
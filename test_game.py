@@ -0,0 +1,180 @@
+"""Tests of the rules a Game applies beyond move generation: draws, their bookkeeping and clocks."""
+
+import time
+
+import pytest
+
+from server import Game, PAWN, BISHOP, BLACK
+from support import new_game, play, random_lines, start_game
+
+
+def recount(game: Game) -> tuple[list[int], list[int], list[int]]:  # occupancy, material and bishops_on from scratch
+    occupancy = [0, 0]
+    material = [0] * 15
+    bishops_on = [0, 0]
+    for sq, piece in enumerate(game.board):
+        if piece:
+            occupancy[piece >> 3] |= 1 << sq
+            material[piece] += 1
+            if piece & 7 == BISHOP:
+                bishops_on[((sq >> 3) + (sq & 7)) & 1] += 1
+    return occupancy, material, bishops_on
+
+
+def counters(game: Game) -> tuple[list[int], list[int], list[int]]:
+    return game.occupancy, game.material, game.bishops_on
+
+
+MATERIAL = [  # (position, whether neither side can mate)
+    ("4k3/8/8/8/8/8/8/4K3 w - - 0 1", True),
+    ("4k3/8/8/8/8/8/8/2B1K3 w - - 0 1", True),
+    ("4k3/8/8/8/8/8/8/1N2K3 b - - 0 1", True),
+    ("4kb2/8/8/8/8/8/3B4/4K3 w - - 0 1", True),  # Both bishops on dark squares
+    ("2b1k3/8/8/8/8/8/3B4/4K3 w - - 0 1", False),  # Opposite colors
+    ("4k3/8/8/8/8/8/8/1N2KN2 w - - 0 1", False),
+    ("4k3/8/8/8/8/8/4P3/4K3 w - - 0 1", False),
+    ("4k3/8/8/8/8/8/8/3RK3 w - - 0 1", False),
+    ("4kn2/8/8/8/8/8/8/2B1K3 w - - 0 1", False),
+]
+
+
+@pytest.mark.parametrize("pos,insufficient", MATERIAL)
+def test_insufficient_material(pos, insufficient):
+    assert new_game(pos).insufficient_material() == insufficient
+
+
+DRAWING_CAPTURES = [  # (position, capture, whether it leaves mating material)
+    ("4k3/8/8/8/8/8/3r4/2B1K3 w - - 0 1", "c1d2", False),  # K+B vs K
+    ("4k3/8/8/8/8/8/3r4/1N2K3 w - - 0 1", "b1d2", False),  # K+N vs K
+    ("4kb2/8/8/8/8/8/3r4/2B1K3 w - - 0 1", "c1d2", False),  # Bishops on dark squares only
+    ("2b1k3/8/8/8/8/8/3r4/2B1K3 w - - 0 1", "c1d2", True),  # Bishops on both colors
+    ("4k3/8/8/8/8/8/3r4/1N2KN2 w - - 0 1", "b1d2", True),  # K+N+N vs K
+]
+
+
+@pytest.mark.parametrize("bitboard", [False, True], ids=["list", "bitboard"])
+@pytest.mark.parametrize("pos,move,goes_on", DRAWING_CAPTURES)
+def test_capture_into_insufficient_material_draws(pos, move, goes_on, bitboard):
+    game, white, black = start_game(pos, bitboard=bitboard)
+    game.on_message(white, move)
+
+    if goes_on:
+        assert white.received == ["ok"]
+        assert black.received == [move]
+        assert game.in_progress
+    else:
+        assert white.received == ["ok-", "end 1/2-1/2"]
+        assert black.received == [move, "end 1/2-1/2"]  # The "-" suffix is for stalemate, other draws only end the game
+        assert game.ended and game.score == "1/2-1/2"
+
+
+SPECIAL_MOVES = [  # Moves that change more than two squares or one piece into another
+    ("7k/1P6/8/8/8/8/8/K7 w - - 0 1", ["b7b8=Q"]),
+    ("r6k/1P6/8/8/8/8/8/K7 w - - 0 1", ["b7a8=B"]),
+    ("4k3/3p4/8/4P3/8/8/8/4K3 b - - 0 1", ["d7d5", "e5d6"]),
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", ["e1g1", "e8c8"]),
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", ["e1c1", "e8g8"]),
+]
+
+
+@pytest.mark.parametrize("pos,moves", SPECIAL_MOVES)
+def test_material_counters_follow_special_moves(pos, moves):
+    game = new_game(pos)
+    for move in moves:
+        play(game, move)
+        assert counters(game) == recount(game), move
+
+
+def test_material_counters_survive_undo():
+    for pos, line in random_lines(8, 60, seed=8):
+        game = new_game(pos)
+        for move in line:
+            before = recount(game)
+            for (r, f), targets in game.all_legal_moves().items():
+                for nr, nf in targets:
+                    piece = game.board[r * 8 + f]
+                    prom = BISHOP | piece & BLACK if piece & 7 == PAWN and nr in (0, 7) else 0  # Bishops move bishops_on, queens wouldn't
+                    game.do_move(r, f, nr, nf, prom)
+                    assert counters(game) == recount(game), f"after {(r, f, nr, nf)} from {game.fen_encode()}"
+                    game.undo_move()
+                    assert counters(game) == before
+            play(game, move)
+            assert counters(game) == recount(game)
+
+
+def test_press_clock_charges_the_mover_and_adds_the_increment():
+    game, white, black = start_game(clock=(60, 2))
+    assert game.clocks == [60.0, 60.0]
+
+    game.clock_start -= 5  # White thought for 5 seconds
+    game.on_message(white, "e2e4")
+    assert game.clocks[Game.WHITE_TURN] == pytest.approx(57, abs=0.1)
+    assert game.clocks[Game.BLACK_TURN] == 60
+    assert game.deadline() == pytest.approx(time.monotonic() + 60, abs=0.1)
+
+    game.clock_start -= 1
+    game.on_message(black, "e7e5")
+    assert game.clocks[Game.BLACK_TURN] == pytest.approx(61, abs=0.1)
+    assert game.deadline() == pytest.approx(game.clock_start + game.clocks[Game.WHITE_TURN])
+
+
+def test_untimed_games_have_no_deadline():
+    game, white, _ = start_game()
+    game.on_message(white, "e2e4")
+    assert game.deadline() is None
+
+
+FLAGS = [  # (position, result of the side to move running out of time)
+    (Game.START_POS, "0-1"),
+    ("4k3/8/8/8/8/8/8/R3K3 b - - 0 1", "1-0"),
+    ("rnbqkbnr/pppppppp/8/8/8/8/8/4K3 b kq - 0 1", "1/2-1/2"),  # The other way round
+    ("4k3/8/8/8/8/8/PPPPPPPP/RNBQKBNR w KQ - 0 1", "1/2-1/2"),  # Black has a bare king, it can't win on time
+]
+
+
+@pytest.mark.parametrize("pos,score", FLAGS)
+def test_flag(pos, score):
+    game, white, black = start_game(pos, clock=(60, 0))
+    game.flag()
+    assert game.ended and game.score == score
+    assert white.received == black.received == ["end " + score]
+    assert game.deadline() is None
+
+
+def drawn_at(pos: str, moves: list[str]) -> int | None:  # Ply (from 1) the game ended drawn on by repetition, None if it didn't
+    game, white, black = start_game(pos)
+    for ply, move in enumerate(moves, 1):
+        player = white if game.turn == Game.WHITE_TURN else black
+        player.received.clear()
+        game.on_message(player, move)
+        assert player.received[0] in ("ok", "ok-"), f"{move} was refused"
+        if game.ended:
+            assert player.received[0] == "ok-" and game.score == "1/2-1/2"
+            return ply
+    return None
+
+
+SHUFFLE = ["g1f3", "g8f6", "f3g1", "f6g8"]
+
+
+def test_threefold_repetition_from_the_start():
+    assert drawn_at(Game.START_POS, SHUFFLE * 3) == 8  # The start position for the third time
+
+
+def test_repetition_after_a_late_clock_reset():
+    assert drawn_at(Game.START_POS.replace(" 0 1", " 10 1"), SHUFFLE * 3) == 8  # The window follows caclock, not the move count
+    assert drawn_at(Game.START_POS, ["e2e4", "e7e5"] + SHUFFLE * 3) == 10  # The position right after the last pawn move counts
+
+
+def test_live_en_passant_capture_makes_a_position_different():
+    pos = "rnbqkbnr/pppppppp/8/4P3/8/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+    black_first = ["g8f6", "g1f3", "f6g8", "f3g1"]
+    assert drawn_at(pos, ["d7d5"] + SHUFFLE * 3) == 10  # Not 9: right after d7d5 exd6 was possible, so that board didn't count
+    assert drawn_at(pos, black_first * 3) == 8  # Whereas an en passant square nobody can take from doesn't matter
+    assert drawn_at(pos.replace(" - 0 1", " d3 0 1"), black_first * 3) == 8
+
+
+def test_castling_rights_make_a_position_different():
+    pos = "r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1"
+    kings = ["e1f1", "e8f8", "f1e1", "f8e8"]
+    assert drawn_at(pos, kings * 3) == 10  # Not 8 or 9: the first e1f1 and the start kept castling rights the same boards later lack
@@ -0,0 +1,74 @@
+"""Tests of the game log and of its PGN export."""
+
+import pytest
+
+from server import Game
+from gamelog import GameLog, GameRecord, read_games
+from pgn import export
+from support import start_game
+
+FOOLS_MATE = ["f2f3", "e7e5", "g2g4", "d8h4"]
+
+
+def record(fen: str, moves: list[str], result: str = "*") -> GameRecord:  # As read_games would return it
+    game = GameRecord("id", "0", fen, 0.0)
+    game.moves = [(move, 0.0) for move in moves]
+    game.result = result
+    return game
+
+
+def movetext(pgn: str) -> str:
+    return pgn.split("\n\n", 1)[1].strip()
+
+
+def test_games_read_back(tmp_path):
+    path = tmp_path / "games.log"
+    with GameLog(str(path), fsync=False) as log:
+        game, white, black = start_game(log=log, room_id="7")
+        for i, move in enumerate(FOOLS_MATE):
+            game.on_message(white if i % 2 == 0 else black, move)
+        assert game.ended
+
+        unfinished, white, black = start_game(log=log, room_id="8")
+        unfinished.on_message(white, "e2e4")
+
+    with open(path, "a") as file:  # A server that died halfway through a write
+        file.write('{"game":"' + unfinished.game_id + '","event":"mo')
+
+    finished, cut_short = read_games(str(path))
+    assert (finished.game_id, finished.room_id, finished.fen) == (game.game_id, "7", Game.START_POS)
+    assert [move for move, _ in finished.moves] == FOOLS_MATE
+    assert finished.result == "0-1" and finished.ended >= finished.started
+    assert (cut_short.game_id, cut_short.room_id, cut_short.result, cut_short.ended) == (unfinished.game_id, "8", "*", None)
+    assert [move for move, _ in cut_short.moves] == ["e2e4"]
+
+    pgn = export(finished)
+    assert '[Event "Room 7"]' in pgn and '[Result "0-1"]' in pgn and "SetUp" not in pgn
+    assert movetext(pgn) == "1. f3 e5 2. g4 Qh4# 0-1"
+
+
+SAN = [  # (position, logged moves, expected movetext)
+    ("4k3/8/8/8/8/8/8/1N2KN2 w - - 0 1", ["b1d2"], "1. Nbd2 *"),
+    ("4k3/8/8/R7/8/8/8/R3K3 w - - 0 1", ["a5a3", "e8d8", "a1a2"], "1. R5a3 Kd8 2. R1a2 *"),
+    ("2k5/8/8/8/4Q2Q/8/K7/7Q w - - 0 1", ["h4e1"], "1. Qh4e1 *"),
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", ["e1g1", "e8c8"], "1. O-O O-O-O *"),
+    ("r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1", ["e8g8", "e1c1"], "1... O-O 2. O-O-O *"),
+    ("3r4/4P3/8/8/8/8/8/k3K3 w - - 0 1", ["e7e8=Q"], "1. e8=Q *"),
+    ("3r4/4P3/8/8/8/8/8/k3K3 w - - 0 1", ["e7d8=Q"], "1. exd8=Q *"),
+    ("3r4/4P3/8/8/8/8/8/k3K3 w - - 0 1", ["e7e8=N"], "1. e8=N *"),
+    ("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1", ["e5d6"], "1. exd6 *"),
+    ("4k3/8/8/8/8/8/8/R3K3 w - - 0 1", ["a1a8"], "1. Ra8+ *"),
+    ("6k1/5ppp/8/8/8/8/8/R3K3 w - - 0 1", ["a1a8"], "1. Ra8# *"),
+]
+
+
+@pytest.mark.parametrize("pos, moves, expected", SAN)
+def test_export_movetext(pos, moves, expected):
+    pgn = export(record(pos, moves))
+    assert movetext(pgn) == expected
+    assert f'[SetUp "1"]\n[FEN "{pos}"]' in pgn  # Neither starts from the start position
+
+
+def test_export_refuses_illegal_moves():
+    with pytest.raises(ValueError):
+        export(record(Game.START_POS, ["e2e4", "e7e4"]))
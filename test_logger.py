@@ -0,0 +1,93 @@
+"""Tests of the structured logger's load shedding."""
+
+import json, threading
+
+from logger import Logger, INFO, WARNING
+
+
+class BlockedStream:
+    """A pipe nobody reads until release, the writer thread hangs in its first write."""
+
+    def __init__(self) -> None:
+        self.entered = threading.Event()
+        self.released = threading.Event()
+        self.data = []
+
+    def write(self, data: str) -> None:
+        self.entered.set()
+        self.released.wait(10)
+        self.data.append(data)
+
+    def flush(self) -> None:
+        pass
+
+    def records(self) -> list[dict]:
+        return [json.loads(line) for line in "".join(self.data).splitlines()]
+
+
+def blocked_logger(stream: BlockedStream) -> Logger:  # With its writer stuck, so that the queue fills up
+    logger = Logger(INFO, stream)
+    logger.HIGH_WATER = 10
+    logger.MAX_QUEUE = 20
+    logger.SAMPLE = 5
+    logger.info("first")
+    assert stream.entered.wait(10)
+    return logger
+
+
+def test_queue_is_sampled_past_high_water_and_capped():
+    stream = BlockedStream()
+    logger = blocked_logger(stream)
+
+    for i in range(10):
+        logger.info("below", i=i)
+    for i in range(3):
+        logger.warning("kept", i=i)  # Past HIGH_WATER, never sampled
+    for i in range(35):
+        logger.debug("ignored", i=i)  # Below the level, not even seen
+        logger.info("sampled", i=i)
+    assert len(logger.queue) == 20 and logger.dropped == 28
+    logger.warning("over", i=0)  # At MAX_QUEUE nothing gets in
+    logger.info("over", i=1)
+    assert len(logger.queue) == 20 and logger.dropped == 30
+
+    stream.released.set()
+    logger.close()
+
+    records = stream.records()
+    assert [r["event"] for r in records] == ["first"] + ["below"] * 10 + ["kept"] * 3 + ["sampled"] * 7 + ["dropped"]
+    assert [r["i"] for r in records if r["event"] == "sampled"] == [4, 9, 14, 19, 24, 29, 34]  # One in SAMPLE
+    assert records[-1]["level"] == "warning" and (records[-1]["records"], records[-1]["total"]) == (30, 30)
+    assert logger.stats() == {"written": 22, "dropped": 30, "queued": 0}
+
+
+def test_dropped_records_are_reported_once():
+    stream = BlockedStream()
+    logger = blocked_logger(stream)
+    for i in range(25):
+        logger.warning("flood", i=i)
+    stream.released.set()
+    logger.close()
+
+    logger.warning("later")
+    logger.close()
+    assert [r["event"] for r in stream.records()].count("dropped") == 1
+    assert stream.records()[-1]["event"] == "later"
+    assert logger.dropped == 5
+
+
+class ClosedStream:
+
+    def write(self, data: str) -> None:
+        raise ValueError("I/O operation on closed file.")
+
+    def flush(self) -> None:
+        pass
+
+
+def test_records_lost_to_a_closed_stream_are_counted():
+    logger = Logger(INFO, ClosedStream())
+    for i in range(3):
+        logger.log(WARNING, "lost", {"i": i})
+    logger.close()
+    assert logger.stats() == {"written": 0, "dropped": 3, "queued": 0}
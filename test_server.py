@@ -0,0 +1,540 @@
+"""Tests of the move generators, the FEN codec and the wire protocols.
+
+Run with python -m pytest, the timing side of the same code is in bench.py.
+"""
+
+import asyncio, json, random, resource, socket, string, subprocess, sys, time
+
+import pytest
+
+from server import Game, MoveCache, Connection, Player, Server, AsyncServer, frame, parse_join
+from protocol import MAX_FRAME, FrameError, binary_frame, next_frame, varint
+from support import FEN_CORPUS, PERFT_SUITE, new_game, play, random_lines, start_server, recv_frames, join_players
+
+PERFT_DEPTH = 3  # Deeper counts in PERFT_SUITE take minutes, python bench.py perft 4 goes there
+
+
+def normalized(moves: dict) -> dict:
+    return {sq: sorted(targets) for sq, targets in moves.items()}
+
+
+def test_bitboard_moves_match_list_moves():
+    for pos, line in random_lines(8, 40):
+        ref = new_game(pos)
+        bb = new_game(pos, bitboard=True)
+
+        for ply, move in enumerate([None] + line):
+            if move is not None:
+                play(ref, move)
+                play(bb, move)
+
+            for name in ("get_all_moves", "get_all_legal_moves"):
+                assert normalized(getattr(bb, name)()) == normalized(getattr(ref, name)()), f"{name} after {line[:ply]} from {pos}"
+
+
+def test_bitboard_attackers_match_list_attackers():
+    for pos, line in random_lines(4, 40, seed=7):
+        ref = new_game(pos)
+        bb = new_game(pos, bitboard=True)
+
+        for move in [None] + line:
+            if move is not None:
+                play(ref, move)
+                play(bb, move)
+
+            for r in range(8):
+                for f in range(8):
+                    for color in (Game.WHITE_TURN, Game.BLACK_TURN):
+                        attackers = sorted(ref.attackers_of(r, f, color))
+                        assert sorted(bb.attackers_of(r, f, color)) == attackers, f"{(r, f)} by {color} in {ref.fen_encode()}"
+                        assert ref.is_attacked(r, f, color) == bb.is_attacked(r, f, color) == bool(attackers)
+
+
+@pytest.mark.parametrize("bitboard", [False, True], ids=["list", "bitboard"])
+@pytest.mark.parametrize("pos,counts", PERFT_SUITE, ids=[pos for pos, _ in PERFT_SUITE])
+def test_perft(pos, counts, bitboard):
+    game = new_game(pos, bitboard=bitboard)
+    assert [game.perft(d) for d in range(1, PERFT_DEPTH + 1)] == counts[:PERFT_DEPTH]
+    assert game.fen_encode() == pos  # perft undoes every move it makes
+
+
+def test_incremental_hash():
+    for pos, line in random_lines(8, 60, seed=2):
+        game = new_game(pos)
+        for move in line:
+            for (r, f), targets in game.all_legal_moves().items():
+                for nr, nf in targets:
+                    before = game.hash
+                    game.do_move(r, f, nr, nf)
+                    assert game.hash == game.compute_hash(), f"after {game.fen_encode()}"
+                    game.undo_move()
+                    assert game.hash == before, f"undo_move in {game.fen_encode()}"
+            play(game, move)
+
+
+def fen_corpus() -> list[str]:  # FEN_CORPUS and the positions of random games
+    corpus = list(FEN_CORPUS)
+    for pos, line in random_lines(8, 60, seed=5):
+        game = new_game(pos)
+        for move in line:
+            play(game, move)
+            corpus.append(game.fen_encode())
+    return corpus
+
+
+def test_fen_round_trip():
+    game = Game()
+    for pos in fen_corpus():
+        game.fen_decode(pos)
+        assert game.fen_encode() == pos
+        assert game.hash == new_game(pos).hash, f"{pos} decoded to a different position"
+
+
+def test_fen_cache_survives_legality_probes():
+    for pos, line in random_lines(4, 40, seed=6):
+        game = new_game(pos, move_cache=MoveCache())  # Positions random_lines left in the shared one wouldn't be probed
+        game.white, game.black = object(), object()
+        game.in_progress = True
+        for move in line:
+            fen = game.fen_encode()
+            snapshot = game.snapshot(False)
+            game.all_legal_moves()
+            game.has_moves(game.white)
+            assert game.fen_encode() is fen
+            assert game.snapshot(False) is snapshot
+
+            play(game, move)
+            cached = game.fen_encode()
+            game.fen = None
+            game.fen_ranks = [None] * 8
+            assert cached == game.fen_encode()
+
+
+def protocol_messages() -> list[str]:
+    msgs = ["initok", "initfail", "no", "ok", "ok+", "ok#", "ok-", "end 0-0", "end 1-0", "end 0-1", "end 1/2-1/2",
+            "moves e2", "moves e2 e3e4", "moves a8 ", "white", "black", "spectator binary", "join room-1", "a7a8=N#", "", "x" * 999]
+    for pos, line in random_lines(8, 60, seed=4):
+        game = new_game(pos)
+        for move in line:
+            msgs.append(game.fen_encode())
+            play(game, move)
+            msgs += [move, move + "+"]
+    return msgs
+
+
+@pytest.mark.parametrize("binary", [False, True], ids=["ascii", "binary"])
+def test_protocol_round_trip(binary):
+    encode = binary_frame if binary else frame
+    msgs = protocol_messages()
+    stream = b"".join(encode(msg) for msg in msgs)
+
+    decoded = []
+    start = 0
+    while (found := next_frame(stream, start, len(stream), binary)) is not None:
+        msg, start = found
+        decoded.append(msg)
+    assert decoded == msgs
+    assert start == len(stream)
+
+
+@pytest.mark.parametrize("binary", [False, True], ids=["ascii", "binary"])
+def test_protocol_incomplete_frames(binary):
+    data = (binary_frame if binary else frame)("e2e4+")
+    for end in range(len(data)):
+        assert next_frame(data, 0, end, binary) is None
+
+
+MALFORMED = [  # (binary, bytes of a frame that can't be parsed)
+    (False, b"zzxabc"),
+    (False, b"0 1a"),
+    (False, b"003\xff\xfe\xfd"),
+    (True, b"\x01\x7f"),  # Unknown tag
+    (True, b"\x00"),  # No tag
+    (True, b"\x01\x0d"),  # "end" without its score
+    (True, b"\x02\x0d\x09"),  # Score out of range
+    (True, b"\x02\x0c\x00"),  # Cut off snapshot
+    (True, b"\x02\x00\xff"),  # Text that isn't ASCII
+    (True, varint(2 ** 40)),  # Length far beyond MAX_FRAME, rejected before the payload arrives
+    (True, varint(MAX_FRAME + 1) + b"\x00"),
+    (True, b"\x80\x80"),  # Cut off, but already too long
+]
+
+
+@pytest.mark.parametrize("binary,data", MALFORMED)
+def test_protocol_malformed_frames(binary, data):
+    with pytest.raises(FrameError):
+        next_frame(data, 0, len(data), binary)
+
+
+@pytest.mark.parametrize("size", [16, 4096], ids=["growing", "default"])
+@pytest.mark.parametrize("binary", [False, True], ids=["ascii", "binary"])
+def test_player_reads_pipelined_and_split_frames(binary, size):
+    rng = random.Random(5)
+    msgs = protocol_messages() + ["".join(rng.choices(string.ascii_letters, k=rng.randint(900, 999))) for _ in range(20)]
+    rng.shuffle(msgs)
+    stream = b"".join((binary_frame if binary else frame)(msg) for msg in msgs)
+
+    client, sock = socket.socketpair()
+    player = Player(sock)
+    player.binary = binary
+    player.read_buf = bytearray(size)
+
+    received = []
+    sent = 0
+    while sent < len(stream):  # Several frames or a piece of one at a time, each read as soon as it arrives
+        chunk = stream[sent:sent + rng.choice([1, 2, 3, rng.randint(1, 64), rng.randint(1, 3000)])]
+        client.sendall(chunk)
+        sent += len(chunk)
+
+        while True:
+            try:
+                player.read()
+            except BlockingIOError:
+                break
+            while (msg := player.next_message()) is not None:
+                received.append(msg)
+
+    assert received == msgs
+    assert not player.buffered and player.read_start == player.read_end == 0
+    assert len(player.read_buf) == max(size, 1024)  # Only grown to fit the longest frame
+
+    client.close()
+    with pytest.raises(Exception, match="closed"):
+        player.read()
+    sock.close()
+
+
+class RecordingSocket(socket.socket):
+    """Remembers how many buffers each sendmsg was given, and whether the first was the rest of a partly sent one."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        super().__init__(fileno=sock.detach())
+        self.batches = []  # (buffers, whether the first is a memoryview)
+
+    def sendmsg(self, buffers, *args) -> int:
+        sent = super().sendmsg(buffers, *args)
+        self.batches.append((len(buffers), isinstance(buffers[0], memoryview)))
+        return sent
+
+
+def test_connection_writes_everything_queued_in_order():
+    rng = random.Random(9)
+    frames = [frame("".join(rng.choices(string.ascii_letters, k=rng.choice([0, 4, 5, rng.randint(0, 999)])))) for _ in range(2000)]
+    stream = b"".join(frames)
+
+    sock, peer = socket.socketpair()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    peer.settimeout(5)
+    con = Connection(RecordingSocket(sock))
+    watched = []
+    con.watch = lambda c: watched.append(c.queue_empty)
+    for data in frames:
+        con.queue_frame(data)
+
+    received = bytearray()
+    while not con.queue_empty:
+        try:
+            con.write()
+        except BlockingIOError:  # Full, the peer takes some
+            received += peer.recv(rng.randint(1, 8192))
+    while len(received) < len(stream):
+        received += peer.recv(65536)
+
+    assert received == stream
+    assert con.written == len(stream)
+    assert watched == [False, True]  # Once queued to, once drained
+
+    batches = con.sock.batches
+    assert max(count for count, _ in batches) == Connection.SENDMSG_CHUNKS  # More than that are queued at first
+    assert any(partial for _, partial in batches)  # Some sends stopped in the middle of a frame
+
+    con.sock.close()
+    peer.close()
+
+
+@pytest.mark.parametrize("msg,expected", [("join 7", ("7", False)), ("join 7 binary", ("7", True)), ("join a room", ("a room", False))])
+def test_parse_join(msg, expected):
+    assert parse_join(msg) == expected
+
+
+@pytest.mark.parametrize("msg", ["join", "join ", "joint 7", "e2e4"])
+def test_parse_join_rejects(msg):
+    with pytest.raises(ValueError):
+        parse_join(msg)
+
+
+def read_to_end(sock: socket.socket) -> bytes:
+    data = bytearray()
+    while chunk := sock.recv(4096):
+        data.extend(chunk)
+    return bytes(data)
+
+
+@pytest.mark.parametrize("transport", ["selectors", "asyncio"])
+def test_server_refuses_clients_that_dont_join(transport):
+    port, proc = start_server(transport)
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+            sock.sendall(frame("e2e4"))
+            assert read_to_end(sock) == frame("initfail")
+
+        white, black = join_players(port, "after")
+        white.sendall(frame("e2e4"))
+        assert recv_frames(black, 1) == ["e2e4"]
+        white.close()
+        black.close()
+    finally:
+        proc.kill()
+        proc.join()
+
+
+@pytest.mark.parametrize("binary,data", [MALFORMED[0], MALFORMED[3], MALFORMED[9]], ids=["ascii", "binary", "oversized"])
+@pytest.mark.parametrize("transport", ["selectors", "asyncio"])
+def test_server_drops_malformed_frames(transport, binary, data):
+    port, proc = start_server(transport)
+    try:
+        white, black = join_players(port, "bystander")
+
+        bad = socket.create_connection(("127.0.0.1", port), timeout=5)
+        bad.sendall(frame("join culprit binary" if binary else "join culprit"))
+        bad.recv(64)  # Role prompt
+        bad.sendall(data)
+        assert read_to_end(bad).endswith(binary_frame("initfail") if binary else frame("initfail"))
+
+        victim, rival = join_players(port, "victim")  # A player sending garbage on its turn loses the game
+        rival.settimeout(5)
+        victim.sendall(b"zzxabc")
+        assert recv_frames(rival, 1) == ["end 0-1"]
+
+        white.sendall(frame("e2e4"))
+        assert recv_frames(black, 1) == ["e2e4"]
+        assert proc.is_alive()
+
+        for sock in (bad, rival, victim, white, black):
+            sock.close()
+    finally:
+        proc.kill()
+        proc.join()
+
+
+def accept_to_lobby(server: Server, listener: socket.socket) -> tuple[socket.socket, Player]:  # (client socket, its Player)
+    client = socket.create_connection(listener.getsockname())
+    sock, address = listener.accept()
+    server.add(sock, address)
+    return client, server.connections[sock.fileno()]
+
+
+LEAVERS = [(None,), ("w",), ("w", None), (None, "b", None)]  # Roles the clients of a room take before leaving, None for none
+
+
+@pytest.mark.parametrize("roles", LEAVERS + [("w", "s"), ("s", None)])  # Spectators aren't read from, AsyncServer only sees them leave once it writes to them
+def test_server_deletes_rooms_left_before_they_start(roles):
+    with Server() as server, socket.create_server(("127.0.0.1", 0)) as listener:
+        clients = []
+        cons = []
+        for role in roles:
+            client, con = accept_to_lobby(server, listener)
+            clients.append(client)
+            server.dispatch(con, "join left")
+            if role is not None:
+                server.dispatch(con, role)
+            cons.append(con)
+
+        for con in cons:
+            assert "left" in server.rooms
+            server.drop(con)
+        assert server.rooms == {}
+
+        for sock in clients:
+            sock.close()
+
+
+def test_server_shutdown_ends_games():
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        server = Server()
+        clients = []
+        for role in ("w", "b", "s"):
+            client, con = accept_to_lobby(server, listener)
+            clients.append(client)
+            server.dispatch(con, "join room")
+            server.dispatch(con, role)
+        lurker, con = accept_to_lobby(server, listener)  # Hasn't picked a role yet
+        server.dispatch(con, "join room")
+
+        server.shutdown()
+
+        for sock in clients + [lurker]:
+            assert read_to_end(sock).endswith(frame("end 0-0"))
+            sock.close()
+
+
+@pytest.mark.parametrize("roles", LEAVERS)
+def test_async_server_deletes_rooms_left_before_they_start(roles):
+    async def main():
+        server = AsyncServer()
+        server.listen(0)
+        serving = asyncio.create_task(server.main())
+
+        clients = []
+        for role in roles:
+            reader, writer = await asyncio.open_connection(*server.serversocket.getsockname())
+            writer.write(frame("join left"))
+            await reader.readexactly(int(await reader.readexactly(3)))  # Role prompt
+            if role is not None:
+                writer.write(frame(role))
+                await reader.readexactly(int(await reader.readexactly(3)))
+            clients.append(writer)
+
+        for left, writer in enumerate(clients, 1):
+            assert "left" in server.rooms
+            writer.close()
+            for _ in range(500):  # Until the client's task is done with it
+                if len(server.tasks) == len(clients) - left:
+                    break
+                await asyncio.sleep(0.01)
+        assert server.rooms == {}
+
+        server.done.set_result(None)
+        await serving
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("transport", ["selectors", "asyncio"])
+def test_server_survives_running_out_of_file_descriptors(transport):
+    limit = lambda: resource.setrlimit(resource.RLIMIT_NOFILE, (40, 40))
+    args = [sys.executable, "server.py", "0", "--rooms"] + (["--asyncio"] if transport == "asyncio" else [])
+    with subprocess.Popen(args, stdout=subprocess.PIPE, text=True, preexec_fn=limit) as proc:
+        try:
+            port = json.loads(proc.stdout.readline())["port"]
+
+            crowd = [socket.create_connection(("127.0.0.1", port)) for _ in range(60)]  # Beyond the limit, the rest waits in the backlog
+            for sock in crowd:
+                sock.sendall(frame("join crowd"))
+            crowd[-1].settimeout(1)
+            with pytest.raises(socket.timeout):
+                crowd[-1].recv(64)
+            assert proc.poll() is None
+
+            for sock in crowd:
+                sock.close()
+
+            white, black = join_players(port, "after")
+            black.settimeout(5)
+            white.sendall(frame("e2e4"))
+            assert recv_frames(black, 1) == ["e2e4"]
+            white.close()
+            black.close()
+        finally:
+            proc.terminate()
+
+
+def test_timers_fire_in_deadline_order():
+    server = Server()
+    fired = []
+    now = time.monotonic()
+    for delay in (3, 1, 2, 1, -1):
+        server.call_at(now + delay - 10, lambda delay=delay: fired.append(delay))  # All due already
+    later = server.call_later(60, lambda: fired.append("later"))
+
+    server.run_timers()
+    assert fired == [-1, 1, 1, 2, 3]  # Equal deadlines in the order they were set
+    assert server.next_deadline() == later.deadline
+    server.shutdown()
+
+
+def test_cancelled_timers_are_skipped_and_compacted():
+    server = Server()
+    fired = []
+    now = time.monotonic()
+    timers = [server.call_at(now - 100 + i, lambda i=i: fired.append(i)) for i in range(10)]
+    server.cancel(timers[0])
+    server.cancel(timers[0])  # Twice is once
+    server.cancel(timers[5])
+    assert server.cancelled == 2
+    assert server.next_deadline() == timers[1].deadline  # The cancelled head is popped, not waited for
+    assert server.cancelled == 1
+
+    server.run_timers()
+    assert fired == [1, 2, 3, 4, 6, 7, 8, 9]
+    assert server.cancelled == 0 and server.timers == []
+
+    timers = [server.call_later(60 + i, lambda: fired.append("late")) for i in range(200)]
+    for timer in timers[:100]:
+        server.cancel(timer)
+    assert len(server.timers) == 200  # Cancelled entries wait in the heap
+    server.cancel(timers[100])  # Now most of the heap is cancelled
+    assert len(server.timers) == 99 and server.cancelled == 0
+    assert server.next_deadline() == timers[101].deadline
+    server.shutdown()
+
+
+def test_handshake_timeout():
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        server = Server()
+        server.HANDSHAKE_TIMEOUT = -1  # Due as soon as it's set
+
+        idle, con = accept_to_lobby(server, listener)
+        joined, joiner = accept_to_lobby(server, listener)
+        server.dispatch(joiner, "join room")
+        server.dispatch(joiner, "s")  # Done with the handshake in time
+
+        server.run_timers()
+        assert con.fd not in server.connections
+        assert joiner.fd in server.connections
+        assert read_to_end(idle) == frame("initfail")
+
+        server.shutdown()
+        idle.close()
+        joined.close()
+
+
+def test_spectators_that_stop_reading_are_evicted():
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        server = Server()
+        clients = []
+        cons = []
+        for role in ("w", "b", "s", "s"):
+            client, con = accept_to_lobby(server, listener)
+            server.dispatch(con, "join room")
+            server.dispatch(con, role)
+            clients.append(client)
+            cons.append(con)
+        white, black, reader, stuck = cons
+
+        for con in cons:
+            con.queue_frame(b"x" * 100)  # Output left to take
+        server.evict()
+        reader.write()
+        server.evict()  # Only the spectator that took nothing since the last run goes
+
+        assert stuck.fd not in server.connections
+        assert [con.fd in server.connections for con in (white, black, reader)] == [True, True, True]
+        assert stuck not in server.rooms["room"].write_to
+
+        server.shutdown()
+        for client in clients:
+            client.close()
+
+
+@pytest.mark.parametrize("transport", ["selectors", "asyncio"])
+def test_flag_fall(transport):
+    port, proc = start_server(transport, clock=(0.5, 0.25))
+    try:
+        white, black = join_players(port, "blitz")
+        for sock in (white, black):
+            sock.settimeout(5)
+
+        start = time.monotonic()
+        white.sendall(frame("e2e4"))
+        assert recv_frames(white, 1) == ["ok"]
+        assert recv_frames(black, 1) == ["e2e4"]
+        assert recv_frames(white, 1) == recv_frames(black, 1) == ["end 1-0"]  # Black never moved
+        assert 0.4 < time.monotonic() - start < 2
+
+        for sock in (white, black):
+            assert read_to_end(sock) == b""
+            sock.close()
+    finally:
+        proc.kill()
+        proc.join()
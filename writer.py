@@ -0,0 +1,69 @@
+"""A queue of records drained by a writer thread, under logger.py and gamelog.py.
+
+The event loop only appends records, the thread encodes whatever is queued and
+hands the lines to write in one go. Subclasses provide encode and write.
+"""
+
+import threading, time
+from collections import deque
+
+
+class Writer:
+
+    FLUSH_INTERVAL = 0  # Seconds a record may wait for company before it is written
+    NAME = "writer"  # Of the thread
+
+    def __init__(self) -> None:
+        self.queue: deque[tuple] = deque()  # Appended to by the event loop, drained by the writer thread
+        self.ready = threading.Event()  # Set once something is queued
+        self.closing = False
+        self.thread: threading.Thread = None  # Started by the first record, in every process
+
+    def encode(self, record: tuple) -> str:  # Line of a queued record
+        raise NotImplementedError
+
+    def write(self, lines: list[str]) -> None:  # Called by the writer thread, lines may be empty
+        raise NotImplementedError
+
+    def append(self, record: tuple) -> None:
+        self.queue.append(record)
+
+        if self.thread is None:
+            self.spawn()
+        if not self.ready.is_set():
+            self.ready.set()
+
+    def spawn(self) -> None:
+        self.thread = threading.Thread(target=self.run, name=self.NAME, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.closing:
+            self.ready.wait()
+            if self.FLUSH_INTERVAL:
+                time.sleep(self.FLUSH_INTERVAL)  # Let the batch fill up
+            self.ready.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:  # Writes out everything queued so far
+        queue = self.queue
+        self.write([self.encode(queue.popleft()) for _ in range(len(queue))])  # Not what the loop queues meanwhile, or a busy loop would keep it from writing
+
+    def close(self, timeout: float = None) -> None:  # Writes out the backlog, a later record starts a new writer
+        thread = self.thread
+        if thread is None:
+            return
+
+        self.closing = True
+        self.ready.set()
+        thread.join(timeout)
+
+        self.thread = None
+        self.closing = False
+
+    def forked(self) -> None:  # The writer thread stays behind in the parent, and so do its records
+        self.queue = deque()
+        self.ready = threading.Event()
+        self.thread = None
+        self.closing = False